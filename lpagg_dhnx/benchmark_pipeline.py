@@ -0,0 +1,235 @@
+# -*- coding: utf-8 -*-
+
+"""Scaling benchmark of the stages of the workflow with synthetic districts.
+
+Runs the stages of import_osm_invest_lpagg for synthetic districts (see
+synthetic_district) of several sizes and street layouts, without OSM
+data:
+
+- 'generate': streets and buildings (replaces the OSM download of Part I)
+- 'lpagg': peak loads of the buildings (building_loads.run_lpagg())
+- 'geometry': network_design.prepare_geometry()
+- 'optimize': network_design.optimize_network()
+- 'apply_DN': network_design.apply_DN()
+
+For each stage, the wall time, the CPU time, the peak resident set size
+(RSS) of the process and the number of rows of the result are recorded
+with instrumentation.stage(), together with the steps recorded within
+the stages (e.g. 'optimize/optimize_investment', with the time of the
+solver run in 'solver_seconds'). Each district is run in a new process,
+so the memory of one district does not count for the next one.
+
+The aggregator and the optimisation do not scale to the biggest
+districts. Above ``--lpagg-max`` buildings, the peak loads are estimated
+with a peak_load_model.PeakLoadModel, which is calibrated with the
+results of the biggest district that used the aggregator (or loaded from
+``--peak-load-model``). Above ``--optimize-max`` buildings, the fast mode
+of the Steiner tree heuristic is used instead of the solver. The method
+of each stage is stored in the results.
+
+The results are written to a JSON file, together with the exponent b of
+a fit of the wall time t = a * n^b over the number of buildings n for
+each stage and layout.
+
+Usage::
+
+    python benchmark_pipeline.py --output bench_pipeline.json
+    python benchmark_pipeline.py --sizes 10 100 1000 --layouts grid
+
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import logging
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+
+import instrumentation
+import synthetic_district
+
+# Define the logging function
+logger = logging.getLogger(__name__)
+
+STAGES = ['generate', 'lpagg', 'geometry', 'optimize', 'apply_DN']
+
+
+def setup():
+    """Set up logger."""
+    logging.basicConfig(format='%(asctime)-15s %(levelname)-8s %(message)s')
+    logger.setLevel(level='INFO')
+    logging.getLogger('instrumentation').setLevel(level='INFO')
+    logging.getLogger('lpagg.agg').setLevel(level='ERROR')
+    logging.getLogger('lpagg.simultaneity').setLevel(level='ERROR')
+
+
+def _stage(case, name, func, **kwargs):
+    """Run one stage with instrumentation, return the result or None."""
+    try:
+        with instrumentation.stage(name) as record:
+            result = func(**kwargs)
+            record['rows'] = instrumentation.rows(result)
+    except Exception:
+        # Later sizes and stages may still work, e.g. without a solver
+        result = None
+    record.update(case)
+    logger.info('{layout} {n_buildings}: {stage} in {seconds:.2f} s, peak '
+                'RSS {rss_peak_mb:.0f} MB'.format(**record))
+    if record['error']:
+        logger.error('{layout} {n_buildings}: {stage} failed: {error}'
+                     .format(**record))
+    return result
+
+
+def run_case(layout, n_buildings, lpagg_max=1000, optimize_max=300,
+             peak_load_file=None, calibration=None, settings=None,
+             invest_data='invest_data', seed=42):
+    """Run all stages for one synthetic district.
+
+    :param layout:          [-]     street layout, 'grid' or 'tree'
+    :param n_buildings:     [-]     number of buildings
+    :param lpagg_max:       [-]     maximum number of buildings for the
+                                    aggregator, above: peak load model
+    :param optimize_max:    [-]     maximum number of buildings for the
+                                    solver, above: Steiner tree heuristic
+    :param peak_load_file:  [-]     calibrated PeakLoadModel (csv file)
+    :param calibration:     [-]     buildings with 'P_th' from the
+                                    aggregator, to calibrate the model
+    :param settings:        [-]     settings of optimize_investment()
+    :param invest_data:     [-]     path to the invest options of DHNx
+    :param seed:            [-]     seed of the synthetic district
+    :return:                [-]     tuple of the list of stage records (see
+                                    instrumentation) and the buildings with
+                                    peak loads (if the aggregator was used)
+    """
+    import building_loads
+    import network_design
+    import peak_load_model
+
+    setup()
+    instrumentation.clear()
+    case = dict(layout=layout, n_buildings=n_buildings)
+
+    def records():
+        """Return the records of all stages and steps of the case."""
+        df = instrumentation.records()
+        for key, value in case.items():
+            df[key] = value
+        return df.to_dict('records')
+
+    data = _stage(case, 'generate', synthetic_district.osm_data,
+                  n_buildings=n_buildings, layout=layout, seed=seed)
+    if data is None:
+        return records(), None
+
+    model = None
+    if n_buildings > lpagg_max:
+        if peak_load_file is not None:
+            model = peak_load_model.PeakLoadModel.load(peak_load_file)
+        elif calibration is not None:
+            model = peak_load_model.PeakLoadModel.calibrate(calibration)
+    method = 'aggregator' if model is None else 'peak_load_model'
+    houses = _stage(dict(case, method=method), 'lpagg',
+                    building_loads.run_lpagg, gdf=data['houses'],
+                    peak_load_model=model)
+    if houses is None:
+        return records(), None
+
+    consumers = houses.loc[houses['DH_stage'] == 1]
+    tn_input = _stage(case, 'geometry',
+                      network_design.prepare_geometry,
+                      lines=data['streets'], producers=data['generators'],
+                      consumers=consumers)
+    if tn_input is None:
+        return records(), None
+
+    heuristic = None if n_buildings <= optimize_max else 'fast'
+    optimization = _stage(
+        dict(case, method=heuristic or 'solver'), 'optimize',
+        network_design.optimize_network, tn_input=tn_input,
+        invest_data=invest_data, settings=settings, presolve=True,
+        heuristic=heuristic)
+    if optimization is not None:
+        pipes = optimization['pipes']
+        _stage(case, 'apply_DN', network_design.apply_DN,
+               gdf_pipes=pipes.loc[pipes['capacity'] > 0].copy(),
+               DN_xlsx=None)
+
+    return records(), houses if model is None else None
+
+
+def scaling(df):
+    """Return the exponent b of the fit t = a * n^b per layout and stage."""
+    rows = []
+    for (layout, stage), group in df.loc[df['error'].isna()].groupby(
+            ['layout', 'stage']):
+        if group['n_buildings'].nunique() < 2:
+            continue
+        b, _ = np.polyfit(np.log(group['n_buildings']),
+                          np.log(group['seconds']), 1)
+        rows.append(dict(layout=layout, stage=stage, exponent=b))
+    return pd.DataFrame(rows, columns=['layout', 'stage', 'exponent'])
+
+
+def main(args=None):
+    """Run the benchmark for all layouts and sizes and write the results."""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--output', default='bench_pipeline.json',
+                        help='JSON file for the results')
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=[10, 100, 1000, 10000, 50000],
+                        help='numbers of buildings')
+    parser.add_argument('--layouts', nargs='+', default=['grid', 'tree'],
+                        help='street layouts')
+    parser.add_argument('--lpagg-max', type=int, default=1000,
+                        help='maximum number of buildings for lpagg')
+    parser.add_argument('--optimize-max', type=int, default=300,
+                        help='maximum number of buildings for the solver')
+    parser.add_argument('--peak-load-model', default=None,
+                        help='csv file of a calibrated PeakLoadModel')
+    parser.add_argument('--solver', default='cbc', help='MILP solver')
+    args = parser.parse_args(args)
+
+    setup()
+    settings = dict(solver=args.solver, solve_kw={'tee': False})
+    records = []
+    for layout in args.layouts:
+        calibration = None
+        for n_buildings in sorted(args.sizes):
+            # A new process for each district, see the module docstring
+            with ProcessPoolExecutor(max_workers=1) as executor:
+                case_records, houses = executor.submit(
+                    run_case, layout, n_buildings,
+                    lpagg_max=args.lpagg_max,
+                    optimize_max=args.optimize_max,
+                    peak_load_file=args.peak_load_model,
+                    calibration=calibration, settings=settings).result()
+            records += case_records
+            if houses is not None:
+                calibration = houses
+
+    df = pd.DataFrame(records)
+    df_scaling = scaling(df)
+    logger.info('Results:\n{}'.format(
+        df.drop(columns=['rows', 'error']).to_string(index=False)))
+    logger.info('Exponent b of the wall time t = a * n^b:\n{}'.format(
+        df_scaling.pivot(index='stage', columns='layout',
+                         values='exponent').round(2).to_string()))
+
+    with open(args.output, 'w') as f:
+        json.dump({'python': platform.python_version(),
+                   'machine': platform.machine(),
+                   'cpu_count': os.cpu_count(),
+                   'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                   'results': df.replace({np.nan: None}).to_dict('records'),
+                   'scaling': df_scaling.to_dict('records'),
+                   }, f, indent=2)
+    logger.info('Results written to {}'.format(args.output))
+    return 1 if df['error'].notna().any() else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,296 @@
+# -*- coding: utf-8 -*-
+
+"""Benchmark and accuracy regression checks for pre_calc_pmax.
+
+Measures the throughput of the pressure drop and maximum velocity
+calculations and compares their results with a high-precision reference,
+which uses CoolProp.PropsSI directly (instead of the property table) and
+solves the implicit friction laws with scipy.optimize.brentq close to
+machine precision.
+
+The results are written to a JSON file. If a baseline file from an
+earlier run is given, the script exits with code 1 when the throughput of
+any case drops by more than ``--max-slowdown`` or when an accuracy limit
+is exceeded.
+
+Usage::
+
+    python benchmark_pre_calc_pmax.py --output bench.json
+    python benchmark_pre_calc_pmax.py --baseline bench.json
+
+"""
+import sys
+import json
+import time
+import argparse
+import platform
+import logging
+import numpy as np
+import pandas as pd
+from scipy.optimize import brentq
+from CoolProp.CoolProp import PropsSI
+
+import pre_calc_pmax
+
+# Define the logging function
+logger = logging.getLogger(__name__)
+
+# Maximum accepted relative deviation from the reference
+ACCURACY_LIMITS = {
+    'delta_p': 1e-5,        # property table + Newton friction factor
+    'v_max': 2e-3,          # solvers stop at p_epsilon / v_epsilon
+    'v_max_secant': 1e-2,   # calc_v_max() uses p_epsilon=1 Pa/m
+    }
+
+# Inputs (v [m/s], d_i [m], k [mm]) that fall into each flow regime
+REGIMES = {
+    'laminar': dict(v=(0.001, 0.01), d_i=(0.02, 0.05), k=0.01),
+    'prandtl': dict(v=(0.2, 0.5), d_i=(0.02, 0.05), k=0.001),
+    'nikuradse': dict(v=(1, 2), d_i=(0.1, 0.2), k=0.001),
+    'karman': dict(v=(3, 5), d_i=(0.5, 0.6), k=0.0001),
+    'transition': dict(v=(1, 2), d_i=(0.05, 0.1), k=0.1),
+    'rough': dict(v=(5, 8), d_i=(0.02, 0.03), k=2),
+    }
+
+
+def setup():
+    """Set up logger."""
+    logging.basicConfig(format='%(asctime)-15s %(levelname)-8s %(message)s')
+    logger.setLevel(level='INFO')
+
+
+def reference_delta_p(v, d_i, k=0.1, T_medium=90, pressure=1,
+                      fluid='IF97::Water'):
+    """Calculate the pressure drop [Pa/m] with high precision."""
+    k = k * 0.001
+    d = PropsSI('D', 'T', T_medium + 273.15, 'P', pressure*101325, fluid)
+    d_v = PropsSI('V', 'T', T_medium + 273.15, 'P', pressure*101325, fluid)
+    R_e = v * d_i / (d_v/d)
+
+    regime = pre_calc_pmax.flow_regime(R_e, k, d_i)
+    if regime == pre_calc_pmax.REGIME_LAMINAR:
+        lam = 64 / R_e
+    elif regime == pre_calc_pmax.REGIME_PRANDTL:
+        lam = 0.3164 * R_e ** (-0.25)
+    elif regime == pre_calc_pmax.REGIME_NIKURADSE:
+        lam = 0.0032 + 0.221 * R_e ** (-0.237)
+    elif regime == pre_calc_pmax.REGIME_ROUGH:
+        lam = (1 / (-2 * np.log10(k / (3.71 * d_i)))) ** 2
+    else:
+        b = 0 if regime == pre_calc_pmax.REGIME_KARMAN else k / (3.71*d_i)
+        x = brentq(lambda x: x + 2 * np.log10(2.51 * x / R_e + b),
+                   1, 100, xtol=1e-15, rtol=1e-15)
+        lam = 1 / x**2
+
+    return lam / d_i * d / 2 * v**2
+
+
+def reference_v_max(d_i, T_average, k=0.1, p_max=100):
+    """Calculate the maximum flow velocity [m/s] with high precision."""
+    return brentq(lambda v: reference_delta_p(v, d_i, k, T_average) - p_max,
+                  0.01, 10, xtol=1e-12)
+
+
+def timed(func, *args, min_time=0.2, max_repeat=100, **kwargs):
+    """Return the result and the best wall time of repeated calls.
+
+    The call is repeated at least three times and until ``min_time`` has
+    passed, which keeps the timing of small cases stable.
+    """
+    best = np.inf
+    total = 0
+    n = 0
+    while n < 3 or (total < min_time and n < max_repeat):
+        n += 1
+        start = time.perf_counter()
+        result = func(*args, **kwargs)
+        elapsed = time.perf_counter() - start
+        best = min(best, elapsed)
+        total += elapsed
+    return result, best
+
+
+class CallCounter():
+    """Count the calls of pre_calc_pmax.delta_p by the scalar solvers."""
+
+    def __init__(self):
+        self.calls = 0
+        self._delta_p = pre_calc_pmax.delta_p
+
+    def __enter__(self):
+        def counted(*args, **kwargs):
+            self.calls += 1
+            return self._delta_p(*args, **kwargs)
+        pre_calc_pmax.delta_p = counted
+        return self
+
+    def __exit__(self, *exc):
+        pre_calc_pmax.delta_p = self._delta_p
+
+
+def bench_delta_p(n_scalar=200, n_vector=100000, T_medium=65.37, seed=42):
+    """Benchmark delta_p() and delta_p_array() in each flow regime.
+
+    T_medium is chosen between the nodes of the property table, so that
+    the interpolation error is included.
+    """
+    rng = np.random.default_rng(seed)
+    results = dict()
+    for name, cfg in REGIMES.items():
+        v = rng.uniform(*cfg['v'], n_vector)
+        d_i = rng.uniform(*cfg['d_i'], n_vector)
+
+        props = pre_calc_pmax.fluid_properties.get_provider()
+        R_e = v * d_i / (props.viscosity(T_medium) / props.density(T_medium))
+        regimes = pre_calc_pmax.flow_regime(R_e, cfg['k']*0.001, d_i)
+        if not (regimes == regimes[0]).all():
+            logger.warning('Not all inputs of {} are in the same regime'
+                           .format(name))
+
+        dp_scalar, t_scalar = timed(
+            lambda: [pre_calc_pmax.delta_p(v[i], d_i[i], cfg['k'], T_medium)
+                     for i in range(n_scalar)])
+        dp_vector, t_vector = timed(pre_calc_pmax.delta_p_array,
+                                    v, d_i, cfg['k'], T_medium)
+
+        dp_ref = np.array([reference_delta_p(v[i], d_i[i], cfg['k'],
+                                             T_medium)
+                           for i in range(n_scalar)])
+        results['delta_p_' + name] = {
+            'throughput_scalar': n_scalar / t_scalar,
+            'throughput': n_vector / t_vector,
+            'speedup': (n_vector / t_vector) / (n_scalar / t_scalar),
+            'error_scalar': float(np.max(np.abs(dp_scalar/dp_ref - 1))),
+            'error': float(np.max(np.abs(dp_vector[:n_scalar]/dp_ref - 1))),
+            'accuracy_limit': ACCURACY_LIMITS['delta_p'],
+            }
+    return results
+
+
+def bench_v_max(T_average=65, p_max=100):
+    """Compare calc_v_max(), v_max_bisection() and v_max_array()."""
+    d_i = np.array([25, 32, 40, 50, 63, 75, 90, 110, 125,
+                    160, 200, 250, 300, 350, 400, 500, 600]) / 1000
+    k = 0.01
+    v_ref = np.array([reference_v_max(d, T_average, k, p_max) for d in d_i])
+
+    results = dict()
+    for name, func in [('secant', pre_calc_pmax.calc_v_max),
+                       ('bisection', pre_calc_pmax.v_max_bisection)]:
+        def run():
+            return np.array([func(d, T_average, k=k, p_max=p_max)
+                             for d in d_i], dtype=float)
+
+        with CallCounter() as counter:
+            run()
+        v, t = timed(run)
+        results['v_max_' + name] = {
+            'throughput': len(d_i) / t,
+            'delta_p_calls_per_row': counter.calls / len(d_i),
+            'error': float(np.nanmax(np.abs(v/v_ref - 1))),
+            'accuracy_limit': ACCURACY_LIMITS.get('v_max_' + name,
+                                                  ACCURACY_LIMITS['v_max']),
+            }
+
+    (v, converged, n_iter), t = timed(pre_calc_pmax.v_max_array, d_i,
+                                      T_average, k=k, p_max=p_max)
+    results['v_max_newton'] = {
+        'throughput': len(d_i) / t,
+        'iterations_mean': float(n_iter.mean()),
+        'iterations_max': int(n_iter.max()),
+        'converged': bool(converged.all()),
+        'error': float(np.max(np.abs(v/v_ref - 1))),
+        'accuracy_limit': ACCURACY_LIMITS['v_max'],
+        }
+    return results
+
+
+def bench_dataframe_german(sizes=(17, 1000, 100000), seed=42):
+    """Benchmark calc_dataframe_german() for DN tables of several sizes."""
+    rng = np.random.default_rng(seed)
+    results = dict()
+    for n in sizes:
+        df = pd.DataFrame({
+            'Innendurchmesser [m]': rng.uniform(0.02, 0.6, n),
+            'Max delta p [Pa/m]': rng.choice([50, 100, 200], n),
+            'Rauhigkeit [mm]': rng.choice([0.01, 0.1], n),
+            'T_Vorlauf [°C]': rng.choice([60, 70, 80], n),
+            'T_Rücklauf [°C]': rng.choice([30, 40, 50], n),
+            })
+        df['Temperaturniveau [°C]'] = (
+            (df['T_Vorlauf [°C]'] + df['T_Rücklauf [°C]']) / 2)
+
+        df_res, t = timed(pre_calc_pmax.calc_dataframe_german, df.copy())
+        results['dataframe_german_{}'.format(n)] = {
+            'throughput': n / t,
+            'wall_time': t,
+            'converged': bool(df_res['v_max [m/s]'].notna().all()),
+            }
+    return results
+
+
+def check(results, baseline=None, max_slowdown=0.3):
+    """Return a list of regressions against limits and the baseline."""
+    failures = []
+    for case, res in results.items():
+        if 'accuracy_limit' in res and res['error'] > res['accuracy_limit']:
+            failures.append('{}: error {:.2e} > {:.2e}'.format(
+                case, res['error'], res['accuracy_limit']))
+        if res.get('converged') is False:
+            failures.append('{}: not converged'.format(case))
+        if baseline and case in baseline:
+            ratio = res['throughput'] / baseline[case]['throughput']
+            if ratio < 1 - max_slowdown:
+                failures.append('{}: throughput {:.0f}/s is {:.0%} of the '
+                                'baseline'.format(case, res['throughput'],
+                                                  ratio))
+    return failures
+
+
+def main(args=None):
+    """Run all benchmarks, write the results and check for regressions."""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--output', default='bench_pre_calc_pmax.json',
+                        help='JSON file for the results')
+    parser.add_argument('--baseline', default=None,
+                        help='JSON file of an earlier run to compare with')
+    parser.add_argument('--max-slowdown', type=float, default=0.3,
+                        help='accepted relative loss of throughput')
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=[17, 1000, 100000],
+                        help='sizes of the DN tables')
+    args = parser.parse_args(args)
+
+    setup()
+    results = dict()
+    results.update(bench_delta_p())
+    results.update(bench_v_max())
+    results.update(bench_dataframe_german(sizes=args.sizes))
+
+    for case, res in results.items():
+        logger.info('{:<28} {}'.format(case, ', '.join(
+            '{}={:.4g}'.format(key, value) for key, value in res.items())))
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+
+    failures = check(results, baseline, max_slowdown=args.max_slowdown)
+
+    with open(args.output, 'w') as f:
+        json.dump({'python': platform.python_version(),
+                   'machine': platform.machine(),
+                   'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                   'results': results,
+                   'failures': failures,
+                   }, f, indent=2)
+    logger.info('Results written to {}'.format(args.output))
+
+    for failure in failures:
+        logger.error(failure)
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,376 @@
+# -*- coding: utf-8 -*-
+
+"""Heat demand and peak thermal load of the buildings.
+
+run_lpagg() is Part II of the example workflow (import_osm_invest_lpagg.py):
+the floor area of each building is derived from its footprint and number
+of levels, the annual demand from the building typology and the peak
+thermal load 'P_th' from the load profiles of the aggregator lpagg
+(VDI 4655), or from a peak_load_model.PeakLoadModel for screening.
+
+Usage::
+
+    import building_loads
+    gdf_poly_houses = building_loads.run_lpagg(gdf_poly_houses)
+
+"""
+import os
+import shutil
+import logging
+import tempfile
+import numpy as np
+import pandas as pd
+import shapely
+
+import dhnx.gistools.geometry_operations as go
+
+import lpagg.agg
+import lpagg.misc
+
+import instrumentation
+
+# Define the logging function
+logger = logging.getLogger(__name__)
+
+# Relative tolerance of the peak loads from the load profiles compared to
+# the peak loads printed by lpagg (see run_aggregator())
+P_MAX_RTOL = 1e-3
+
+
+# Building typology: OSM building tag -> lpagg house type, number of
+# apartments and persons and specific demand for space heating and
+# domestic hot water in kWh / (m² * a), with m² = NRF
+BUILDING_TYPOLOGY = pd.DataFrame(
+    [('house', 'EFH', 1, 2, 150, 18),
+     ('residential', 'EFH', 1, 2, 150, 18),
+     ('detached', 'EFH', 1, 2, 150, 18),
+     ('semidetached_house', 'EFH', 1, 2, 150, 18),
+     ('apartments', 'MFH', 10, 20, 150, 18),
+     ('retail', 'G1G', 0, 0, 150, 0),
+     ('commercial', 'G1G', 0, 0, 150, 0),
+     ('industrial', 'G1G', 0, 0, 150, 0),
+     ],
+    columns=['building', 'house_type', 'N_WE', 'N_Pers',
+             'E_th_spec_heat', 'E_th_spec_DHW']).set_index('building')
+
+
+def assign_TRY(gdf, TRY_polygons):
+    """Return the test-reference-year code of all buildings at once.
+
+    All buildings are queried against an STRtree of the TRY polygons in
+    a single bulk query. A building that intersects several regions gets
+    the region with the largest overlap. A building that intersects no
+    region (e.g. at the coast or the border) gets the nearest region and
+    a warning is logged.
+
+    :param gdf:             [-]     GeoDataFrame of the buildings
+    :param TRY_polygons:    [-]     GeoDataFrame with column 'TRY_code'
+    :return:                [-]     Series of TRY codes with index of gdf
+    """
+    TRY_polygons = TRY_polygons.to_crs(gdf.crs)
+    geoms = gdf.geometry.to_numpy()
+    regions = TRY_polygons.geometry.to_numpy()
+    codes = TRY_polygons['TRY_code'].to_numpy()
+
+    tree = shapely.STRtree(regions)
+    i_bld, i_reg = tree.query(geoms, predicate='intersects')
+
+    # Ties: keep the region with the largest overlap of each building
+    n_hits = np.bincount(i_bld, minlength=len(geoms))
+    tie = n_hits[i_bld] > 1
+    overlap = np.zeros(len(i_bld))
+    if tie.any():
+        logger.debug('{} buildings intersect more than one TRY region'
+                     .format((n_hits > 1).sum()))
+        overlap[tie] = shapely.area(shapely.intersection(
+            geoms[i_bld[tie]], regions[i_reg[tie]]))
+    order = np.lexsort((-overlap, i_bld))
+    i_bld, i_reg = i_bld[order], i_reg[order]
+    first = np.r_[True, i_bld[1:] != i_bld[:-1]]
+
+    region = np.full(len(geoms), -1)
+    region[i_bld[first]] = i_reg[first]
+
+    # Misses: use the nearest region
+    miss = np.flatnonzero(region < 0)
+    if len(miss):
+        logger.warning('{} buildings are outside of all TRY regions, the '
+                       'nearest region is used'.format(len(miss)))
+        i_miss, i_near = tree.query_nearest(geoms[miss], all_matches=False)
+        region[miss[i_miss]] = i_near
+
+    return pd.Series(codes[region], index=gdf.index, name='TRY')
+
+
+def apply_typology(gdf, typology=None):
+    """Add house type, occupants and heat demand from a typology table.
+
+    The typology table is merged with the buildings on the OSM 'building'
+    tag. The specific demands refer to the net floor area 'A_NRF' [m²].
+    Buildings with a tag that is missing in the table get no house type
+    and are not passed to lpagg.
+
+    :param gdf:         [-]     GeoDataFrame with columns 'building' and
+                                'A_NRF'
+    :param typology:    [-]     DataFrame indexed by the building tag with
+                                the columns of BUILDING_TYPOLOGY
+    :return:            [-]     gdf with columns 'house_type', 'N_WE',
+                                'N_Pers', 'E_th_heat' and 'E_th_DHW' [kWh]
+    """
+    if typology is None:
+        typology = BUILDING_TYPOLOGY
+
+    types = typology.reindex(gdf['building'].to_numpy())
+    types.index = gdf.index
+    unknown = types['house_type'].isna()
+    if unknown.any():
+        logger.error('House type not defined for building tags: {}'.format(
+            sorted(gdf.loc[unknown, 'building'].astype(str).unique())))
+
+    gdf['house_type'] = types['house_type']
+    gdf['N_WE'] = types['N_WE']
+    gdf['N_Pers'] = types['N_Pers']
+    gdf['E_th_heat'] = types['E_th_spec_heat'] * gdf['A_NRF']
+    gdf['E_th_DHW'] = types['E_th_spec_DHW'] * gdf['A_NRF']
+    return gdf
+
+
+def houses_from_gdf(gdf):
+    """Create the dictionary of houses for lpagg from the building columns.
+
+    The house names are the string representation of the index.
+    Buildings without a house type are skipped.
+    """
+    gdf = gdf.loc[gdf['house_type'].notna()]
+    df_houses = pd.DataFrame({
+        'Q_Heiz_a': gdf['E_th_heat'],
+        'Q_Kalt_a': None,  # Cooling is not used
+        'Q_TWW_a': gdf['E_th_DHW'],
+        # 'W_a': None,  # uncomment = use estimation from VDI 2067
+        'house_type': gdf['house_type'],
+        'N_Pers': gdf['N_Pers'].astype(int),
+        'N_WE': gdf['N_WE'].astype(int),
+        'copies': 0,
+        'sigma': 4,  # standard deviation for simultainety
+        'TRY': gdf['TRY'],
+        })
+    df_houses.index = df_houses.index.astype(str)
+
+    duplicates = df_houses.index.duplicated()
+    if duplicates.any():
+        raise ValueError('House name duplicate: {}'.format(
+            list(df_houses.index[duplicates])))
+
+    return df_houses.to_dict(orient='index')
+
+
+def house_loads(weather_data, houses, intervall='1 hours',
+                energies=('Q_Heiz_TT', 'Q_TWW_TT')):
+    """Return the thermal load of each house from the aggregator result.
+
+    The result of lpagg.agg.aggregator_run() holds the energy per time step
+    of each house and type of energy in columns with several levels, one of
+    them with the house names and one with the energies (e.g. 'Q_Heiz_TT'
+    for space heating and 'Q_TWW_TT' for domestic hot water). The levels
+    are taken by their names 'house' and 'energy' if the columns have
+    these names, otherwise they are found by their values. Every house
+    must have exactly one column of each energy, otherwise a ValueError is
+    raised.
+
+    :param weather_data:    [-]     result of lpagg.agg.aggregator_run()
+    :param houses:          [-]     names of the houses
+    :param intervall:       [-]     length of a time step
+    :param energies:        [-]     energies that are summed up
+    :return:                [kW]    DataFrame of the load, time x houses
+    """
+    columns = weather_data.columns
+    levels = [columns.get_level_values(i) for i in range(columns.nlevels)]
+    if {'house', 'energy'} <= set(columns.names):
+        level_house = columns.names.index('house')
+        level_energy = columns.names.index('energy')
+    else:
+        level_house = next((i for i, values in enumerate(levels)
+                            if values.isin(houses).any()), None)
+        level_energy = next((i for i, values in enumerate(levels)
+                             if values.isin(energies).any()), None)
+    if level_house is None or level_energy is None \
+            or level_house == level_energy:
+        raise ValueError('Houses and energies {} not found in separate '
+                         'levels of the columns of the aggregator '
+                         'result'.format(list(energies)))
+
+    mask = (levels[level_house].isin(houses)
+            & levels[level_energy].isin(energies))
+    found = pd.MultiIndex.from_arrays([levels[level_house][mask],
+                                       levels[level_energy][mask]])
+    expected = pd.MultiIndex.from_product([list(houses), list(energies)])
+    missing = expected.difference(found)
+    if len(missing) > 0 or found.has_duplicates:
+        raise ValueError('The aggregator result needs one column of each '
+                         'energy per house, missing: {}, duplicate: '
+                         '{}'.format(list(missing)[:5],
+                                     list(found[found.duplicated()])[:5]))
+    energy = weather_data.loc[:, mask]
+    energy.columns = levels[level_house][mask]
+
+    hours = pd.Timedelta(intervall) / pd.Timedelta('1 hours')
+    load = energy.T.groupby(level=0).sum().T / hours  # kWh per step -> kW
+    return load.reindex(columns=list(houses))
+
+
+def lpagg_P_max(print_folder):
+    """Return the peak thermal load of each house printed by lpagg.
+
+    :param print_folder:    [-]     output folder of lpagg
+    :return:                [kW]    Series of 'P_th', index: house names
+    """
+    df_P_max = pd.read_csv(os.path.join(print_folder,
+                                        'lpagg_load_P_max.dat'),
+                           index_col='house')
+    df_P_max.index = df_P_max.index.astype(str)
+    return df_P_max['P_th']
+
+
+def run_aggregator(houses, print_folder=None, check_P_max=False):
+    """Run the load profile aggregator and return the load of all houses.
+
+    The load of each house is taken from the result of the aggregator in
+    memory (see house_loads()). For validation, ``check_P_max`` compares
+    its maximum with the peak load that lpagg prints to
+    'lpagg_load_P_max.dat' (in a temporary folder if no ``print_folder`` is
+    given) and raises a ValueError if they differ by more than P_MAX_RTOL.
+    This writes all output files of lpagg, so it is off by default.
+
+    :param houses:          [-]     dictionary of houses for lpagg
+    :param print_folder:    [-]     output folder of lpagg, e.g.
+                                    './lpagg_out' (default: no output)
+    :param check_P_max:     [-]     compare with the peak loads of lpagg
+    :return:                [kW]    DataFrame of the thermal load,
+                                    time x house names
+    """
+    logger.info('Running load profile aggregator...')
+    folder = print_folder
+    if check_P_max and print_folder is None:
+        folder = tempfile.mkdtemp(prefix='lpagg_')
+
+    # Create a configuration dictionary. In "normal" use of lpagg, this
+    # would be provided as a yaml file, but we can just define it here.
+    cfg = dict()
+    cfg['settings'] = dict()
+    cfg['print_folder'] = folder or './lpagg_out'
+    cfg['settings']['weather_file'] = './lpagg_in/DWD_TRY_weather_file.dat'
+    cfg['settings']['weather_data_type'] = 'DWD'
+    cfg['settings']['intervall'] = '1 hours'
+    cfg['settings']['start'] = [2021, 1, 1, 00, 00, 00]
+    cfg['settings']['end'] = [2022, 1, 1, 00, 00, 00]
+    cfg['settings']['apply_DST'] = True
+    cfg['settings']['language'] = 'en'
+    cfg['settings']['holidays'] = {'country': 'DE', 'province': 'SH'}
+    cfg['settings']['print_houses_xlsx'] = False
+    cfg['settings']['print_P_max'] = folder is not None
+    cfg['settings']['print_GLF_stats'] = print_folder is not None
+    cfg['settings']['show_plot'] = False
+
+    # Import the cfg from the dictionary
+    cfg = lpagg.agg.perform_configuration(cfg=cfg, ignore_errors=True)
+
+    # Information for all houses is derived from the previously defined table
+    cfg['houses'] = houses
+
+    # Now the "sorting" of houses has to be triggered manually
+    cfg = lpagg.agg.houses_sort(cfg)
+
+    # Now let the aggregator do its job
+    weather_data = lpagg.agg.aggregator_run(cfg)
+    try:
+        if folder is not None:
+            lpagg.agg.plot_and_print(weather_data, cfg)
+        if check_P_max:
+            P_max = lpagg_P_max(folder)
+    finally:
+        if folder != print_folder:
+            shutil.rmtree(folder, ignore_errors=True)
+
+    load = house_loads(weather_data, houses=list(houses),
+                       intervall=cfg['settings']['intervall'])
+    if check_P_max:
+        deviation = (load.max() / P_max.reindex(load.columns) - 1).abs()
+        if not (deviation <= P_MAX_RTOL).all():
+            raise ValueError('The peak loads of {} houses from the load '
+                             'profiles differ from the peak loads of lpagg '
+                             'by up to {:.2%}'.format(
+                                 (~(deviation <= P_MAX_RTOL)).sum(),
+                                 deviation.max()))
+    return load
+
+
+def run_lpagg(gdf, typology=None, print_folder=None, return_load=False,
+              peak_load_model=None, check_P_max=False):
+    """Integrate the load profile aggregator to define thermal power.
+
+    The peak thermal power 'P_th' [kW] of each house is taken from the
+    load profiles returned by the aggregator. Files and plots of lpagg are
+    only created if a ``print_folder`` is given.
+
+    For screening, a calibrated peak_load_model.PeakLoadModel can be
+    given instead. Then the peak load is estimated from the annual demand
+    and the aggregator is not run (see peak_load_model for the accuracy).
+
+    :param gdf:             [-]     GeoDataFrame of the buildings
+    :param typology:        [-]     building typology table, default:
+                                    BUILDING_TYPOLOGY (see apply_typology())
+    :param print_folder:    [-]     output folder of lpagg, e.g.
+                                    './lpagg_out' (default: no output)
+    :param return_load:     [-]     also return the hourly thermal load [kW]
+                                    of each house (index of gdf as columns),
+                                    None with a peak_load_model
+    :param peak_load_model: [-]     PeakLoadModel for screening
+    :param check_P_max:     [-]     validate the peak loads against those
+                                    printed by lpagg (see run_aggregator())
+    :return:                [-]     gdf, or (gdf, load) if return_load
+    """
+    gdf = go.check_crs(gdf)
+
+    levels_default = 2
+    if 'building:levels' not in gdf:
+        gdf['building:levels'] = pd.NA
+    # OSM tags are strings
+    gdf['building:levels'] = pd.to_numeric(
+        gdf['building:levels']).fillna(levels_default).astype(float)
+    gdf['A_ground'] = gdf.area
+    ratio_NRF_to_BGF = 0.8
+    gdf['A_BGF'] = (gdf['A_ground'] * gdf['building:levels'])
+    gdf['A_NRF'] = gdf['A_BGF'] * ratio_NRF_to_BGF
+
+    # VDI 4655 needs the test-reference-year region, which we have to determine
+    TRY_polygons = lpagg.misc.get_TRY_polygons_GeoDataFrame()
+    TRY_polygons = go.check_crs(TRY_polygons)
+
+    gdf['TRY'] = assign_TRY(gdf, TRY_polygons)
+
+    gdf = apply_typology(gdf, typology=typology)
+
+    if peak_load_model is not None:
+        # Screening: estimate the peak load from the annual demand
+        logger.info('Estimating peak loads with the peak load model...')
+        gdf['P_th'] = peak_load_model.predict(gdf)
+        load = None
+    else:
+        # The thermal power of each house is the maximum of its load profile
+        with instrumentation.stage('aggregator'):
+            load = run_aggregator(houses_from_gdf(gdf),
+                                  print_folder=print_folder,
+                                  check_P_max=check_P_max)
+        load.columns = gdf.index[
+            gdf.index.astype(str).get_indexer(load.columns)]
+        gdf['P_th'] = load.max()
+
+    gdf['P_heat_max'] = gdf['P_th']
+    gdf['E_th_total'] = gdf[['E_th_heat', 'E_th_DHW']].sum('columns')
+    gdf['Vbh_th'] = gdf['E_th_total'] / gdf['P_th']
+
+    logger.debug('Thermal energy demand: %s kWh', gdf['E_th_total'].sum())
+
+    if return_load:
+        return gdf, load
+    return gdf  # = gdf_poly_houses
@@ -0,0 +1,223 @@
+# -*- coding: utf-8 -*-
+
+"""Tabulated fluid properties as a fast replacement for CoolProp.PropsSI.
+
+The hydraulic calculations in pre_calc_pmax need density, viscosity and
+heat capacity of water for only a few temperatures, but call PropsSI
+thousands of times. Here the properties are computed once on a fine grid
+of temperature and pressure, optionally stored on disk, and queries are
+answered by (vectorized) linear interpolation.
+
+The interpolation error is estimated when the table is built, by comparing
+the interpolated values at the centre of each grid cell with PropsSI.
+It is available as ``max_rel_error`` and is below 1e-5 for the default
+grid. Grid cells touching the vapour phase are not interpolated; queries
+in these cells (and outside of the grid) are passed on to PropsSI.
+
+Usage::
+
+    import fluid_properties
+    props = fluid_properties.get_provider('IF97::Water')
+    rho = props.density(T=65)  # [kg/m^3]
+
+Pressures use the same convention as pre_calc_pmax, i.e. the value is
+multiplied by 101325 Pa.
+"""
+import os
+import functools
+import logging
+import numpy as np
+import CoolProp
+from CoolProp.CoolProp import PropsSI
+
+# Define the logging function
+logger = logging.getLogger(__name__)
+
+# CoolProp output keys of the tabulated properties
+PROPERTIES = {'density': 'D',       # [kg/m^3]
+              'viscosity': 'V',     # dynamic viscosity [kg/(m*s)]
+              'cp': 'C',            # heat capacity [J/(kg*K)]
+              }
+
+_providers = dict()
+
+
+def get_provider(fluid='IF97::Water', cache_file=None):
+    """Return the shared property table for a fluid.
+
+    The table is built on first use. If a ``cache_file`` is given, the
+    table is loaded from it (or written to it after building). There is
+    one shared table per fluid and cache file. Without a ``cache_file``,
+    any existing table of the fluid is returned.
+
+    :param fluid:       [-]     type of fluid, default: 'IF97::Water'
+    :param cache_file:  [-]     path to a .npz file for persistence
+    :return:            [-]     FluidPropertyTable
+    """
+    if cache_file is not None:
+        cache_file = os.path.abspath(cache_file)
+    elif (fluid, None) not in _providers:
+        for (name, _), table in _providers.items():
+            if name == fluid:
+                return table
+    key = (fluid, cache_file)
+    if key not in _providers:
+        _providers[key] = FluidPropertyTable(fluid, cache_file=cache_file)
+    return _providers[key]
+
+
+class FluidPropertyTable():
+    """Grid of fluid properties over temperature and pressure."""
+
+    def __init__(self, fluid='IF97::Water', T_min=1, T_max=150, dT=0.1,
+                 pressures=(1, 2, 4, 6, 10, 16, 25), cache_file=None,
+                 memo_size=4096):
+        """Build or load the property grid.
+
+        :param fluid:       [-]     type of fluid, default: 'IF97::Water'
+        :param T_min:       [°C]    lowest temperature of the grid
+        :param T_max:       [°C]    highest temperature of the grid
+        :param dT:          [K]     temperature step of the grid
+        :param pressures:   [bar]   pressure levels of the grid (at least 2)
+        :param cache_file:  [-]     path to a .npz file for persistence
+        :param memo_size:   [-]     size of the LRU memo for scalar queries
+        """
+        self.fluid = fluid
+        self.T = np.arange(T_min, T_max + 0.5*dT, dT)
+        self.P = np.asarray(sorted(pressures), dtype=float)
+        if len(self.P) < 2:
+            raise ValueError('At least two pressure levels are required')
+        self.dT = dT
+        self.cache_file = cache_file
+
+        if not (cache_file and self._load(cache_file)):
+            self._build()
+            if cache_file:
+                self._save(cache_file)
+
+        self._scalar = functools.lru_cache(maxsize=memo_size)(
+            self._scalar_lookup)
+
+    def _signature(self):
+        """Return parameters that have to match for loading a cache file."""
+        return np.array([self.fluid, CoolProp.__version__,
+                         repr(self.T[0]), repr(self.T[-1]), repr(self.dT),
+                         repr(self.P.tolist())])
+
+    def _build(self):
+        """Evaluate all properties on the grid with CoolProp."""
+        logger.debug('Building property table for {}'.format(self.fluid))
+        self.tables = {name: self._props_grid(key, self.T, self.P)
+                       for name, key in PROPERTIES.items()}
+        self.max_rel_error = self._estimate_error()
+
+    def _props_grid(self, key, T, P):
+        """Call PropsSI for a grid of T and P, NaN in the vapour phase."""
+        TT, PP = np.meshgrid(T, P, indexing='ij')
+        values = PropsSI(key, 'T', TT.ravel() + 273.15,
+                         'P', PP.ravel()*101325, self.fluid)
+        values = np.asarray(values, dtype=float).reshape(TT.shape)
+        T_sat = np.array([self._saturation_temperature(p) for p in P])
+        values[TT >= T_sat[np.newaxis, :]] = np.nan
+        return values
+
+    def _saturation_temperature(self, p):
+        """Return the boiling temperature [°C], or inf if not defined."""
+        try:
+            return PropsSI('T', 'P', p*101325, 'Q', 0, self.fluid) - 273.15
+        except ValueError:
+            return np.inf
+
+    def _estimate_error(self):
+        """Compare interpolation at the cell centres with PropsSI."""
+        T_mid = 0.5 * (self.T[1:] + self.T[:-1])
+        P_mid = 0.5 * (self.P[1:] + self.P[:-1])
+        TT, PP = np.meshgrid(T_mid, P_mid, indexing='ij')
+        errors = dict()
+        for name, key in PROPERTIES.items():
+            exact = self._props_grid(key, T_mid, P_mid)
+            approx = self._interpolate(name, TT, PP)
+            errors[name] = float(np.nanmax(np.abs(approx/exact - 1)))
+        logger.debug('Maximum relative interpolation error: {}'
+                     .format(errors))
+        return errors
+
+    def _load(self, path):
+        """Load the tables from a .npz file, if it matches this grid."""
+        if not os.path.exists(path):
+            return False
+        with np.load(path, allow_pickle=False) as data:
+            if not np.array_equal(data['signature'], self._signature()):
+                logger.info('Property table {} is outdated'.format(path))
+                return False
+            self.tables = {name: data[name] for name in PROPERTIES}
+            self.max_rel_error = {name: float(data['error_' + name])
+                                  for name in PROPERTIES}
+        logger.debug('Loaded property table from {}'.format(path))
+        return True
+
+    def _save(self, path):
+        """Store the tables in a .npz file."""
+        if os.path.dirname(os.path.abspath(path)):
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        errors = {'error_' + name: value
+                  for name, value in self.max_rel_error.items()}
+        np.savez(path, signature=self._signature(), **self.tables, **errors)
+        logger.debug('Saved property table to {}'.format(path))
+
+    def _interpolate(self, name, T, P):
+        """Bilinear interpolation in the table, NaN outside of it."""
+        table = self.tables[name]
+        x = (T - self.T[0]) / self.dT
+        i = np.clip(np.floor(x).astype(int), 0, len(self.T) - 2)
+        t = x - i
+
+        j = np.clip(np.searchsorted(self.P, P, side='right') - 1,
+                    0, len(self.P) - 2)
+        s = (P - self.P[j]) / (self.P[j+1] - self.P[j])
+
+        values = ((1-t) * (1-s) * table[i, j] + t * (1-s) * table[i+1, j]
+                  + (1-t) * s * table[i, j+1] + t * s * table[i+1, j+1])
+
+        outside = ((x < 0) | (x > len(self.T) - 1) | (s < 0) | (s > 1))
+        return np.where(outside, np.nan, values)
+
+    def _scalar_lookup(self, name, T, P):
+        """Look up a single value (wrapped by an LRU memo)."""
+        return float(self.query(name, np.array([T]), np.array([P]))[0])
+
+    def query(self, name, T, P=1):
+        """Return a property for arrays of temperature and pressure.
+
+        :param name:        [-]     'density', 'viscosity' or 'cp'
+        :param T:           [°C]    temperature
+        :param P:           [bar]   pressure level
+        :return:            [-]     property values (float for scalar input)
+        """
+        if np.ndim(T) == 0 and np.ndim(P) == 0:
+            return self._scalar(name, float(T), float(P))
+
+        T, P = np.broadcast_arrays(np.asarray(T, dtype=float),
+                                   np.asarray(P, dtype=float))
+        values = self._interpolate(name, T, P)
+
+        missing = np.isnan(values)
+        if missing.any():
+            logger.debug('{} values not in property table, using CoolProp'
+                         .format(missing.sum()))
+            values[missing] = PropsSI(PROPERTIES[name],
+                                      'T', T[missing] + 273.15,
+                                      'P', P[missing]*101325, self.fluid)
+        return values
+
+    def density(self, T, P=1):
+        """Return the density [kg/m^3]."""
+        return self.query('density', T, P)
+
+    def viscosity(self, T, P=1):
+        """Return the dynamic viscosity [kg/(m*s)]."""
+        return self.query('viscosity', T, P)
+
+    def cp(self, T, P=1):
+        """Return the specific heat capacity [J/(kg*K)]."""
+        return self.query('cp', T, P)
@@ -14,6 +14,10 @@ Part II: Run the load profile aggregator
 Part III: Process the geometry for DHNx
 Part IV: Initialise the ThermalNetwork and perform the Optimisation
 Part V: Check the results
+Part VI: Sweep over adoption rates (optional)
+
+Each part is a stage of a pipeline (see pipeline.py). Results of the
+stages are stored on disk and reused as long as their inputs do not change.
 
 Contributors:
 - Johannes Röder
@@ -45,20 +49,25 @@ LPagg:
     - or download source from https://github.com/jnettels/lpagg
     - pip install -e <path to LPagg>
 
+pyrosm (optional, to read local .osm.pbf extracts, see osm_cache.py):
+    - pip install pyrosm
+
 """
 import os
 import numpy as np
-import pandas as pd
 import osmnx as ox
 import shapely
 import matplotlib.pyplot as plt
 
-import dhnx
 import dhnx.gistools.geometry_operations as go
-from dhnx.gistools.connect_points import process_geometry
 
-import lpagg.agg
-import lpagg.misc
+import building_loads
+import instrumentation
+import layer_io
+import network_design
+import osm_cache
+import peak_load_model
+import pipeline
 
 import logging
 
@@ -73,6 +82,9 @@ def setup():
     log_level = 'DEBUG'
     # log_level = 'INFO'
     logger.setLevel(level=log_level.upper())  # Logger for this module
+    # Parts II to V and the report of the stages
+    for module in ['building_loads', 'network_design', 'instrumentation']:
+        logging.getLogger(module).setLevel(level=log_level.upper())
     logging.getLogger('lpagg.agg').setLevel(level='ERROR')
     logging.getLogger('lpagg.simultaneity').setLevel(level='ERROR')
 
@@ -93,177 +105,84 @@ def save_geojson(gdf, file, path_geo='dhnx_out'):
         raise e
 
 
-def run_lpagg(gdf):
-    """Integrate the load profile aggregator to define thermal power."""
-    gdf = go.check_crs(gdf)
-    logger.info('Running load profile aggregator...')
-
-    levels_default = 2
-    if 'building:levels' not in gdf:
-        gdf['building:levels'] = pd.NA
-    gdf['building:levels'].fillna(levels_default, inplace=True)
-    gdf['building:levels'] = gdf['building:levels'].astype(float)
-    gdf['A_ground'] = gdf.area
-    ratio_NRF_to_BGF = 0.8
-    gdf['A_BGF'] = (gdf['A_ground'] * gdf['building:levels'])
-    gdf['A_NRF'] = gdf['A_BGF'] * ratio_NRF_to_BGF
-
-    # VDI 4655 needs the test-reference-year region, which we have to determine
-    TRY_polygons = lpagg.misc.get_TRY_polygons_GeoDataFrame()
-    TRY_polygons = go.check_crs(TRY_polygons)
-
-    houses = dict()
-    E_th_spec_heat = 150  # kWh / (m² * a); m² = NRF
-    E_th_spec_DHW = 18  # kWh / (m² * a); m² = NRF
-
-    for i in gdf.index:
-        house_name = str(i)
-        for _, TRY_region in TRY_polygons.iterrows():
-            if gdf.loc[i].geometry.intersects(TRY_region.geometry):
-                try_code = TRY_region['TRY_code']
-
-        if gdf.loc[i, 'building'] in ['house', 'residential', 'detached',
-                                      'semidetached_house']:
-            house_type = 'EFH'
-            N_WE = 1
-            N_Pers = 2
-            gdf.loc[i, 'E_th_heat'] = E_th_spec_heat * gdf.loc[i, 'A_NRF']
-            Q_Heiz_a = gdf.loc[i, 'E_th_heat']
-            gdf.loc[i, 'E_th_DHW'] = E_th_spec_DHW * gdf.loc[i, 'A_NRF']
-            Q_TWW_a = gdf.loc[i, 'E_th_DHW']
-        elif gdf.loc[i, 'building'] in ['apartments']:
-            house_type = 'MFH'
-            N_WE = 10
-            N_Pers = 2*N_WE
-            gdf.loc[i, 'E_th_heat'] = E_th_spec_heat * gdf.loc[i, 'A_NRF']
-            Q_Heiz_a = gdf.loc[i, 'E_th_heat']
-            gdf.loc[i, 'E_th_DHW'] = E_th_spec_DHW * gdf.loc[i, 'A_NRF']
-            Q_TWW_a = gdf.loc[i, 'E_th_DHW']
-        elif gdf.loc[i, 'building'] in ['retail', 'commercial', 'industrial']:
-            house_type = 'G1G'
-            N_WE = 0
-            N_Pers = 0
-            gdf.loc[i, 'E_th_heat'] = E_th_spec_heat * gdf.loc[i, 'A_NRF']
-            Q_Heiz_a = gdf.loc[i, 'E_th_heat']
-            gdf.loc[i, 'E_th_DHW'] = 0
-            Q_TWW_a = gdf.loc[i, 'E_th_DHW']
-
-        else:
-            logger.error('House type not defined: {}'.format(house_type))
-
-        if houses.get(house_name):
-            raise ValueError('House name duplicate: {}'.format(house_name))
-
-        houses[house_name] = dict({
-            'Q_Heiz_a': Q_Heiz_a,
-            'Q_Kalt_a': None,  # Cooling is not used
-            'Q_TWW_a': Q_TWW_a,
-            # 'W_a': None,  # uncomment = use estimation from VDI 2067
-            'house_type': house_type,
-            'N_Pers': N_Pers,
-            'N_WE': N_WE,
-            'copies': 0,
-            'sigma': 4,  # standard deviation for simultainety
-            'TRY': try_code,
-            })
-
-    # Create a configuration dictionary. In "normal" use of lpagg, this
-    # would be provided as a yaml file, but we can just define it here.
-    cfg = dict()
-    cfg['settings'] = dict()
-    cfg['print_folder'] = './lpagg_out'
-    cfg['settings']['weather_file'] = './lpagg_in/DWD_TRY_weather_file.dat'
-    cfg['settings']['weather_data_type'] = 'DWD'
-    cfg['settings']['intervall'] = '1 hours'
-    cfg['settings']['start'] = [2021, 1, 1, 00, 00, 00]
-    cfg['settings']['end'] = [2022, 1, 1, 00, 00, 00]
-    cfg['settings']['apply_DST'] = True
-    cfg['settings']['language'] = 'en'
-    cfg['settings']['holidays'] = {'country': 'DE', 'province': 'SH'}
-    cfg['settings']['print_houses_xlsx'] = False
-    cfg['settings']['print_P_max'] = True
-    cfg['settings']['print_GLF_stats'] = True
-    cfg['settings']['show_plot'] = False
-
-    # Import the cfg from the dictionary
-    cfg = lpagg.agg.perform_configuration(cfg=cfg, ignore_errors=True)
-
-    # Information for all houses is derived from the previously defined table
-    cfg['houses'] = houses
-
-    # Now the "sorting" of houses has to be triggered manually
-    cfg = lpagg.agg.houses_sort(cfg)
-
-    # Now let the aggregator do its job
-    weather_data = lpagg.agg.aggregator_run(cfg)
-    lpagg.agg.plot_and_print(weather_data, cfg)
-
-    # The thermal power of each house can be read from a certain file
-    df_P_max = pd.read_csv(os.path.join(cfg['print_folder'],
-                                        'lpagg_load_P_max.dat'),
-                           index_col='house')
-
-    gdf = pd.concat([gdf_poly_houses, df_P_max], axis='columns')
-    gdf['P_heat_max'] = gdf['P_th']
-    gdf['E_th_total'] = gdf[['E_th_heat', 'E_th_DHW']].sum('columns')
-    gdf['Vbh_th'] = gdf['E_th_total'] / gdf['P_th']
-
-    logger.debug('Thermal energy demand: %s kWh', gdf['E_th_total'].sum())
-
-    # breakpoint()
-    # return None
-    return gdf  # = gdf_poly_houses
-
-
-def apply_DN(gdf_pipes=None, DN_xlsx='./dhnx_out/DN_table_export.xlsx'):
-    """Apply norm diameter of pipes from capacity.
-
-    Export the results to the given xslx file.
-    """
-    import pre_calc_pmax
-
-    df_DN = pd.DataFrame(
-        {'Bezeichnung [DN]': [25, 32, 40, 50, 63, 75, 90, 110, 125,
-                              160, 200, 250, 300, 350, 400, 500, 600]})
-
-    df_DN['Innendurchmesser [m]'] = df_DN['Bezeichnung [DN]']/1000
-    df_DN['Max delta p [Pa/m]'] = 100
-    df_DN['Rauhigkeit [mm]'] = 0.01
-    df_DN['T_Vorlauf [°C]'] = 80  # °C
-    df_DN['T_Rücklauf [°C]'] = 50  # °C
-    df_DN['Temperaturniveau [°C]'] = (
-        (df_DN['T_Vorlauf [°C]'] + df_DN['T_Rücklauf [°C]']) / 2)
-
-    df_DN = pre_calc_pmax.calc_dataframe_german(df_DN)
-
-    # Export the diameter data to an Excel file
-    if not os.path.exists(os.path.abspath(os.path.dirname(DN_xlsx))):
-        os.makedirs(os.path.abspath(os.path.dirname(DN_xlsx)))
-    df_DN.to_excel(DN_xlsx)
+def save_layers(layers, formats=('parquet',), path_geo='dhnx_out'):
+    """Save several gdfs at once in the given formats.
 
-    # Now apply the norm diameter to the pipes dataframe
-    gdf_pipes['DN'] = 0
+    The binary formats 'parquet' and 'fgb' are written concurrently (see
+    layer_io). GeoJSON files are written afterwards with save_geojson().
 
-    for idx in gdf_pipes.index:
-        capacity = gdf_pipes.loc[idx, 'capacity']
-
-        if capacity > df_DN["P_max [kW]"].max():
-            index = df_DN.sort_values(by=["P_max [kW]"],
-                                      ascending=False).index[0]
-            logger.error('Maximum heat demand exceeds capacity of biggest '
-                         'pipe! The biggest pipe type is selected.')
-        else:
-            index = df_DN[df_DN["P_max [kW]"] >= capacity].sort_values(
-                by=["P_max [kW]"]).index[0]
-
-        gdf_pipes.loc[idx, 'DN'] = df_DN.loc[index, "Bezeichnung [DN]"]
-
-    return gdf_pipes
+    :param layers:      [-]     dict of file name: GeoDataFrame
+    :param formats:     [-]     list of 'parquet', 'fgb' and 'geojson'
+    :param path_geo:    [-]     output directory
+    """
+    layer_io.save_layers(layers, path_geo=path_geo,
+                         formats=[fmt for fmt in formats if fmt != 'geojson'])
+    if 'geojson' in formats:
+        for file, gdf in layers.items():
+            save_geojson(gdf, file, path_geo=path_geo)
+
+
+def get_osm_data(polygon, streets, buildings, cache_dir='./osm_cache',
+                 pbf=None, adoption_rate=0.7, seed=42):
+    """Part I: Get the OSM data and select generator and connected houses.
+
+    :param polygon:         [-]     shapely polygon in EPSG:4326
+    :param streets:         [-]     tag filter of the streets
+    :param buildings:       [-]     tag filter of the buildings
+    :param cache_dir:       [-]     OSM cache directory (see osm_cache)
+    :param pbf:             [-]     optional local .osm.pbf extract
+    :param adoption_rate:   [-]     fraction of buildings to connect to DHN
+    :param seed:            [-]     seed of the random selection
+    :return:                [-]     dict with GeoDataFrames 'houses',
+                                    'generators' and 'streets'
+    """
+    gdf_poly_houses = osm_cache.geometries_from_polygon(
+        polygon, tags=buildings, cache_dir=cache_dir, pbf=pbf)
+    gdf_lines_streets = osm_cache.geometries_from_polygon(
+        polygon, tags=streets, cache_dir=cache_dir, pbf=pbf)
+    gdf_poly_houses.drop(columns=['nodes'], inplace=True, errors='ignore')
+    gdf_lines_streets.drop(columns=['nodes'], inplace=True, errors='ignore')
+
+    gdf_poly_houses = go.check_crs(gdf_poly_houses)
+    gdf_lines_streets = go.check_crs(gdf_lines_streets)
+
+    # We need one (or more) buildings that we call "generators".
+    # Choose one among the buildings at random and move it to a new
+    # GeoDataFrame
+    np.random.seed(seed)
+    id_generator = np.random.randint(len(gdf_poly_houses))
+    gdf_poly_gen = gdf_poly_houses.iloc[[id_generator]].copy()
+    gdf_poly_houses.drop(index=gdf_poly_gen.index, inplace=True)
+    gdf_poly_houses.reset_index(drop=True, inplace=True)
+
+    # We may not want to supply all given buildings with heat, to simulate
+    # a low adoption rate among the building owners:
+    ids_DH = np.random.choice(len(gdf_poly_houses),
+                              size=int(adoption_rate*len(gdf_poly_houses)),
+                              replace=False)
+    gdf_poly_houses['DH_stage'] = 0
+    gdf_poly_houses.loc[ids_DH, 'DH_stage'] = 1
+
+    return dict(houses=gdf_poly_houses, generators=gdf_poly_gen,
+                streets=gdf_lines_streets)
 
 
 # Part I: Get OSM data #############
 setup()
 
+# Each part of the workflow is a stage of a pipeline. The result of each
+# stage is stored in 'pipeline_dir'. When the script is run again, stages
+# whose inputs and code did not change are loaded from there instead.
+# Stage names in 'force_stages' are always run.
+pipeline_dir = './dhnx_out/pipeline'
+force_stages = []  # e.g. ['optimize']
+pipe = pipeline.Pipeline(pipeline_dir, force=force_stages)
+
+# Formats of the exported layers in 'dhnx_out'. GeoParquet is the fastest
+# and smallest. QGIS can also open FlatGeobuf ('fgb') files, add 'geojson'
+# if GeoJSON files are needed.
+output_formats = ['parquet']  # e.g. ['parquet', 'fgb', 'geojson']
+
 # select the street types you want to consider as DHS routes
 # see: https://wiki.openstreetmap.org/wiki/Key:highway
 streets = dict({
@@ -301,38 +220,45 @@ bbox = [(9.1008896, 54.1954005),
         (9.1027474, 54.1895923),
         ]
 polygon = shapely.geometry.Polygon(bbox)
-graph = ox.graph_from_polygon(polygon, network_type='drive_service')
-ox.plot_graph(graph)  # show a plot of the selected street network
-
-gdf_poly_houses = ox.geometries_from_polygon(polygon, tags=buildings)
-gdf_lines_streets = ox.geometries_from_polygon(polygon, tags=streets)
-gdf_poly_houses.drop(columns=['nodes'], inplace=True)
-gdf_lines_streets.drop(columns=['nodes'], inplace=True)
 
-gdf_poly_houses = go.check_crs(gdf_poly_houses)
-gdf_lines_streets = go.check_crs(gdf_lines_streets)
+# The OSM data is stored in a local cache, so it is only downloaded once.
+# Optionally, set the path to a local .osm.pbf extract (e.g. from
+# https://download.geofabrik.de) to work without the Overpass API.
+osm_cache_dir = './osm_cache'
+osm_pbf = None
 
-# We need one (or more) buildings that we call "generators".
-# Choose one among the buildings at random and move it to a new GeoDataFrame
-np.random.seed(42)
-id_generator = np.random.randint(len(gdf_poly_houses))
-gdf_poly_gen = gdf_poly_houses.iloc[[id_generator]].copy()
-gdf_poly_houses.drop(index=gdf_poly_gen.index, inplace=True)
-gdf_poly_houses.reset_index(drop=True, inplace=True)
+with instrumentation.stage('osm_graph'):
+    graph = osm_cache.graph_from_polygon(
+        polygon, network_type='drive_service', cache_dir=osm_cache_dir,
+        pbf=osm_pbf)
+ox.plot_graph(graph)  # show a plot of the selected street network
 
 # We may not want to supply all given buildings with heat, to simulate
 # a low adoption rate among the building owners:
 adoption_rate = 0.7  # fraction of total buildings to connect to DHN
-ids_DH = np.random.choice(len(gdf_poly_houses),
-                          size=int(adoption_rate*len(gdf_poly_houses)),
-                          replace=False)
-gdf_poly_houses['DH_stage'] = 0
-gdf_poly_houses.loc[ids_DH, 'DH_stage'] = 1
+
+osm_data = pipe.run('osm', get_osm_data, polygon=polygon, streets=streets,
+                    buildings=buildings, cache_dir=osm_cache_dir,
+                    pbf=osm_pbf, adoption_rate=adoption_rate)
+gdf_poly_houses = osm_data['houses']
+gdf_poly_gen = osm_data['generators']
+gdf_lines_streets = osm_data['streets']
 
 # Part II: Run the load profile aggregator
 # The houses need a maximum thermal power. For this example, we get it
-# from load profiles
-gdf_poly_houses = run_lpagg(gdf_poly_houses)
+# from load profiles. Set a print folder to keep the files and plots of lpagg
+lpagg_print_folder = None  # e.g. './lpagg_out'
+# For screening of many districts, the peak loads can be estimated with a
+# model calibrated with earlier results of run_lpagg() instead (see
+# peak_load_model.py). The full aggregator should be used for the design.
+peak_load_file = None  # e.g. './lpagg_in/peak_load_model.csv'
+# The hourly loads of the houses are used for the pump power in Part V
+# (None with a peak load model)
+gdf_poly_houses, load_houses = pipe.run(
+    'lpagg', building_loads.run_lpagg, gdf=gdf_poly_houses,
+    print_folder=lpagg_print_folder, return_load=True,
+    peak_load_model=(None if peak_load_file is None else
+                     peak_load_model.PeakLoadModel.load(peak_load_file)))
 
 # plot the given geometry
 fig, ax = plt.subplots()
@@ -342,9 +268,10 @@ gdf_poly_houses[gdf_poly_houses['DH_stage'] == 0].plot(ax=ax, color='grey')
 gdf_poly_houses[gdf_poly_houses['DH_stage'] == 1].plot(ax=ax, color='green')
 plt.title('Geometry before processing')
 plt.show(block=False)
-save_geojson(gdf_poly_houses, 'consumers_polygon')
-save_geojson(gdf_poly_gen, 'producers_polygon')
+save_layers({'consumers_polygon': gdf_poly_houses,
+             'producers_polygon': gdf_poly_gen}, formats=output_formats)
 
+gdf_houses_all = gdf_poly_houses  # all houses, for the sweep in Part VI
 gdf_poly_houses = (gdf_poly_houses.where(gdf_poly_houses['DH_stage'] == 1)
                    .dropna(axis='index', how='all'))
 
@@ -355,12 +282,12 @@ gdf_poly_houses = (gdf_poly_houses.where(gdf_poly_houses['DH_stage'] == 1)
 # gdf_poly_gen = gpd.read_file('your_file.geojson')
 # gdf_poly_houses = gpd.read_file('your_file.geojson')
 
-# process the geometry
-tn_input = process_geometry(
-    lines=gdf_lines_streets.copy(),
-    producers=gdf_poly_gen.copy(),
-    consumers=gdf_poly_houses.copy(),
-)
+# process the geometry. For large areas, the geometry can be processed in
+# parallel tiles with an edge length of 'tile_size' in meters
+tile_size = None  # e.g. 1000
+tn_input = pipe.run('geometry', network_design.prepare_geometry,
+                    lines=gdf_lines_streets, producers=gdf_poly_gen,
+                    consumers=gdf_poly_houses, tile_size=tile_size)
 
 # plot output after processing the geometry
 _, ax = plt.subplots()
@@ -373,26 +300,11 @@ plt.show(block=False)
 
 # optionally export the geodataframes and load it into qgis, arcgis whatever
 # for checking the results of the geometry processing
-for filename, gdf in tn_input.items():
-    save_geojson(gdf, filename)
+save_layers(tn_input, formats=output_formats)
 
 
 # Part IV: Initialise the ThermalNetwork and perform the Optimisation #######
 
-# initialize a ThermalNetwork
-network = dhnx.network.ThermalNetwork()
-
-# add the pipes, forks, consumer, and producers to the ThermalNetwork
-for k, v in tn_input.items():
-    network.components[k] = v
-
-# check if ThermalNetwork is consistent
-network.is_consistent()
-
-# load the specification of the oemof-solph components
-invest_opt = dhnx.input_output.load_invest_options('invest_data')
-
-
 # optionally, define some settings for the solver. Especially increasing the
 # solution tolerance with 'ratioGap' or setting a maximum runtime in 'seconds'
 # helps if large networks take too long to solve
@@ -409,31 +321,64 @@ settings = dict(
     },
     )
 
+# Remove dead ends of pipes before the optimisation to reduce the size of
+# the model (see network_presolve.py). The results are mapped back to all
+# pipes. Chains of pipes are only contracted without heat losses, or with
+# 'approximate' (which neglects the losses within each chain).
+presolve = True  # False, True or 'approximate'
+
+# For large districts, the network can be cut at bridges (single streets
+# that connect parts of the network) and the parts solved in parallel
+# (see network_decomposition.py). With heat losses this is approximate and
+# needs 'approximate'. 'compare' also solves the whole network and logs
+# the speedup.
+decompose = None  # e.g. dict(min_pipes=200, approximate=True)
+
+# A heuristic supply tree along the streets (see steiner_heuristic.py) can
+# be passed to the solver as MIP start ('start'), or used as result
+# without running a solver ('fast'), e.g. for quick screening of variants
+heuristic = None  # None, 'start' or 'fast'
+
 # perform the investment optimisation
-network.optimize_investment(invest_options=invest_opt, **settings)
+optimization = pipe.run('optimize', network_design.optimize_network,
+                        tn_input=tn_input, invest_data='invest_data',
+                        settings=settings, presolve=presolve,
+                        decompose=decompose, heuristic=heuristic)
 
 
 # Part V: Check the results #############
 
 # get results
-results_edges = network.results.optimization['components']['pipes']
+gdf_pipes = optimization['pipes']
 
 # if logger.isEnabledFor(logging.DEBUG):
-#     print(results_edges[['from_node', 'to_node', 'hp_type', 'capacity',
-#                          'direction', 'costs', 'losses']])
+#     print(gdf_pipes[['from_node', 'to_node', 'hp_type', 'capacity',
+#                      'direction', 'costs', 'losses']])
 
-logger.info('Total costs: {}'.format(results_edges[['costs']].sum()))
-logger.info('Objective value: {}'.format(
-    network.results.optimization['oemof_meta']['objective']))
+logger.info('Total costs: {}'.format(gdf_pipes[['costs']].sum()))
+logger.info('Objective value: {}'.format(optimization['objective']))
 # (The costs of the objective value and the investment costs of the DHS
 # pipelines are the same, since no additional costs (e.g. for energy sources)
 # are considered in this example.)
 
-# add the investment results to the geoDataFrame
-gdf_pipes = network.components['pipes']
-gdf_pipes = gdf_pipes.join(results_edges, rsuffix='results_')
-
-gdf_pipes = apply_DN(gdf_pipes)  # Apply DN from capacity
+# Apply DN from capacity, pressure distribution, pump head and critical
+# consumer of the network, hourly heat losses of the invested pipes and
+# hourly pump power from the loads of the houses
+evaluation = pipe.run('evaluate', network_design.evaluate_network,
+                      gdf_pipes=gdf_pipes,
+                      weather_file='./lpagg_in/DWD_TRY_weather_file.dat',
+                      loads=load_houses, consumers=tn_input['consumers'])
+gdf_pipes = evaluation['pipes']
+logger.info('Critical path: {}'.format(
+    evaluation['hydraulics']['critical_path']))
+
+# Wall time of each stage
+pipe.report()
+# Wall time, CPU time, peak memory and number of rows of the stages and of
+# the steps within them (see instrumentation.py)
+instrumentation.report('./dhnx_out/run_report.json', settings=settings,
+                       presolve=presolve, decompose=decompose,
+                       heuristic=heuristic)
 
 # plot output after processing the geometry
 _, ax = plt.subplots()
@@ -447,4 +392,29 @@ plt.title('Invested pipelines')
 plt.show()
 
 # EXPORT RESULTS
-save_geojson(gdf_pipes, 'pipes')
+save_layers({'pipes': gdf_pipes}, formats=output_formats)
+
+
+# Part VI: Sweep over adoption rates (optional) #############
+
+# Get the network costs for many adoption rates and random selections of
+# the connected houses. The streets, the generator and the peak loads of
+# the houses are reused, only the geometry processing and the optimisation
+# are repeated for each variant in parallel processes.
+sweep_adoption_rates = None  # e.g. [0.3, 0.5, 0.7, 0.9]
+sweep_seeds = range(5)  # random selections per adoption rate
+if sweep_adoption_rates is not None:
+    df_sweep = pipe.run(
+        'sweep', network_design.sweep, houses=gdf_houses_all,
+        generators=gdf_poly_gen, streets=gdf_lines_streets,
+        adoption_rates=sweep_adoption_rates, seeds=list(sweep_seeds),
+        invest_data='invest_data', tile_size=tile_size, presolve=presolve,
+        settings=dict(settings, solve_kw={'tee': False}))
+    df_sweep.to_csv('./dhnx_out/sweep.csv', index=False)
+
+    _, ax = plt.subplots()
+    ax.scatter(df_sweep['adoption_rate'], df_sweep['costs'])
+    ax.set_xlabel('Adoption rate')
+    ax.set_ylabel('Costs')
+    plt.title('Network costs of the variants')
+    plt.show()
@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+
+"""Record wall time, CPU time and memory of the stages of the workflow.
+
+A stage is a block of code in a ``with stage(name)`` statement. For each
+stage, a record with the following entries is stored:
+
+- 'stage': name of the stage. Stages within other stages get the names
+  of the outer stages as prefix, e.g. 'optimize/optimize_investment'.
+- 'seconds': wall time
+- 'cpu_seconds': CPU time of the process (all threads, without child
+  processes, e.g. of the solver)
+- 'rss_mb': resident set size (RSS) of the process at the end [MB]
+- 'rss_peak_mb': peak RSS during the stage [MB]. On Linux, the peak is
+  reset at the start of each stage; on other systems, it is the peak of
+  the process up to the end of the stage.
+- 'rows': number of rows of the (Geo)DataFrames of the result of the
+  stage, if given with ``record['rows'] = rows(result)``
+- 'error': the exception, if the stage failed
+
+The records are collected in the process that runs the stages. Stages in
+other processes (e.g. of network_design.sweep()) are not recorded.
+
+Recording a stage reads the memory statistics of the process twice, which
+takes well below a millisecond, so the instrumentation can stay enabled.
+pipeline.Pipeline records all its stages. Within the stages, the
+optimisation records the call of optimize_investment() with the time of
+the solver run reported by pyomo ('solver_seconds'), and
+evaluate_network() records apply_DN, the hydraulics, the heat losses and
+the pump power.
+
+Usage::
+
+    import instrumentation
+    with instrumentation.stage('geometry') as record:
+        tn_input = process_geometry(...)
+        record['rows'] = instrumentation.rows(tn_input)
+    instrumentation.report('./dhnx_out/run_report.json')
+
+"""
+import os
+import sys
+import json
+import time
+import logging
+import platform
+from contextlib import contextmanager
+import numpy as np
+import pandas as pd
+
+# Define the logging function
+logger = logging.getLogger(__name__)
+
+COLUMNS = ['stage', 'seconds', 'cpu_seconds', 'rss_mb', 'rss_peak_mb',
+           'rows', 'error']
+
+_records = []
+_open = []  # records of the stages that are running
+
+
+def reset_peak_rss():
+    """Reset the peak RSS of the process (Linux only)."""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+def memory():
+    """Return the current and the peak RSS of the process [MB]."""
+    try:
+        with open('/proc/self/status') as f:
+            status = dict(line.split(':', 1) for line in f if ':' in line)
+        return (int(status['VmRSS'].split()[0]) / 1024,
+                int(status['VmHWM'].split()[0]) / 1024)
+    except (OSError, KeyError, ValueError):
+        pass
+    try:
+        import psutil  # optional, e.g. on Windows
+        info = psutil.Process().memory_info()
+        return info.rss / 1024**2, getattr(info, 'peak_wset',
+                                           info.rss) / 1024**2
+    except ImportError:
+        pass
+    try:
+        import resource
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        rss = rss / 1024**2 if sys.platform == 'darwin' else rss / 1024
+        return np.nan, rss
+    except ImportError:
+        return np.nan, np.nan
+
+
+def rows(result):
+    """Return the number of rows of the (Geo)DataFrames in a result.
+
+    :param result:  [-]     DataFrame or dict of DataFrames
+    :return:        [-]     number of rows, dict of key: number of rows,
+                            or None
+    """
+    if isinstance(result, pd.DataFrame):
+        return len(result)
+    if isinstance(result, dict):
+        return {key: len(value) for key, value in result.items()
+                if isinstance(value, pd.DataFrame)} or None
+    return None
+
+
+@contextmanager
+def stage(name):
+    """Record wall time, CPU time and memory of a block of code.
+
+    :param name:    [-]     name of the stage
+    :return:        [-]     the record of the stage (dict), e.g. to set
+                            the entry 'rows'
+    """
+    _, peak = memory()
+    for outer in _open:  # the peak of the outer stages is kept
+        outer['rss_peak_mb'] = np.fmax(outer['rss_peak_mb'], peak)
+    reset_peak_rss()
+
+    record = dict(stage='/'.join([r['stage'] for r in _open] + [name]),
+                  rss_peak_mb=np.nan, rows=None, error=None)
+    _open.append(record)
+    start, start_cpu = time.perf_counter(), time.process_time()
+    try:
+        yield record
+    except BaseException as e:
+        record['error'] = '{}: {}'.format(type(e).__name__, e)
+        raise
+    finally:
+        record['seconds'] = time.perf_counter() - start
+        record['cpu_seconds'] = time.process_time() - start_cpu
+        record['rss_mb'], peak = memory()
+        record['rss_peak_mb'] = np.fmax(record['rss_peak_mb'], peak)
+        _open.remove(record)
+        for outer in _open:
+            outer['rss_peak_mb'] = np.fmax(outer['rss_peak_mb'], peak)
+        _records.append(record)
+        logger.debug('Stage {stage}: {seconds:.2f} s, CPU {cpu_seconds:.2f} '
+                     's, peak RSS {rss_peak_mb:.0f} MB'.format(**record))
+
+
+def records():
+    """Return the records of all finished stages as DataFrame.
+
+    Further entries that were added to the records (e.g. by benchmark_
+    pipeline) are appended as columns.
+    """
+    df = pd.DataFrame(_records, columns=COLUMNS)
+    extra = pd.DataFrame(_records, index=df.index).drop(
+        columns=COLUMNS, errors='ignore')
+    return df.join(extra)
+
+
+def clear():
+    """Remove all records, e.g. before the next run in the same process."""
+    _records.clear()
+
+
+def summary(df=None):
+    """Return a one line summary of the stages."""
+    if df is None:
+        df = records()
+    top = df.loc[~df['stage'].str.contains('/')]
+    if top.empty:
+        return 'No stages recorded'
+    slowest = df.loc[df['seconds'].idxmax()]
+    return ('{} stages: {:.1f} s wall time, {:.1f} s CPU time, peak RSS '
+            '{:.0f} MB, slowest: {} ({:.1f} s){}'.format(
+                len(top), top['seconds'].sum(), top['cpu_seconds'].sum(),
+                df['rss_peak_mb'].max(), slowest['stage'],
+                slowest['seconds'],
+                ', {} failed'.format(df['error'].notna().sum())
+                if df['error'].notna().any() else ''))
+
+
+def report(path=None, **info):
+    """Log the summary and return (and write) the report of the run.
+
+    :param path:    [-]     JSON file for the report, default: no file
+    :param info:    [-]     further entries of the report, e.g. settings
+    :return:        [-]     dict with information on the run ('python',
+                            'machine', 'time', ...), the 'summary' line
+                            and the 'stages' (list of records)
+    """
+    df = records()
+    result = dict(python=platform.python_version(),
+                  machine=platform.machine(), cpu_count=os.cpu_count(),
+                  time=time.strftime('%Y-%m-%dT%H:%M:%S'), **info,
+                  summary=summary(df),
+                  stages=df.astype(object).where(df.notna(), None)
+                  .to_dict('records'))
+    logger.info(result['summary'])
+    if path is not None:
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump(result, f, indent=2, default=str)
+        logger.info('Run report written to {}'.format(path))
+    return result
@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+
+"""Export of GeoDataFrames to GeoParquet, FlatGeobuf and GeoJSON.
+
+GeoJSON is a text format. For large networks it is slow to write and
+read and several times larger than binary formats. Two binary formats
+are supported instead, both with a spatial index:
+
+- GeoParquet (.parquet): columnar and compressed. The bounding box of each
+  geometry is written as a covering column, so readers can filter row
+  groups by location.
+- FlatGeobuf (.fgb): a packed Hilbert R-tree is written in front of the
+  features. QGIS can open these files directly.
+
+save_layers() writes several layers (e.g. all layers of tn_input) in
+several formats concurrently. Threads are sufficient, because pyarrow
+and GDAL release the GIL while writing.
+
+Usage::
+
+    import layer_io
+    layer_io.save_layers(tn_input, path_geo='dhnx_out',
+                         formats=['parquet', 'fgb'])
+
+"""
+import os
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+# Define the logging function
+logger = logging.getLogger(__name__)
+
+# File extensions of the supported formats
+EXTENSIONS = {
+    'parquet': '.parquet',
+    'fgb': '.fgb',
+    'geojson': '.geojson',
+    }
+
+
+def _mixed_to_str(gdf):
+    """Convert object columns with values of mixed types to strings.
+
+    OSM tag columns may mix values of different types (e.g. numbers and
+    strings in 'building:levels'), which Parquet cannot store.
+    """
+    mixed = [col for col in gdf.columns.drop(gdf.geometry.name)
+             if gdf[col].dtype == object
+             and len(set(map(type, gdf[col].dropna()))) > 1]
+    if mixed:
+        gdf = gdf.copy()
+        for col in mixed:
+            gdf[col] = gdf[col].where(gdf[col].isna(), gdf[col].astype(str))
+    return gdf
+
+
+def write_parquet(gdf, path):
+    """Write a GeoParquet file, replacing an existing file atomically."""
+    gdf = _mixed_to_str(gdf)
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp = path + '.tmp'
+    gdf.to_parquet(tmp, compression='zstd', write_covering_bbox=True)
+    os.replace(tmp, path)
+
+
+def save_layer(gdf, file, path_geo='dhnx_out', fmt='parquet'):
+    """Save a GeoDataFrame in one of the supported formats.
+
+    :param gdf:         [-]     GeoDataFrame
+    :param file:        [-]     file name without extension
+    :param path_geo:    [-]     output directory
+    :param fmt:         [-]     'parquet', 'fgb' or 'geojson'
+    :return:            [-]     path of the written file
+    """
+    if fmt not in EXTENSIONS:
+        raise ValueError('Unknown output format {}. Choose from {}'.format(
+            fmt, list(EXTENSIONS)))
+    path = os.path.join(path_geo, file + EXTENSIONS[fmt])
+    os.makedirs(path_geo, exist_ok=True)
+    logger.info('Saving... ' + path)
+    if fmt == 'parquet':
+        write_parquet(gdf, path)
+    elif fmt == 'fgb':
+        gdf.to_file(path, driver='FlatGeobuf', SPATIAL_INDEX='YES')
+    else:
+        gdf.to_file(path, driver='GeoJSON')
+    return path
+
+
+def save_layers(layers, path_geo='dhnx_out', formats=('parquet',),
+                n_workers=None):
+    """Save several layers in several formats concurrently.
+
+    :param layers:      [-]     dict of file name: GeoDataFrame
+    :param path_geo:    [-]     output directory
+    :param formats:     [-]     list of formats, see save_layer()
+    :param n_workers:   [-]     number of threads, default: one per file
+    :return:            [-]     list of the written paths
+    """
+    jobs = [(gdf, file, path_geo, fmt)
+            for file, gdf in layers.items() for fmt in formats]
+    if not jobs:
+        return []
+    with ThreadPoolExecutor(max_workers=n_workers or len(jobs)) as executor:
+        return list(executor.map(lambda job: save_layer(*job), jobs))
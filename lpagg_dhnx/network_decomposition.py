@@ -0,0 +1,362 @@
+# -*- coding: utf-8 -*-
+
+"""Decompose the investment optimisation at bridges of the network.
+
+The optimisation model of DHNx is solved as one mixed integer problem,
+whose solve time grows much faster than linear with the number of pipes.
+Many pipes of a district heating network are bridges: removing one of
+them splits the network into two parts. With a single producer, all heat
+for the part behind a bridge (downstream) has to flow through the bridge,
+so the flow across it is fixed by the demand behind it. The downstream
+part can therefore be optimised on its own, with a virtual producer at
+the end of the bridge. The upstream part sees the downstream part as one
+virtual consumer at the end of the bridge.
+
+optimize_investment() cuts the network at bridges with at least
+``min_pipes`` pipes behind them (smaller branches stay with their
+upstream part). The parts are solved from the leaves towards the producer.
+Parts at the same level are independent and are solved in parallel
+processes. The heat demand of a virtual consumer is the inflow of the
+part behind it: the demand of its consumers plus the heat losses of its
+invested pipes. The virtual producers and consumers are connected to the
+fork at the end of the bridge by pipes of zero length, which have no
+costs and no losses.
+
+The network is deliberately only cut at bridges, not at the other
+articulation points (forks whose removal splits the network, e.g. where
+two rings of streets meet). Parts of street networks are mostly joined by
+single streets, and a bridge keeps every pipe in exactly one part.
+
+Accuracy: without heat losses, the result is exact. With heat losses, a
+downstream part is optimised without the costs its losses cause in the
+upstream part (a slightly higher capacity upstream). So with heat losses
+('l_factor' or 'l_factor_fix' of an active pipe type is not 0), the
+decomposition has to be allowed with ``approximate=True``. The objective
+is the sum of the objectives of all parts. It would include the costs of
+the virtual producers, so the producers must not have any costs (as in
+the example invest data), otherwise a ValueError is raised. Only the
+optimisation with heat_demand='scalar' is supported.
+
+Usage::
+
+    import network_decomposition
+    network_decomposition.optimize_investment(
+        network, invest_opt, min_pipes=200, approximate=True,
+        compare=True, solver='cbc')
+    network.results.optimization['components']['pipes']
+    network.results.optimization['decomposition']  # parts and wall times
+
+"""
+import time
+import logging
+from concurrent.futures import ProcessPoolExecutor
+import pandas as pd
+import geopandas as gpd
+import networkx as nx
+
+import dhnx
+
+import network_presolve
+
+# Define the logging function
+logger = logging.getLogger(__name__)
+
+
+def _kind(node):
+    """Return the kind of a node id, e.g. 'forks' for 'forks-12'."""
+    return node.split('-')[0]
+
+
+def _ids(node_list, kind):
+    """Return the ids (as str) of the nodes of one kind."""
+    return {node.split('-', 1)[1] for node in node_list
+            if _kind(node) == kind}
+
+
+def _find_parts(pipes, consumers, min_pipes):
+    """Assign every pipe to a part of the network.
+
+    :return:    [-]     tuple of a Series (part of each pipe) and a
+                        DataFrame of the parts (index) with their 'parent'
+                        part (-1 for the part with the producer), 'node'
+                        (fork at the end of the cut bridge) and 'level'
+                        (number of cut bridges to the producer)
+    """
+    graph = nx.Graph()
+    graph.add_edges_from(zip(pipes['from_node'], pipes['to_node']))
+    producer = [node for node in graph if _kind(node) == 'producers'][0]
+
+    # Components that remain connected without the bridges
+    bridges = list(nx.bridges(graph, root=producer))
+    core = graph.copy()
+    core.remove_edges_from(bridges)
+    component = dict()
+    for i, nodes in enumerate(nx.connected_components(core)):
+        component.update(dict.fromkeys(nodes, i))
+
+    # Tree of the components, connected by the bridges
+    tree = nx.Graph()
+    for u, v in bridges:
+        tree.add_edge(component[u], component[v], bridge=(u, v))
+    root = component[producer]
+    tree.add_node(root)
+    parent = dict(nx.bfs_predecessors(tree, root))
+    order = [root] + [c for _, children in nx.bfs_successors(tree, root)
+                      for c in children]
+
+    # Fork at the downstream end of the bridge above each component
+    end = dict()
+    for c, p in parent.items():
+        u, v = tree.edges[p, c]['bridge']
+        end[c] = v if component[v] == c else u
+
+    demand = consumers['P_heat_max'].copy()
+    demand.index = 'consumers-' + demand.index.astype(str)
+    demand = demand.groupby(demand.index.map(component)).sum()
+    internal = [component[u] for u, v in
+                zip(pipes['from_node'], pipes['to_node'])
+                if component[u] == component[v]]
+    size = pd.Series(internal, dtype=int).value_counts().to_dict()
+    load = {c: demand.get(c, 0) for c in order}
+
+    # Cut the bridges from the leaves upwards. The bridge itself stays in
+    # the upstream part.
+    cut = set()
+    for c in reversed(order[1:]):
+        size.setdefault(c, 0)
+        if (size[c] >= min_pipes and load[c] > 0
+                and _kind(end[c]) == 'forks'):
+            cut.add(c)
+            size[c] = 0
+        size[parent[c]] = size.get(parent[c], 0) + size[c] + 1
+        load[parent[c]] += load[c]
+
+    # Number the parts from the producer downwards
+    part_of = {root: 0}
+    parts = [dict(parent=-1, node=None, level=0)]
+    for c in order[1:]:
+        if c in cut:
+            part_of[c] = len(parts)
+            parts.append(dict(parent=part_of[parent[c]], node=end[c],
+                              level=parts[part_of[parent[c]]]['level'] + 1))
+        else:
+            part_of[c] = part_of[parent[c]]
+
+    # Bridges belong to the part of their upstream component
+    part = []
+    for u, v in zip(pipes['from_node'], pipes['to_node']):
+        cu, cv = component[u], component[v]
+        if cu != cv and parent.get(cu) == cv:
+            cu = cv
+        part.append(part_of[cu])
+    return (pd.Series(part, index=pipes.index),
+            pd.DataFrame(parts).rename_axis('part'))
+
+
+def _append(gdf, index, geometry, **attributes):
+    """Append one row to a GeoDataFrame."""
+    row = gpd.GeoDataFrame(dict(attributes, geometry=[geometry]),
+                           index=[index], crs=gdf.crs)
+    return pd.concat([gdf, row])
+
+
+def _sub_network(components, part, p, node, inflow, simultaneity):
+    """Return the components of one part with its virtual nodes.
+
+    :param components:      [-]     components of the whole network
+    :param part:            [-]     Series of the part of each pipe
+    :param p:               [-]     number of the part
+    :param node:            [-]     fork of the virtual producer, or None
+    :param inflow:          [-]     dict of fork: heat flow [kW] of the
+                                    virtual consumers
+    :param simultaneity:    [-]     simultaneity factor of the optimisation
+    :return:                [-]     tuple of the components and the list of
+                                    the ids of the virtual pipes
+    """
+    pipes = components['pipes'].loc[part == p]
+    nodes = set(pipes['from_node']) | set(pipes['to_node'])
+    forks, consumers, producers = [
+        components[k].loc[components[k].index.astype(str).isin(
+            _ids(nodes, k))]
+        for k in ['forks', 'consumers', 'producers']]
+
+    def fork_point(fork):
+        return forks.geometry[forks.index.astype(str)
+                              == fork.split('-', 1)[1]].iloc[0]
+
+    next_pipe = components['pipes'].index.max() + 1
+    next_consumer = components['consumers'].index.max() + 1
+    virtual = []
+    for fork, flow in inflow.items():
+        # The demand of consumers is multiplied by the simultaneity
+        consumers = _append(consumers, next_consumer, fork_point(fork),
+                            P_heat_max=flow / simultaneity)
+        virtual.append((next_pipe, fork, 'consumers-{}'.format(
+            next_consumer)))
+        next_consumer += 1
+        next_pipe += 1
+    if node is not None:
+        index = components['producers'].index.max() + 1
+        producers = _append(producers, index, fork_point(node))
+        virtual.append((next_pipe, 'producers-{}'.format(index), node))
+
+    virtual_pipes = pd.DataFrame(virtual, columns=['id', 'from_node',
+                                                   'to_node']).set_index('id')
+    virtual_pipes['length'] = 0.
+    pipes = pd.concat([pipes, virtual_pipes])
+    if 'existing' in pipes:
+        pipes['existing'] = pipes['existing'].fillna(0)
+    return (dict(forks=forks, consumers=consumers, producers=producers,
+                 pipes=pipes), list(virtual_pipes.index))
+
+
+def producer_costs(invest_options, producers):
+    """Return True if the producers may cause costs in the optimisation.
+
+    Costs are variable costs of the sources, excess or shortage flows of
+    the buses, any other component of the producers (e.g. transformers or
+    storages) and specific cost attributes of the producers.
+
+    :param invest_options:  [-]     invest options of DHNx
+    :param producers:       [-]     DataFrame of the producers
+    :return:                [-]     bool
+    """
+    for name, df in invest_options.get('producers', dict()).items():
+        if 'active' in df:
+            df = df.loc[df['active'] == 1]
+        if df.empty:
+            continue
+        if name == 'source':
+            costs = [c for c in df.columns if c.endswith('costs')]
+            if (df[costs].fillna(0) != 0).any(axis=None):
+                return True
+        elif name == 'bus':
+            for flow in ['excess', 'shortage']:
+                if flow in df and (df[flow] == 1).any():
+                    return True
+        else:
+            return True
+    costs = [c for c in producers.columns if str(c).endswith('costs')]
+    return bool((producers[costs].fillna(0) != 0).any(axis=None))
+
+
+def _solve(tn_input, invest_options, settings):
+    """Optimise one part and return its pipe results and objective."""
+    start = time.perf_counter()
+    network = dhnx.network.ThermalNetwork()
+    for k, v in tn_input.items():
+        network.components[k] = v
+    network.optimize_investment(invest_options=invest_options, **settings)
+    results = network.results.optimization
+    return dict(pipes=results['components']['pipes'],
+                objective=results['oemof_meta']['objective'],
+                seconds=time.perf_counter() - start)
+
+
+def optimize_investment(network, invest_options, min_pipes=200,
+                        n_workers=None, approximate=False, compare=False,
+                        **settings):
+    """Optimise the investment of a ThermalNetwork in parts.
+
+    The results are stored in ``network.results.optimization`` like by
+    network.optimize_investment(), with the additional key
+    'decomposition' (DataFrame of the parts with their parent part,
+    level, number of pipes, objective and wall time of the solve).
+
+    :param network:         [-]     dhnx.network.ThermalNetwork
+    :param invest_options:  [-]     invest options of DHNx
+    :param min_pipes:       [-]     minimum number of pipes behind a bridge
+                                    to solve them as separate part
+    :param n_workers:       [-]     number of processes, default: all cores
+    :param approximate:     [-]     allow the decomposition with heat
+                                    losses, which neglects the costs of
+                                    the losses in the upstream parts
+    :param compare:         [-]     also solve the network at once and log
+                                    the speedup and the difference of the
+                                    objective
+    :param settings:        [-]     settings of optimize_investment()
+    :return:                [-]     None
+    """
+    if settings.get('heat_demand', 'scalar') != 'scalar':
+        raise ValueError("Decomposition only supports heat_demand='scalar'")
+    components = {k: network.components[k] for k in
+                  ['forks', 'consumers', 'producers', 'pipes']}
+    if len(components['producers']) != 1:
+        logger.warning('Decomposition needs exactly one producer, solving '
+                       'the network at once')
+        network.optimize_investment(invest_options=invest_options,
+                                    **settings)
+        return
+    if producer_costs(invest_options, components['producers']):
+        raise ValueError('Decomposition needs producers without costs, '
+                         'otherwise the costs of the virtual producers are '
+                         'included in the objective')
+    if not network_presolve.lossless(invest_options):
+        if not approximate:
+            raise ValueError('Decomposition with heat losses is '
+                             'approximate, use approximate=True')
+        logger.warning('Decomposition with heat losses: the costs of the '
+                       'losses in the upstream parts are neglected. The '
+                       'result is approximate.')
+
+    start = time.perf_counter()
+    pipes = components['pipes']
+    part, parts = _find_parts(pipes, components['consumers'], min_pipes)
+    parts['pipes'] = part.value_counts().reindex(parts.index, fill_value=0)
+    logger.info('Decomposed the network with {} pipes into {} parts on {} '
+                'levels'.format(len(pipes), len(parts),
+                                parts['level'].max() + 1))
+
+    simultaneity = settings.get('simultaneity', 1)
+    inflow = {p: dict() for p in parts.index}  # fork: heat flow [kW]
+    solved = dict()
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        for level in sorted(parts['level'].unique(), reverse=True):
+            # Parts on the same level are independent
+            level_parts = parts.loc[parts['level'] == level]
+            args = [_sub_network(components, part, p,
+                                 row['node'] if row['parent'] >= 0 else None,
+                                 inflow[p], simultaneity)
+                    for p, row in level_parts.iterrows()]
+            futures = [executor.submit(_solve, tn_input, invest_options,
+                                       settings) for tn_input, _ in args]
+            for (p, row), (tn_input, virtual), future in zip(
+                    level_parts.iterrows(), args, futures):
+                result = future.result()
+                result['pipes'] = result['pipes'].drop(index=virtual)
+                solved[p] = result
+                if row['parent'] >= 0:
+                    # Heat flowing into this part: demand and losses
+                    inflow[row['parent']][row['node']] = (
+                        tn_input['consumers']['P_heat_max'].sum()
+                        * simultaneity + result['pipes']['losses'].sum())
+
+    pipes_results = pd.concat([solved[p]['pipes'] for p in parts.index])
+    pipes_results = pipes_results.loc[
+        pipes.index.intersection(pipes_results.index, sort=False)]
+    parts['objective'] = [solved[p]['objective'] for p in parts.index]
+    parts['seconds'] = [solved[p]['seconds'] for p in parts.index]
+    seconds = time.perf_counter() - start
+    objective = parts['objective'].sum()
+    logger.info('Solved {} parts in {:.1f} s (sum of the solve times '
+                '{:.1f} s)'.format(len(parts), seconds,
+                                   parts['seconds'].sum()))
+
+    if compare:
+        start = time.perf_counter()
+        network.optimize_investment(invest_options=invest_options,
+                                    **settings)
+        seconds_full = time.perf_counter() - start
+        objective_full = network.results.optimization['oemof_meta'][
+            'objective']
+        logger.info('Monolithic solve: {:.1f} s, speedup {:.1f}, '
+                    'difference of the objective {:.3%}'.format(
+                        seconds_full, seconds_full / seconds,
+                        objective / objective_full - 1))
+        parts.attrs.update(seconds_monolithic=seconds_full,
+                           objective_monolithic=objective_full)
+
+    network.results.optimization = dict(
+        components=dict(pipes=pipes_results),
+        oemof_meta=dict(objective=objective, seconds=seconds),
+        decomposition=parts)
@@ -0,0 +1,441 @@
+# -*- coding: utf-8 -*-
+
+"""Geometry processing, investment optimisation and evaluation of a network.
+
+prepare_geometry(), optimize_network() and evaluate_network() are Part
+III, Part IV and Part V of the example workflow
+(import_osm_invest_lpagg.py).
+
+sweep() runs both for many variants of the connected buildings, e.g. to
+get the cost curve of the network over the adoption rate. The streets,
+the generator and the houses with their peak loads (Part I and II) are
+the same for all variants. Each variant draws the connected houses at
+random with a given adoption rate and seed and is processed and
+optimised in a separate process. The result is one table with a row per
+variant:
+
+- 'n_consumers': number of connected houses
+- 'P_th_sum' [kW]: sum of the peak loads of the connected houses
+- 'objective': objective value of the optimisation
+- 'costs': investment costs of the pipes
+- 'length' [m]: trench length of the invested pipes
+- 'capacity' [kW]: invested capacity at the producers
+- 'seconds': wall time of the variant
+- 'error': error message, if the variant failed
+
+Usage::
+
+    import network_design
+    df = network_design.sweep(
+        houses=gdf_poly_houses, generators=gdf_poly_gen,
+        streets=gdf_lines_streets, adoption_rates=[0.3, 0.5, 0.7, 0.9],
+        seeds=range(5), settings=dict(solver='cbc'))
+
+"""
+import os
+import time
+import logging
+import itertools
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+
+import dhnx
+from dhnx.gistools.connect_points import process_geometry
+
+import instrumentation
+import network_decomposition
+import network_hydraulics
+import network_presolve
+import steiner_heuristic
+import thermal_losses
+import tiled_geometry
+
+# Define the logging function
+logger = logging.getLogger(__name__)
+
+SWEEP_COLUMNS = ['adoption_rate', 'seed', 'n_consumers', 'P_th_sum',
+                 'objective', 'costs', 'length', 'capacity', 'seconds',
+                 'error']
+
+
+def prepare_geometry(lines, producers, consumers, tile_size=None,
+                     n_workers=None):
+    """Part III: Process the geometry for DHNx.
+
+    For large areas, the geometry can be processed in parallel tiles with
+    an edge length of ``tile_size`` in meters (see tiled_geometry).
+
+    DHNx renumbers the consumers, so the index of each building is kept
+    in the column 'building_index' of the consumers (see consumer_loads()).
+    """
+    consumers = consumers.assign(building_index=consumers.index)
+    if tile_size is None:
+        return process_geometry(lines=lines.copy(),
+                                producers=producers.copy(),
+                                consumers=consumers.copy())
+    return tiled_geometry.process_geometry_tiled(
+        lines=lines, producers=producers, consumers=consumers,
+        tile_size=tile_size, n_workers=n_workers)
+
+
+def optimize_network(tn_input, invest_data='invest_data', settings=None,
+                     presolve=False, decompose=None, heuristic=None):
+    """Part IV: Initialise the ThermalNetwork and perform the optimisation.
+
+    With ``presolve``, the network is reduced before the optimisation and
+    the results are mapped back to all pipes (see network_presolve).
+    True removes dead ends and isolated parts and contracts chains only
+    if the pipe types have no heat losses, so the optimum is unchanged.
+    'approximate' contracts chains also with heat losses.
+
+    With ``decompose``, a dict of arguments of
+    network_decomposition.optimize_investment() (e.g. dict(min_pipes=200)),
+    the network is cut at bridges and the parts are solved in parallel.
+
+    With ``heuristic``, a supply tree is searched along the streets (see
+    steiner_heuristic): 'start' passes it to the solver as MIP start,
+    'fast' uses it as result without running a solver. It cannot be
+    combined with ``decompose``.
+
+    :return:    [-]     dict with the pipes including the investment
+                        results ('pipes') and the objective value
+    """
+    if heuristic not in (None, 'start', 'fast'):
+        raise ValueError("heuristic must be None, 'start' or 'fast', not "
+                         "{}".format(heuristic))
+    if heuristic is not None and decompose is not None:
+        raise ValueError('heuristic and decompose cannot be combined')
+    if presolve not in (False, True, 'approximate'):
+        raise ValueError("presolve must be False, True or 'approximate', "
+                         "not {}".format(presolve))
+
+    # load the specification of the oemof-solph components
+    invest_opt = dhnx.input_output.load_invest_options(invest_data)
+
+    if presolve:
+        presolved = network_presolve.reduce_network(
+            tn_input, invest_opt, approximate=presolve == 'approximate')
+        tn_input_orig, tn_input = tn_input, presolved['tn_input']
+
+    # initialize a ThermalNetwork
+    network = dhnx.network.ThermalNetwork()
+
+    # add the pipes, forks, consumer, and producers to the ThermalNetwork
+    for k, v in tn_input.items():
+        network.components[k] = v
+
+    # check if ThermalNetwork is consistent
+    network.is_consistent()
+
+    # perform the investment optimisation
+    settings = settings or dict()
+    if decompose is not None:
+        network_decomposition.optimize_investment(
+            network, invest_opt, **decompose, **settings)
+    elif heuristic == 'fast':
+        tree = steiner_heuristic.supply_tree(
+            network.components, invest_opt,
+            simultaneity=settings.get('simultaneity', 1))
+        network.results.optimization = dict(
+            components=dict(pipes=tree['pipes']),
+            oemof_meta=dict(objective=tree['objective']))
+    else:
+        if heuristic == 'start':
+            with instrumentation.stage('heuristic'):
+                start = steiner_heuristic.supply_tree(
+                    network.components, invest_opt,
+                    simultaneity=settings.get('simultaneity', 1))
+        # The solver time is taken from the results, the rest is the set
+        # up and build of the model and the processing of the results
+        with instrumentation.stage('optimize_investment') as record:
+            if heuristic == 'start':
+                steiner_heuristic.optimize_investment(
+                    network, invest_opt, start=start, **settings)
+            else:
+                network.optimize_investment(invest_options=invest_opt,
+                                            **settings)
+            record['solver_seconds'] = _solver_seconds(
+                network.results.optimization['oemof_meta'])
+            record['rows'] = instrumentation.rows(
+                network.results.optimization['components'])
+
+    # add the investment results to the geoDataFrame
+    results_edges = network.results.optimization['components']['pipes']
+    gdf_pipes = network.components['pipes']
+    if presolve:
+        results_edges = network_presolve.expand_results(
+            results_edges, tn_input_orig['pipes'], presolved['mapping'])
+        gdf_pipes = tn_input_orig['pipes']
+    gdf_pipes = gdf_pipes.join(results_edges, rsuffix='results_')
+
+    return dict(
+        pipes=gdf_pipes,
+        objective=network.results.optimization['oemof_meta']['objective'])
+
+
+def _solver_seconds(meta):
+    """Return the solve time reported by the solver [s], or NaN.
+
+    :param meta:    [-]     meta results of oemof.solph ('oemof_meta'),
+                            with the solver information of pyomo
+    :return:        [s]     time of the solver run
+    """
+    solver = meta.get('solver', dict())
+    for key in ['Time', 'Wallclock time', 'User time']:
+        try:
+            seconds = float(solver.get(key))
+        except (TypeError, ValueError):
+            continue
+        if seconds >= 0:
+            return seconds
+    return np.nan
+
+
+def apply_DN(gdf_pipes=None, DN_xlsx='./dhnx_out/DN_table_export.xlsx',
+             cache_dir='./dhnx_out/cache'):
+    """Apply norm diameter of pipes from capacity.
+
+    The DN table is only calculated if no cached result for the same
+    input exists in ``cache_dir``. Export the table to the given xslx file,
+    unless ``DN_xlsx`` is None.
+    """
+    import pre_calc_pmax
+
+    df_DN = pd.DataFrame(
+        {'Bezeichnung [DN]': [25, 32, 40, 50, 63, 75, 90, 110, 125,
+                              160, 200, 250, 300, 350, 400, 500, 600]})
+
+    df_DN['Innendurchmesser [m]'] = df_DN['Bezeichnung [DN]']/1000
+    df_DN['Max delta p [Pa/m]'] = 100
+    df_DN['Rauhigkeit [mm]'] = 0.01
+    df_DN['T_Vorlauf [°C]'] = 80  # °C
+    df_DN['T_Rücklauf [°C]'] = 50  # °C
+    df_DN['Temperaturniveau [°C]'] = (
+        (df_DN['T_Vorlauf [°C]'] + df_DN['T_Rücklauf [°C]']) / 2)
+
+    df_DN = pre_calc_pmax.calc_dataframe_german_cached(df_DN, cache_dir)
+
+    # Export the diameter data to an Excel file
+    if DN_xlsx is not None:
+        if not os.path.exists(os.path.abspath(os.path.dirname(DN_xlsx))):
+            os.makedirs(os.path.abspath(os.path.dirname(DN_xlsx)))
+        df_DN.to_excel(DN_xlsx)
+
+    # Now apply the norm diameter to the pipes dataframe
+    gdf_pipes = assign_DN(gdf_pipes, df_DN)
+
+    return gdf_pipes
+
+
+def assign_DN(gdf_pipes, df_DN):
+    """Assign the smallest sufficient norm diameter to all pipes at once.
+
+    The DN table is sorted by capacity once and the capacity of all pipes
+    is mapped to it with a single ``searchsorted``. Pipes whose capacity
+    exceeds the biggest pipe type get the biggest one and are flagged in
+    the column 'DN_oversize'. Pipes without capacity (NaN) get no DN and
+    are not flagged.
+
+    Additional columns describe the utilisation of the selected pipe:
+    'v [m/s]' and 'dp [Pa/m]' are the flow velocity and the pressure
+    gradient at the pipe's capacity, 'v_util' and 'dp_util' their ratio
+    to 'v_max [m/s]' and 'Max delta p [Pa/m]' of the DN table.
+    """
+    import pre_calc_pmax
+
+    df_DN = df_DN.sort_values(by=["P_max [kW]"], kind='stable')
+    P_max = df_DN["P_max [kW]"].to_numpy()
+    capacity = gdf_pipes['capacity'].to_numpy(dtype=float)
+
+    missing = np.isnan(capacity)
+    if missing.any():
+        logger.warning('{} pipes have no capacity, no DN is assigned to '
+                       'them.'.format(missing.sum()))
+    pos = np.searchsorted(P_max, capacity, side='left')
+    oversize = (pos >= len(P_max)) & ~missing
+    if oversize.any():
+        logger.error('Maximum heat demand of {} pipes exceeds capacity of '
+                     'biggest pipe! The biggest pipe type is selected.'
+                     .format(oversize.sum()))
+    pos[pos >= len(P_max)] = len(P_max) - 1
+
+    df_sel = df_DN.iloc[pos]
+    DN = df_sel["Bezeichnung [DN]"].to_numpy()
+    gdf_pipes['DN'] = np.where(missing, np.nan, DN) if missing.any() else DN
+    gdf_pipes['DN_oversize'] = oversize
+
+    # Capacity is proportional to the velocity for a given pipe type
+    v = df_sel['v_max [m/s]'].to_numpy() * capacity / P_max[pos]
+    dp = np.full(len(v), np.nan)
+    dp[~missing] = pre_calc_pmax.delta_p_array(
+        v[~missing],
+        d_i=df_sel['Innendurchmesser [m]'].to_numpy()[~missing],
+        k=df_sel['Rauhigkeit [mm]'].to_numpy()[~missing],
+        T_medium=df_sel['Temperaturniveau [°C]'].to_numpy()[~missing])
+    gdf_pipes['v [m/s]'] = v
+    gdf_pipes['v_util'] = v / df_sel['v_max [m/s]'].to_numpy()
+    gdf_pipes['dp [Pa/m]'] = dp
+    gdf_pipes['dp_util'] = dp / df_sel['Max delta p [Pa/m]'].to_numpy()
+
+    return gdf_pipes
+
+
+def consumer_loads(loads, consumers):
+    """Return the load profiles of the buildings with consumer node ids.
+
+    :param loads:       [kW]    hourly thermal load per building, the
+                                columns are the index of the buildings
+                                (see building_loads.run_lpagg())
+    :param consumers:   [-]     consumers of the processed geometry, with
+                                the columns 'id_full' and 'building_index'
+                                (see prepare_geometry())
+    :return:            [kW]    hourly thermal load per consumer, the
+                                columns are the consumer node ids
+    """
+    missing = ~consumers['building_index'].isin(loads.columns)
+    if missing.any():
+        raise ValueError('No load profile for the buildings {}'.format(
+            consumers.loc[missing, 'building_index'].tolist()))
+    loads = loads[consumers['building_index'].tolist()]
+    loads.columns = consumers['id_full'].to_numpy()
+    return loads
+
+
+def evaluate_network(gdf_pipes,
+                     weather_file='./lpagg_in/DWD_TRY_weather_file.dat',
+                     loads=None, consumers=None):
+    """Part V: Apply DN, solve the hydraulics and calculate heat losses.
+
+    If the hourly ``loads`` of the buildings (see building_loads.
+    run_lpagg() with return_load=True) and the ``consumers`` of the
+    processed geometry are given, the hourly pump power is calculated
+    from them as well.
+
+    :return:    [-]     dict with 'pipes', 'hydraulics' (see
+                        network_hydraulics.solve_network()), 'losses'
+                        (see thermal_losses.calc_losses()) and 'pumping'
+                        (see network_hydraulics.pumping_energy(), None
+                        without loads)
+    """
+    with instrumentation.stage('apply_DN'):
+        gdf_pipes = apply_DN(gdf_pipes)  # Apply DN from capacity
+
+    # Pressure distribution, pump head and critical consumer of the network
+    with instrumentation.stage('hydraulics'):
+        hydraulics = network_hydraulics.solve_network(gdf_pipes)
+
+    # Hourly heat losses of the invested pipes with the ground temperature
+    # derived from the weather file
+    with instrumentation.stage('losses'):
+        T_ground = thermal_losses.ground_temperature(weather_file)
+        losses = thermal_losses.calc_losses(gdf_pipes, T_ground)
+        gdf_pipes = gdf_pipes.join(losses['pipes'])
+
+    # Hourly pump power from the load profiles of the consumers
+    pumping = None
+    if loads is not None:
+        with instrumentation.stage('pumping'):
+            pumping = network_hydraulics.pumping_energy(
+                gdf_pipes, consumer_loads(loads, consumers))
+
+    return dict(pipes=gdf_pipes, hydraulics=hydraulics, losses=losses,
+                pumping=pumping)
+
+
+def select_consumers(houses, adoption_rate, seed=None, n_generators=1):
+    """Return the houses that are connected to the network at random.
+
+    The houses are drawn like by get_osm_data() of the example script, with
+    the legacy random generator of numpy. There, the generator is drawn
+    first from all buildings. So the same seed and adoption rate select the
+    same houses as Part I of the script.
+
+    :param houses:          [-]     GeoDataFrame of all houses
+    :param adoption_rate:   [-]     fraction of houses to connect
+    :param seed:            [-]     seed of the random selection
+    :param n_generators:    [-]     number of buildings that were drawn as
+                                    generators before
+    :return:                [-]     GeoDataFrame of the connected houses
+    """
+    rng = np.random.RandomState(seed)
+    rng.randint(len(houses) + n_generators)  # the draw of the generator
+    ids = rng.choice(len(houses), size=int(adoption_rate*len(houses)),
+                     replace=False)
+    return houses.iloc[np.sort(ids)]
+
+
+def _summary(gdf_pipes):
+    """Return trench length [m] and producer capacity [kW] of the pipes."""
+    invested = gdf_pipes.loc[gdf_pipes['capacity'] > 0]
+    at_producer = (invested['from_node'].str.startswith('producers')
+                   | invested['to_node'].str.startswith('producers'))
+    return dict(length=invested['length'].sum(),
+                capacity=invested.loc[at_producer, 'capacity'].sum())
+
+
+def _run_variant(adoption_rate, seed, houses, generators, streets,
+                 invest_data, settings, tile_size, presolve):
+    """Select, process and optimise one variant and return its row."""
+    start = time.perf_counter()
+    consumers = select_consumers(houses, adoption_rate, seed)
+    row = dict(adoption_rate=adoption_rate, seed=seed,
+               n_consumers=len(consumers),
+               P_th_sum=consumers['P_th'].sum())
+    try:
+        tn_input = prepare_geometry(streets, generators, consumers,
+                                    tile_size=tile_size, n_workers=1)
+        optimization = optimize_network(tn_input, invest_data, settings,
+                                        presolve=presolve)
+        row.update(objective=optimization['objective'],
+                   costs=optimization['pipes']['costs'].sum(),
+                   **_summary(optimization['pipes']))
+    except Exception as e:
+        # A single failed variant (e.g. infeasible) must not stop the sweep
+        row['error'] = '{}: {}'.format(type(e).__name__, e)
+    row['seconds'] = time.perf_counter() - start
+    return row
+
+
+def sweep(houses, generators, streets, adoption_rates, seeds=(42,),
+          invest_data='invest_data', settings=None, tile_size=None,
+          presolve=False, n_workers=None):
+    """Optimise the network for all combinations of adoption rate and seed.
+
+    :param houses:          [-]     GeoDataFrame of all houses with the
+                                    peak load 'P_th' (result of run_lpagg())
+    :param generators:      [-]     GeoDataFrame of the producers
+    :param streets:         [-]     GeoDataFrame of the streets
+    :param adoption_rates:  [-]     list of fractions of connected houses
+    :param seeds:           [-]     list of seeds of the random selection
+    :param invest_data:     [-]     path to the invest options of DHNx
+    :param settings:        [-]     settings of optimize_investment()
+    :param tile_size:       [m]     process the geometry in tiles (within
+                                    each variant, without further processes)
+    :param presolve:        [-]     reduce the network before the
+                                    optimisation, see optimize_network()
+    :param n_workers:       [-]     number of processes, default: all cores
+    :return:                [-]     DataFrame with the columns SWEEP_COLUMNS
+    """
+    variants = list(itertools.product(adoption_rates, seeds))
+    n_workers = min(n_workers or os.cpu_count(), len(variants))
+    logger.info('Running {} variants on {} processes'.format(
+        len(variants), n_workers))
+
+    common = (houses, generators, streets, invest_data, settings, tile_size,
+              presolve)
+    if n_workers > 1:
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            futures = [executor.submit(_run_variant, *variant, *common)
+                       for variant in variants]
+            rows = [future.result() for future in futures]
+    else:
+        rows = [_run_variant(*variant, *common) for variant in variants]
+
+    df = pd.DataFrame(rows, columns=SWEEP_COLUMNS)
+    for _, row in df.loc[df['error'].notna()].iterrows():
+        logger.error('Variant adoption_rate={} seed={} failed: {}'.format(
+            row['adoption_rate'], row['seed'], row['error']))
+    logger.info('Sweep results:\n{}'.format(df.drop(columns='error')
+                                           .to_string(index=False)))
+    return df
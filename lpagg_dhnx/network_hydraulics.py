@@ -0,0 +1,384 @@
+# -*- coding: utf-8 -*-
+
+"""Steady-state hydraulics of an invested DHNx thermal network.
+
+pre_calc_pmax evaluates single pipes. The functions here combine the
+pressure drop of all invested pipes of ``network.components['pipes']``
+(after apply_DN) to node pressures in the supply and return line, the
+required pump head and the worst-case (critical) consumer.
+
+Flows are taken as given, e.g. the design capacity of each pipe from the
+investment optimisation. The flow graph is a tree (or at least acyclic),
+so all node pressures follow from a single pass over the nodes in
+topological order. The pass is vectorized level by level, i.e. the Python
+loop only runs over the depth of the network, which allows networks with
+100k pipes to be solved in well below a second.
+
+pumping_energy() evaluates hourly load profiles instead of the design
+flows: loads are accumulated through the tree to hourly mass flows of
+all pipes, and the pressure loss of all pipes and hours is calculated in
+vectorized chunks of hours, giving the pump power as a time series.
+
+Usage::
+
+    import network_hydraulics
+    hydraulics = network_hydraulics.solve_network(gdf_pipes)
+    hydraulics['pump_head']  # [Pa]
+    # Loads of run_lpagg(return_load=True) have the buildings as columns
+    df_loads = network_design.consumer_loads(load, tn_input['consumers'])
+    df_pump = network_hydraulics.pumping_energy(gdf_pipes, df_loads)
+
+"""
+import logging
+import numpy as np
+import pandas as pd
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import breadth_first_order
+
+import pre_calc_pmax
+
+# Define the logging function
+logger = logging.getLogger(__name__)
+
+
+def _orient_edges(u, v, sources, n_nodes):
+    """Orient undirected edges away from the sources.
+
+    A virtual node connected to all sources is the root of a breadth first
+    search. Each edge is directed from the node that is visited first to
+    the node visited later, which always yields an acyclic graph.
+    """
+    root = n_nodes
+    rows = np.concatenate([u, np.full(len(sources), root)])
+    cols = np.concatenate([v, sources])
+    graph = coo_matrix((np.ones(len(rows)), (rows, cols)),
+                       shape=(n_nodes + 1, n_nodes + 1)).tocsr()
+    order = breadth_first_order(graph, root, directed=False,
+                                return_predecessors=False)
+    rank = np.full(n_nodes + 1, len(order))
+    rank[order] = np.arange(len(order))
+    if (rank[u] == len(order)).any():
+        logger.warning('Some pipes are not connected to a producer')
+    flip = rank[u] > rank[v]
+    return np.where(flip, v, u), np.where(flip, u, v)
+
+
+def _flow_graph(pipes, producer_prefix='producers'):
+    """Return node ids and directed edges (integer arrays) of the pipes.
+
+    If the column 'direction' (1 or -1) is available, it defines the
+    direction of flow. Otherwise the pipes are oriented away from the
+    producers.
+
+    :return:            [-]     node ids, start and end node of each pipe,
+                        producer nodes
+    """
+    nodes, inverse = np.unique(
+        np.concatenate([pipes['from_node'].to_numpy(dtype=str),
+                        pipes['to_node'].to_numpy(dtype=str)]),
+        return_inverse=True)
+    n = len(pipes)
+    u, v = inverse[:n], inverse[n:]
+    sources = np.flatnonzero(np.char.startswith(nodes, producer_prefix))
+    if len(sources) == 0:
+        raise ValueError('No producer node found in the invested pipes')
+
+    if 'direction' in pipes.columns:
+        flip = pipes['direction'].to_numpy() < 0
+        u, v = np.where(flip, v, u), np.where(flip, u, v)
+    else:
+        u, v = _orient_edges(u, v, sources, len(nodes))
+    return nodes, u, v, sources
+
+
+def longest_path(u, v, w, n_nodes, sources):
+    """Return the maximum accumulated weight from the sources to each node.
+
+    The edges ``u -> v`` with weights ``w`` must form an acyclic graph.
+    Nodes are processed in topological order (Kahn's algorithm), where
+    all nodes of one level are handled with vectorized numpy operations.
+
+    :param u:           [-]     start node of each edge (integer array)
+    :param v:           [-]     end node of each edge (integer array)
+    :param w:           [-]     weight of each edge (array)
+    :param n_nodes:     [-]     number of nodes
+    :param sources:     [-]     source nodes (integer array)
+    :return:            [-]     accumulated weight per node (-inf if not
+                        reachable), incoming edge on the longest path
+                        per node (-1 for sources and unreachable nodes)
+    """
+    order = np.argsort(u, kind='stable')
+    ptr = np.searchsorted(u[order], np.arange(n_nodes + 1))
+    indeg = np.bincount(v, minlength=n_nodes)
+
+    dist = np.full(n_nodes, -np.inf)
+    dist[sources] = 0
+    frontier = np.flatnonzero(indeg == 0)
+    n_done = 0
+    while frontier.size:
+        n_done += frontier.size
+        starts = ptr[frontier]
+        counts = ptr[frontier + 1] - starts
+        if counts.sum() == 0:
+            break
+        # Indices of all edges leaving the frontier
+        offsets = np.repeat(starts - np.cumsum(counts) + counts, counts)
+        edges = order[np.arange(counts.sum()) + offsets]
+
+        np.maximum.at(dist, v[edges], dist[u[edges]] + w[edges])
+        np.subtract.at(indeg, v[edges], 1)
+        targets = np.unique(v[edges])
+        frontier = targets[indeg[targets] == 0]
+
+    if n_done < n_nodes:
+        logger.warning('The flow graph contains cycles, {} nodes were not '
+                       'evaluated'.format(n_nodes - n_done))
+
+    # Incoming edge on the longest path of each node
+    pred = np.full(n_nodes, -1)
+    on_path = np.isfinite(dist[u]) & np.isclose(dist[u] + w, dist[v],
+                                                rtol=1e-12, atol=0)
+    pred[v[on_path]] = np.flatnonzero(on_path)
+    pred[sources] = -1
+    return dist, pred
+
+
+def solve_network(pipes, T_supply=80, T_return=50, k=0.01,
+                  dp_substation=1e5, p_static=2e5,
+                  producer_prefix='producers', consumer_prefix='consumers'):
+    """Calculate node pressures and pump head of an invested network.
+
+    The pipes need the columns 'from_node', 'to_node', 'length' [m], 'DN'
+    and 'capacity' [kW], as available after apply_DN(). The inner
+    diameter is DN/1000 m, as in the DN table of apply_DN(). The design
+    mass flow follows from the capacity, unless a column
+    'mass_flow [kg/s]' is given. Only pipes with a flow are considered.
+    If the column 'direction' (1 or -1) from the DHNx optimisation results
+    is available, it defines the direction of flow. Otherwise the pipes
+    are oriented away from the producers.
+
+    Supply and return line are evaluated at their own temperature. The
+    pump head is the largest round trip pressure loss to any consumer plus
+    the differential pressure ``dp_substation`` required at the consumer.
+
+    :param pipes:           [-]     pipes of the ThermalNetwork (DataFrame)
+    :param T_supply:        [°C]    supply temperature
+    :param T_return:        [°C]    return temperature
+    :param k:               [mm]    roughness of inner pipeline surface
+    :param dp_substation:   [Pa]    required differential pressure at the
+                                    consumers
+    :param p_static:        [Pa]    pressure of the return line at the
+                                    producer (pressure maintenance)
+    :param producer_prefix: [-]     prefix of producer node ids
+    :param consumer_prefix: [-]     prefix of consumer node ids
+    :return:                [-]     dict with 'nodes' and 'pipes'
+                                    DataFrames, 'pump_head' [Pa],
+                                    'critical_consumer' and
+                                    'critical_path' (list of node ids)
+    """
+    T_av = 0.5 * (T_supply + T_return)
+    if 'mass_flow [kg/s]' in pipes.columns:
+        mf = pipes['mass_flow [kg/s]'].to_numpy(dtype=float)
+    else:
+        mf = pre_calc_pmax.calc_mass_flow_P(
+            pipes['capacity'].to_numpy(dtype=float) * 1000,
+            T_av, T_supply - T_return)
+    active = np.nan_to_num(mf) > 0
+    if 'direction' in pipes.columns:
+        active &= pipes['direction'].to_numpy() != 0
+    df = pipes.loc[active, ['from_node', 'to_node', 'length', 'DN']].copy()
+    df['mass_flow [kg/s]'] = mf[active]
+    n = len(df)
+    nodes, u, v, sources = _flow_graph(pipes.loc[active], producer_prefix)
+
+    d_i = df['DN'].to_numpy(dtype=float) / 1000
+    length = df['length'].to_numpy(dtype=float)
+    dp_supply = np.zeros(n)
+    dp_return = np.zeros(n)
+    mf = df['mass_flow [kg/s]'].to_numpy()
+    for dp, T in [(dp_supply, T_supply), (dp_return, T_return)]:
+        v_flow = pre_calc_pmax.calc_v_mf(mf, d_i, T)
+        dp[:] = pre_calc_pmax.delta_p_array(v_flow, d_i, k, T, l=length)
+    df['v [m/s]'] = pre_calc_pmax.calc_v_mf(mf, d_i, T_supply)
+    df['dp_supply [Pa]'] = dp_supply
+    df['dp_return [Pa]'] = dp_return
+    df['dp [Pa/m]'] = dp_supply / length
+
+    loss, pred = longest_path(u, v, dp_supply + dp_return, len(nodes),
+                              sources)
+    loss_total = np.where(np.isfinite(loss), loss, np.nan)
+    # Split the round trip loss along the critical paths into the lines
+    loss_s = accumulate_along_tree(np.where(pred >= 0, u[pred], -1),
+                                   np.where(pred >= 0, dp_supply[pred], 0))
+    loss_r = loss_total - loss_s
+
+    is_consumer = np.char.startswith(nodes, consumer_prefix)
+    if not is_consumer.any():
+        raise ValueError('No consumer node found in the invested pipes')
+    critical = np.flatnonzero(is_consumer)[
+        np.nanargmax(loss_total[is_consumer])]
+    pump_head = loss_total[critical] + dp_substation
+
+    df_nodes = pd.DataFrame(index=pd.Index(nodes, name='node'))
+    df_nodes['dp_supply_line [Pa]'] = loss_s
+    df_nodes['dp_return_line [Pa]'] = loss_r
+    df_nodes['p_supply [Pa]'] = p_static + pump_head - loss_s
+    df_nodes['p_return [Pa]'] = p_static + loss_r
+    df_nodes['dp_available [Pa]'] = (df_nodes['p_supply [Pa]']
+                                     - df_nodes['p_return [Pa]'])
+    df_nodes.loc[np.isnan(loss_total)] = np.nan
+
+    path = [critical]
+    while pred[path[-1]] >= 0:
+        path.append(u[pred[path[-1]]])
+    critical_path = nodes[path[::-1]].tolist()
+
+    logger.info('Pump head: {:.0f} Pa, critical consumer: {}'.format(
+        pump_head, nodes[critical]))
+
+    return dict(nodes=df_nodes, pipes=df, pump_head=pump_head,
+                critical_consumer=nodes[critical],
+                critical_path=critical_path)
+
+
+def accumulate_along_tree(parent, weight):
+    """Sum up weights from each node to the root of its tree.
+
+    Uses pointer jumping, so the number of vectorized steps only grows
+    with the logarithm of the depth of the tree.
+
+    :param parent:      [-]     parent node of each node (-1 for roots)
+    :param weight:      [-]     weight of the edge from the parent
+    :return:            [-]     sum of the weights on the path to the root
+    """
+    idx = np.arange(len(parent))
+    anc = np.where(parent >= 0, parent, idx)
+    acc = np.where(parent >= 0, weight, 0.).astype(float)
+    while (anc != anc[anc]).any():
+        acc = acc + acc[anc]
+        anc = anc[anc]
+    return acc
+
+
+def downstream_matrix(u, v, n_nodes, targets):
+    """Return a sparse matrix of the pipes upstream of each target node.
+
+    Each node is reached through the single pipe ending in it (tree).
+    Element (e, j) is 1 if pipe e is on the path from the producer to
+    ``targets[j]``, so ``M @ loads`` sums up the downstream loads of each
+    pipe and ``M.T @ dp`` the pressure loss on each path.
+
+    :param u:           [-]     start node of each pipe (integer array)
+    :param v:           [-]     end node of each pipe (integer array)
+    :param n_nodes:     [-]     number of nodes
+    :param targets:     [-]     target nodes, e.g. consumers (integer array)
+    :return:            [-]     scipy.sparse.csr_matrix (pipes x targets)
+    """
+    in_edge = np.full(n_nodes, -1)
+    in_edge[v] = np.arange(len(v))
+    if len(np.unique(v)) < len(v):
+        logger.warning('The invested network is not a tree, flows are '
+                       'assigned along a spanning tree')
+
+    rows, cols = [], []
+    cur = np.asarray(targets)
+    col = np.arange(len(cur))
+    visited = 0
+    while cur.size and visited <= len(u):
+        visited += 1
+        edge = in_edge[cur]
+        has_edge = edge >= 0
+        rows.append(edge[has_edge])
+        cols.append(col[has_edge])
+        cur, col = u[edge[has_edge]], col[has_edge]
+
+    rows, cols = np.concatenate(rows), np.concatenate(cols)
+    return coo_matrix((np.ones(len(rows)), (rows, cols)),
+                      shape=(len(u), len(targets))).tocsr()
+
+
+def pumping_energy(pipes, loads, T_supply=80, T_return=50, k=0.01,
+                   dp_substation=1e5, eta_pump=0.7, chunk_size=744,
+                   producer_prefix='producers'):
+    """Calculate the hourly pump power from the load profiles of consumers.
+
+    The hourly mass flow of each pipe is the sum of the loads of all
+    consumers downstream of it (see downstream_matrix()). The pressure
+    loss of all pipes and hours is calculated with delta_p_array(), for
+    supply and return line at their own temperature. For each hour the
+    critical path is the largest round trip loss to a consumer with a
+    load, and the pump head adds ``dp_substation``. The hours are
+    processed in chunks to limit the memory use.
+
+    :param pipes:           [-]     invested pipes with the columns
+                                    'from_node', 'to_node', 'length' [m],
+                                    'DN' and 'capacity' [kW]
+    :param loads:           [kW]    hourly thermal load per consumer
+                                    (DataFrame, columns are the consumer
+                                    node ids, e.g. 'consumers-0')
+    :param T_supply:        [°C]    supply temperature
+    :param T_return:        [°C]    return temperature
+    :param k:               [mm]    roughness of inner pipeline surface
+    :param dp_substation:   [Pa]    required differential pressure at the
+                                    consumers
+    :param eta_pump:        [-]     efficiency of the pump
+    :param chunk_size:      [-]     number of hours per chunk
+    :param producer_prefix: [-]     prefix of producer node ids
+    :return:                [-]     DataFrame with the hourly total mass
+                                    flow, critical path loss, pump head,
+                                    electrical pump power and critical
+                                    consumer
+    """
+    pipes = pipes.loc[pipes['capacity'].fillna(0) > 0]
+    nodes, u, v, sources = _flow_graph(pipes, producer_prefix)
+
+    consumers = loads.columns.to_numpy(dtype=str)
+    idx = np.searchsorted(nodes, consumers)
+    idx = np.minimum(idx, len(nodes) - 1)
+    missing = nodes[idx] != consumers
+    if missing.any():
+        raise ValueError('Consumers not connected to the invested network: '
+                         '{}'.format(consumers[missing].tolist()))
+    M = downstream_matrix(u, v, len(nodes), idx)
+
+    T_av = 0.5 * (T_supply + T_return)
+    props = pre_calc_pmax.fluid_properties.get_provider('IF97::Water')
+    # Loads [kW] to mass flow [kg/s]
+    to_mass_flow = 1000 / (props.cp(T_av) * (T_supply - T_return))
+    d_i = pipes['DN'].to_numpy(dtype=float)[:, np.newaxis] / 1000
+    length = pipes['length'].to_numpy(dtype=float)[:, np.newaxis]
+    area = (0.5 * d_i)**2 * np.pi
+
+    P = loads.to_numpy(dtype=float).T  # consumers x hours
+    n_hours = P.shape[1]
+    m_total = np.zeros(n_hours)
+    dp_critical = np.zeros(n_hours)
+    critical = np.full(n_hours, -1)
+    for start in range(0, n_hours, chunk_size):
+        chunk = slice(start, min(start + chunk_size, n_hours))
+        mf = M @ (P[:, chunk] * to_mass_flow)  # pipes x hours
+        dp = np.zeros(mf.shape)
+        for T in (T_supply, T_return):
+            dp += pre_calc_pmax.delta_p_array(
+                mf / (props.density(T) * area), d_i, k, T, l=length)
+        loss = M.T @ dp  # consumers x hours
+        loss[P[:, chunk] <= 0] = -np.inf
+        critical[chunk] = np.argmax(loss, axis=0)
+        dp_critical[chunk] = np.max(loss, axis=0)
+        m_total[chunk] = P[:, chunk].sum(axis=0) * to_mass_flow
+
+    has_flow = m_total > 0
+    dp_critical[~has_flow] = 0
+    pump_head = np.where(has_flow, dp_critical + dp_substation, 0)
+    P_el = pump_head * m_total / props.density(T_return) / eta_pump
+
+    df = pd.DataFrame({'m_total [kg/s]': m_total,
+                       'dp_critical [Pa]': dp_critical,
+                       'pump_head [Pa]': pump_head,
+                       'P_pump_el [W]': P_el,
+                       'critical_consumer': np.where(
+                           has_flow, consumers[critical], None)},
+                      index=loads.index)
+    logger.info('Annual pumping energy: {:.1f} MWh (hourly values)'.format(
+        P_el.sum() / 1e6))
+    return df
@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+
+"""Offline cache and local extract loader for OpenStreetMap data.
+
+Part I of import_osm_invest_lpagg downloads the streets and buildings from
+the Overpass API on every run. The functions in this module return the
+same GeoDataFrames, but store them in a local cache directory as
+GeoParquet files. The cache key is a hash of the polygon, the tag filter
+and the network type, so a changed area or filter never hits a stale file.
+
+If a local ``.osm.pbf`` extract (e.g. from https://download.geofabrik.de)
+is given, data that is not cached yet is read from the extract instead of
+the Overpass API. This requires the optional package pyrosm
+(``pip install pyrosm``) and works without network access.
+
+Usage::
+
+    import osm_cache
+    gdf_poly_houses = osm_cache.geometries_from_polygon(
+        polygon, tags=buildings, pbf='schleswig-holstein-latest.osm.pbf')
+    graph = osm_cache.graph_from_polygon(polygon,
+                                         network_type='drive_service')
+
+"""
+import os
+import json
+import hashlib
+import logging
+import geopandas as gpd
+import osmnx as ox
+
+import layer_io
+
+# Define the logging function
+logger = logging.getLogger(__name__)
+
+# Increase to invalidate all cached files after a change of the format
+CACHE_VERSION = 1
+
+# Network types of osmnx and their equivalent in pyrosm
+PYROSM_NETWORK_TYPES = {
+    'drive': 'driving',
+    'drive_service': 'driving+service',
+    'walk': 'walking',
+    'bike': 'cycling',
+    'all': 'all',
+    }
+
+
+def cache_key(polygon, tags=None, network_type=None):
+    """Return a hash of the query parameters.
+
+    The polygon is normalized before hashing, so the same area with a
+    different start vertex or orientation gives the same key.
+    """
+    if tags is not None:
+        tags = {key: sorted(value) if isinstance(value, (list, tuple))
+                else value for key, value in tags.items()}
+    h = hashlib.sha256()
+    h.update(json.dumps([CACHE_VERSION, tags, network_type],
+                        sort_keys=True).encode())
+    h.update(polygon.normalize().wkb)
+    return h.hexdigest()[:20]
+
+
+def _open_pbf(pbf, polygon):
+    """Return a pyrosm reader for the extract, limited to the polygon."""
+    try:
+        import pyrosm
+    except ImportError:
+        raise ImportError('Reading .osm.pbf files requires pyrosm: '
+                          'pip install pyrosm')
+    logger.info('Reading OSM data from {}'.format(pbf))
+    return pyrosm.OSM(pbf, bounding_box=polygon)
+
+
+def _osmnx_index(gdf):
+    """Set the (element_type, osmid) index that osmnx uses."""
+    gdf = gdf.rename(columns={'osm_type': 'element_type', 'id': 'osmid'})
+    return gdf.set_index(['element_type', 'osmid'])
+
+
+def geometries_from_pbf(pbf, polygon, tags):
+    """Read the features with the given tags from a local .osm.pbf extract.
+
+    Returns a GeoDataFrame like ``ox.geometries_from_polygon``: features
+    intersecting the polygon, indexed by element type and OSM id, with one
+    column per tag.
+    """
+    osm = _open_pbf(pbf, polygon)
+    # osmnx accepts single strings as tag values, pyrosm only lists
+    custom_filter = {key: [value] if isinstance(value, str) else value
+                     for key, value in tags.items()}
+    gdf = osm.get_data_by_custom_criteria(
+        custom_filter=custom_filter, filter_type='keep', keep_nodes=True,
+        keep_ways=True, keep_relations=True)
+    if gdf is None:  # pyrosm returns None if nothing was found
+        gdf = gpd.GeoDataFrame(columns=['osm_type', 'id', 'geometry'],
+                               geometry='geometry', crs='EPSG:4326')
+    gdf = gdf.loc[gdf.intersects(polygon)]
+    return _osmnx_index(gdf)
+
+
+def graph_from_pbf(pbf, polygon, network_type='drive_service'):
+    """Read the street network from a local .osm.pbf extract.
+
+    Returns a networkx MultiDiGraph that can be used like the result of
+    ``ox.graph_from_polygon``.
+    """
+    osm = _open_pbf(pbf, polygon)
+    nodes, edges = osm.get_network(
+        network_type=PYROSM_NETWORK_TYPES[network_type], nodes=True)
+    return osm.to_graph(nodes, edges, graph_type='networkx')
+
+
+def geometries_from_polygon(polygon, tags, cache_dir='./osm_cache',
+                            pbf=None):
+    """Return the OSM features with the given tags within the polygon.
+
+    :param polygon:     [-]     shapely polygon in EPSG:4326
+    :param tags:        [-]     tag filter, e.g. {'building': ['house']}
+    :param cache_dir:   [-]     directory of the cache, None to disable
+    :param pbf:         [-]     optional path to a local .osm.pbf extract,
+                                which is used instead of the Overpass API
+    :return:            [-]     GeoDataFrame
+    """
+    path = None
+    if cache_dir is not None:
+        path = os.path.join(cache_dir, 'geometries_{}.parquet'.format(
+            cache_key(polygon, tags=tags)))
+        if os.path.exists(path):
+            logger.info('Loading OSM features from cache {}'.format(path))
+            return gpd.read_parquet(path)
+
+    if pbf is not None:
+        gdf = geometries_from_pbf(pbf, polygon, tags)
+    else:
+        gdf = ox.geometries_from_polygon(polygon, tags=tags)
+
+    if path is not None:
+        layer_io.write_parquet(gdf, path)
+        logger.debug('Saved OSM cache file {}'.format(path))
+    return gdf
+
+
+def graph_from_polygon(polygon, network_type='drive_service',
+                       cache_dir='./osm_cache', pbf=None):
+    """Return the street network within the polygon.
+
+    The graph is cached as two GeoParquet files of nodes and edges
+    (see ``ox.graph_to_gdfs``).
+
+    :param polygon:         [-]     shapely polygon in EPSG:4326
+    :param network_type:    [-]     osmnx network type
+    :param cache_dir:       [-]     directory of the cache, None to disable
+    :param pbf:             [-]     optional path to a local .osm.pbf
+                                    extract
+    :return:                [-]     networkx MultiDiGraph
+    """
+    paths = None
+    if cache_dir is not None:
+        key = cache_key(polygon, network_type=network_type)
+        paths = [os.path.join(cache_dir, 'graph_{}_{}.parquet'.format(
+            key, part)) for part in ('nodes', 'edges')]
+        if all(os.path.exists(path) for path in paths):
+            logger.info('Loading street network from cache {}'.format(
+                paths[1]))
+            return ox.graph_from_gdfs(*[gpd.read_parquet(path)
+                                        for path in paths])
+
+    if pbf is not None:
+        graph = graph_from_pbf(pbf, polygon, network_type=network_type)
+    else:
+        graph = ox.graph_from_polygon(polygon, network_type=network_type)
+
+    if paths is not None:
+        for gdf, path in zip(ox.graph_to_gdfs(graph), paths):
+            layer_io.write_parquet(gdf, path)
+            logger.debug('Saved OSM cache file {}'.format(path))
+    return graph
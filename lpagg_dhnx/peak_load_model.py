@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+
+"""Surrogate model of the peak thermal load of buildings for screening.
+
+Running the load profile aggregator (VDI 4655) for every building is the
+slowest part of the workflow. For screening many candidate districts, the
+peak load can be estimated from the annual demand instead:
+
+    P_th = a_heat * E_th_heat + a_DHW * E_th_DHW
+
+The coefficients [kW/kWh] (i.e. inverse full-load hours) are calibrated
+per house type and TRY region with results of the full aggregator, e.g.
+from earlier runs of run_lpagg(). The fit minimises the relative error
+of each building. Building types or TRY regions without calibration data
+fall back to the coefficients of the house type across all regions.
+
+Error bounds: for each group, the quantiles of the absolute relative
+error of the calibration data are stored with the coefficients
+('err_p50', 'err_p95' and 'err_max'). They describe how far the peak load
+of a single house may deviate from the result of the aggregator. The
+random variation of the load profiles (parameter 'sigma' in lpagg) is
+part of these errors. Sums of the peak load over many buildings are more
+accurate than these bounds, because the errors partly cancel out.
+Predictions outside of the calibrated range (e.g. other specific demands
+in the typology table) are extrapolations and not covered by the bounds.
+
+Usage::
+
+    import peak_load_model
+    model = peak_load_model.PeakLoadModel.calibrate(gdf_lpagg)
+    model.save('./lpagg_in/peak_load_model.csv')
+    model = peak_load_model.PeakLoadModel.load(
+        './lpagg_in/peak_load_model.csv')
+    gdf['P_th'] = model.predict(gdf)
+
+"""
+import logging
+import numpy as np
+import pandas as pd
+
+# Define the logging function
+logger = logging.getLogger(__name__)
+
+# Label of the fallback coefficients of a house type across all regions
+TRY_ALL = 'all'
+
+COLUMNS = ['a_heat', 'a_DHW', 'n', 'err_p50', 'err_p95', 'err_max']
+
+
+def _fit(E_heat, E_DHW, P_th):
+    """Fit the coefficients and return them with the error quantiles."""
+    A = np.column_stack([E_heat, E_DHW]) / P_th[:, np.newaxis]
+    (a_heat, a_DHW), *_ = np.linalg.lstsq(A, np.ones(len(P_th)),
+                                          rcond=None)
+    err = np.abs((a_heat * E_heat + a_DHW * E_DHW) / P_th - 1)
+    return [a_heat, a_DHW, len(P_th), *np.quantile(err, [0.5, 0.95, 1])]
+
+
+class PeakLoadModel():
+    """Estimate the peak thermal load from the annual heat demand."""
+
+    def __init__(self, coefficients):
+        """Create the model from a table of coefficients.
+
+        :param coefficients:    [-]     DataFrame with index (house_type,
+                                        TRY) and the columns COLUMNS
+        """
+        self.coefficients = coefficients
+
+    @classmethod
+    def calibrate(cls, gdf, min_samples=10):
+        """Calibrate the model with results of the load profile aggregator.
+
+        :param gdf:         [-]     buildings with the columns 'house_type',
+                                    'TRY', 'E_th_heat', 'E_th_DHW' [kWh]
+                                    and 'P_th' [kW] (result of run_lpagg())
+        :param min_samples: [-]     minimum number of buildings per group
+        :return:            [-]     PeakLoadModel
+        """
+        df = gdf.loc[gdf['P_th'] > 0, ['house_type', 'TRY', 'E_th_heat',
+                                       'E_th_DHW', 'P_th']].dropna()
+        groups = [((house_type, TRY_ALL), group) for house_type, group
+                  in df.groupby('house_type')]
+        groups += [((house_type, str(TRY)), group) for (house_type, TRY), group
+                   in df.groupby(['house_type', 'TRY'])]
+
+        rows = dict()
+        for key, group in groups:
+            if len(group) < min_samples:
+                continue
+            rows[key] = _fit(*[group[col].to_numpy(dtype=float) for col in
+                               ['E_th_heat', 'E_th_DHW', 'P_th']])
+        coefficients = pd.DataFrame.from_dict(rows, orient='index',
+                                              columns=COLUMNS)
+        coefficients.index = pd.MultiIndex.from_tuples(
+            coefficients.index, names=['house_type', 'TRY'])
+        logger.info('Calibrated peak load model:\n{}'.format(coefficients))
+        return cls(coefficients)
+
+    def save(self, path):
+        """Save the coefficients to a csv file."""
+        self.coefficients.to_csv(path)
+
+    @classmethod
+    def load(cls, path):
+        """Load coefficients saved with save()."""
+        coefficients = pd.read_csv(path, index_col=['house_type', 'TRY'],
+                                   dtype={'TRY': str})
+        return cls(coefficients)
+
+    def predict(self, gdf, return_errors=False):
+        """Estimate the peak thermal load [kW] of each building.
+
+        :param gdf:             [-]     buildings with the columns
+                                        'house_type', 'TRY', 'E_th_heat'
+                                        and 'E_th_DHW' [kWh]
+        :param return_errors:   [-]     also return the error quantiles of
+                                        the coefficients used for each
+                                        building
+        :return:                [kW]    Series of the peak load, or
+                                        (Series, DataFrame)
+        """
+        house_type = gdf['house_type'].to_numpy()
+        keys = pd.MultiIndex.from_arrays([house_type,
+                                          gdf['TRY'].astype(str)])
+        fallback = pd.MultiIndex.from_arrays(
+            [house_type, np.full(len(gdf), TRY_ALL)])
+        coef = self.coefficients.reindex(keys)
+        missing = coef['a_heat'].isna().to_numpy()
+        coef.iloc[missing] = self.coefficients.reindex(
+            fallback[missing]).to_numpy()
+        coef.index = gdf.index
+
+        if missing.any():
+            logger.debug('{} buildings use the coefficients of their house '
+                         'type across all TRY regions'.format(missing.sum()))
+        unknown = coef['a_heat'].isna() & gdf['house_type'].notna()
+        if unknown.any():
+            logger.error('Peak load model is not calibrated for house types '
+                         '{}'.format(sorted(gdf.loc[unknown, 'house_type']
+                                            .unique())))
+
+        P_th = (coef['a_heat'] * gdf['E_th_heat']
+                + coef['a_DHW'] * gdf['E_th_DHW']).rename('P_th')
+        if return_errors:
+            return P_th, coef[['err_p50', 'err_p95', 'err_max']]
+        return P_th
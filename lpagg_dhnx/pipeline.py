@@ -0,0 +1,252 @@
+# -*- coding: utf-8 -*-
+
+"""Staged, checkpointed execution of a workflow.
+
+A stage is a function that is called with keyword arguments. Its result
+is stored on disk in a pickle file, whose name contains a hash of
+
+- the name of the stage,
+- the source code of the stage function and of the code it depends on
+  (see below),
+- the content of all arguments (e.g. the results of earlier stages).
+
+When the workflow is run again, every stage whose hash did not change is
+loaded from disk instead of being executed. If an input changes, the
+stage is executed again. Later stages only run again if the result of
+the rerun actually differs, because their inputs are hashed by content.
+
+The content hash of DataFrames and GeoDataFrames uses the values of all
+columns, the index and the geometries (as WKB), so it does not depend on
+the memory layout or on the pickle protocol.
+
+Each stage is recorded with instrumentation.stage(), including the
+number of rows of its result, so instrumentation.report() lists the wall
+time, CPU time and peak memory of the stages (and of the steps recorded
+within them).
+
+The code a stage depends on is found by name: the module of the stage
+function, the modules of this repository (the directory of the stage
+function) whose names the function uses and, recursively, the modules
+these import. Functions of the main script that the stage calls are
+included as well. So a change of a helper function or of a constant like
+building_loads.BUILDING_TYPOLOGY reruns the stage. Changes of installed
+packages (e.g. DHNx or lpagg) and of data files are not detected. Use
+``force`` to rerun stages after such changes, or delete the cache
+directory.
+
+Usage::
+
+    import pipeline
+    pipe = pipeline.Pipeline('./dhnx_out/pipeline')
+    gdf = pipe.run('lpagg', run_lpagg, gdf=gdf_poly_houses)
+    pipe.report()
+
+"""
+import os
+import ast
+import pickle
+import inspect
+import hashlib
+import logging
+import numpy as np
+import pandas as pd
+import shapely
+
+import instrumentation
+
+# Define the logging function
+logger = logging.getLogger(__name__)
+
+# Increase to invalidate all cached stages after a change of the format
+CACHE_VERSION = 2
+
+
+def _update(h, obj):
+    """Update the hash object h with the content of obj."""
+    h.update(type(obj).__name__.encode())
+    if isinstance(obj, dict):
+        for key in sorted(obj, key=str):
+            _update(h, key)
+            _update(h, obj[key])
+    elif isinstance(obj, (list, tuple)):
+        h.update(str(len(obj)).encode())
+        for item in obj:
+            _update(h, item)
+    elif isinstance(obj, pd.DataFrame):
+        _update(h, list(obj.columns))
+        _update(h, obj.index)
+        for col in obj.columns:
+            _update(h, obj[col])
+    elif isinstance(obj, (pd.Series, pd.Index)):
+        h.update(str(obj.dtype).encode())
+        if str(obj.dtype) == 'geometry':
+            for wkb in shapely.to_wkb(np.asarray(obj)):
+                h.update(b'' if wkb is None else wkb)
+            return
+        try:
+            h.update(pd.util.hash_pandas_object(obj, index=False)
+                     .to_numpy().tobytes())
+        except TypeError:  # unhashable values, e.g. lists
+            h.update(pickle.dumps(list(obj)))
+    elif isinstance(obj, np.ndarray) and obj.dtype != object:
+        h.update(obj.dtype.str.encode() + str(obj.shape).encode())
+        h.update(np.ascontiguousarray(obj).tobytes())
+    elif isinstance(obj, shapely.Geometry):
+        h.update(obj.wkb)
+    elif obj is None or isinstance(obj, (str, bytes, int, float, bool)):
+        h.update(repr(obj).encode())
+    else:
+        h.update(pickle.dumps(obj))
+
+
+def content_hash(obj):
+    """Return a hash of the content of obj (hex string)."""
+    h = hashlib.sha256()
+    _update(h, obj)
+    return h.hexdigest()[:20]
+
+
+def _source(func):
+    """Return the source code of a function, or its name if unavailable."""
+    try:
+        return inspect.getsource(func)
+    except (OSError, TypeError):
+        return func.__module__ + '.' + func.__qualname__
+
+
+def _code_names(code):
+    """Return the global names used by a code object and nested code."""
+    names = set(code.co_names)
+    for const in code.co_consts:
+        if inspect.iscode(const):
+            names |= _code_names(const)
+    return names
+
+
+def _imports(path):
+    """Return the names of the modules imported by a source file."""
+    with open(path, 'rb') as f:
+        tree = ast.parse(f.read())
+    names = []
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            names += [alias.name for alias in node.names]
+        elif isinstance(node, ast.ImportFrom) and node.module:
+            names.append(node.module)
+    return names
+
+
+def _dependencies(func):
+    """Return the source code of a stage function and its dependencies.
+
+    :param func:    [-]     stage function
+    :return:        [-]     list of source code strings, the stage
+                            function first, then the source files and
+                            functions of the main script in the order
+                            they were found
+    """
+    try:
+        root = os.path.dirname(os.path.abspath(inspect.getsourcefile(func)))
+    except TypeError:  # e.g. builtins
+        return [_source(func)]
+
+    def local(module):
+        """Return the source file of a module of this repository."""
+        path = os.path.join(root, module.split('.')[0] + '.py')
+        return path if os.path.isfile(path) else None
+
+    sources, done = [], set()
+    todo = [func]
+    if local(func.__module__):  # not the main script
+        todo.append(local(func.__module__))
+    while todo:
+        item = todo.pop(0)
+        if item in done:
+            continue
+        done.add(item)
+        if isinstance(item, str):  # a source file
+            with open(item, encoding='utf-8') as f:
+                sources.append(f.read())
+            todo += [path for path in map(local, _imports(item)) if path]
+            continue
+
+        sources.append(_source(item))
+        if not hasattr(item, '__code__'):  # e.g. a class
+            continue
+        for name in sorted(_code_names(item.__code__)):
+            obj = item.__globals__.get(name)
+            if obj is None:  # e.g. imported within the function
+                module = name
+            elif inspect.ismodule(obj):
+                module = obj.__name__
+            elif inspect.isfunction(obj) or inspect.isclass(obj):
+                module = obj.__module__
+            else:
+                continue
+            if module == '__main__' and inspect.isfunction(obj):
+                todo.append(obj)
+            elif local(module):
+                todo.append(local(module))
+    return sources
+
+
+class Pipeline():
+    """Run named stages and store their results on disk."""
+
+    def __init__(self, cache_dir='./pipeline_cache', force=()):
+        """Create a pipeline.
+
+        :param cache_dir:   [-]     directory for the results of stages
+        :param force:       [-]     names of stages that are always run
+        """
+        self.cache_dir = cache_dir
+        self.force = set(force)
+        self.stages = []
+
+    def run(self, name, func, **kwargs):
+        """Return the result of a stage, from the cache if possible.
+
+        :param name:        [-]     name of the stage
+        :param func:        [-]     stage function, called with kwargs
+        :param kwargs:      [-]     arguments of the stage
+        :return:            [-]     result of func(**kwargs)
+        """
+        key = content_hash([CACHE_VERSION, name, _dependencies(func),
+                            kwargs])
+        path = os.path.join(self.cache_dir, '{}_{}.pkl'.format(name, key))
+
+        with instrumentation.stage(name) as record:
+            if name not in self.force and os.path.exists(path):
+                logger.info('Stage {}: loading result from {}'.format(
+                    name, path))
+                with open(path, 'rb') as f:
+                    result = pickle.load(f)
+                status = 'cached'
+            else:
+                logger.info('Stage {}: running'.format(name))
+                result = func(**kwargs)
+                os.makedirs(self.cache_dir, exist_ok=True)
+                tmp = path + '.tmp'
+                with open(tmp, 'wb') as f:
+                    pickle.dump(result, f,
+                                protocol=pickle.HIGHEST_PROTOCOL)
+                os.replace(tmp, path)
+                status = 'run'
+            record['rows'] = instrumentation.rows(result)
+
+        self.stages.append(dict(
+            stage=name, status=status, seconds=record['seconds'],
+            cpu_seconds=record['cpu_seconds'],
+            rss_peak_mb=record['rss_peak_mb'], key=key))
+        logger.info('Stage {}: {} in {:.1f} s'.format(
+            name, status, record['seconds']))
+        return result
+
+    def report(self):
+        """Log and return the status, time and memory of all stages."""
+        df = pd.DataFrame(self.stages,
+                          columns=['stage', 'status', 'seconds',
+                                   'cpu_seconds', 'rss_peak_mb', 'key'])
+        logger.info('Pipeline stages:\n{}'.format(df.to_string(index=False)))
+        logger.info('Total time: {:.1f} s'.format(df['seconds'].sum()))
+        return df
@@ -1,15 +1,25 @@
-from CoolProp.CoolProp import PropsSI
+import os
+import hashlib
 import numpy as np
 from scipy.optimize import fsolve
 import math
 import pandas as pd
 import logging
+import CoolProp
+
+import fluid_properties
 
 # Define the logging function
 logger = logging.getLogger(__name__)
 
 # CoolProp
 # http://www.coolprop.org/coolprop/wrappers/Python/index.html
+# The properties are not taken from CoolProp.PropsSI directly, but from a
+# precomputed table, see fluid_properties.py
+
+# Version of the calculation, part of the key of cached DN tables. Increase
+# it whenever a change in this module changes the results.
+CACHE_VERSION = 1
 
 # Berechnung Druckverlust siehe:
 #   - http://www.math-tech.at/Beispiele/upload/gra_Druckverlust_in_Rohrleitungen.PDF
@@ -45,10 +55,11 @@ def delta_p(v, d_i, k=0.1, T_medium=90, l=1,
 
     k = k * 0.001
 
+    props = fluid_properties.get_provider(fluid)
     # get density of water [kg/m^3]
-    d = PropsSI('D', 'T', T_medium + 273.15, 'P', pressure*101325, fluid)
+    d = props.density(T_medium, pressure)
     # dynamic viscosity eta [kg/(m*s)]
-    d_v = PropsSI('V', 'T', T_medium + 273.15, 'P', pressure*101325, fluid)
+    d_v = props.viscosity(T_medium, pressure)
     k_v = d_v/d     # kinematic viskosity [m^2/s]
 
     # Reynodszahl
@@ -103,6 +114,185 @@ def delta_p(v, d_i, k=0.1, T_medium=90, l=1,
     return d_p
 
 
+# Flow regimes as used by delta_p(), encoded for the vectorized engine
+REGIME_LAMINAR = 0
+REGIME_PRANDTL = 1      # hydraulisch glatt, Re < 10^5
+REGIME_NIKURADSE = 2    # hydraulisch glatt, 10^5 <= Re < 10^6
+REGIME_KARMAN = 3       # hydraulisch glatt, Re >= 10^6 (implizit)
+REGIME_ROUGH = 4        # hydraulisch rau
+REGIME_TRANSITION = 5   # Übergangsbereich glatt-rau (implizit)
+
+
+def flow_regime(R_e, k, d_i):
+    """Classify each point into the flow regimes used by delta_p().
+
+    :param R_e:         [-]     Reynolds number (array)
+    :param k:           [m]     roughness of inner pipeline surface (array)
+    :param d_i:         [m]     inner diameter (array)
+    :return:            [-]     regime codes REGIME_* (integer array)
+    """
+    R_e, k, d_i = np.broadcast_arrays(R_e, k, d_i)
+    rel_rough = R_e * k / d_i
+
+    regime = np.full(R_e.shape, REGIME_TRANSITION, dtype=np.int8)
+    regime[rel_rough > 1300] = REGIME_ROUGH
+    smooth = rel_rough < 65
+    regime[smooth & (R_e < 10**5)] = REGIME_PRANDTL
+    regime[smooth & (R_e >= 10**5) & (R_e < 10**6)] = REGIME_NIKURADSE
+    regime[smooth & (R_e >= 10**6)] = REGIME_KARMAN
+    regime[R_e < 2320] = REGIME_LAMINAR
+    return regime
+
+
+def _newton_friction(R_e, k_d, smooth, x0, tol=1e-12, max_iter=50):
+    """Solve the implicit friction laws for x = 1/sqrt(lambda) in a batch.
+
+    Both equations are solved with the same Newton iteration. With
+    ``a = 2.51/R_e`` and ``b = k/(3.71*d_i)`` (``b = 0`` for the smooth
+    law of Prandtl and v. Karman) the residual is
+    ``f(x) = x + 2*log10(a*x + b)``, which is strictly increasing and
+    concave in x. Newton therefore approaches the root monotonically from
+    below after the first step; an overshoot to the left is limited to
+    halving x, which keeps the logarithm defined.
+
+    :param R_e:         [-]     Reynolds number (array)
+    :param k_d:         [-]     relative roughness k/d_i (array)
+    :param smooth:      [-]     True where the smooth law applies (array)
+    :param x0:          [-]     start values (array)
+    :param tol:         [-]     relative tolerance for x
+    :param max_iter:    [-]     maximum number of iterations
+    :return:            [-]     x = 1/sqrt(lambda), number of iterations
+    """
+    a = 2.51 / R_e
+    b = np.where(smooth, 0., k_d / 3.71)
+    x = np.array(x0, dtype=float)
+    active = np.ones(x.shape, dtype=bool)
+    n = 0
+    while n < max_iter and active.any():
+        n += 1
+        xa, aa, ba = x[active], a[active], b[active]
+        arg = aa * xa + ba
+        f = xa + 2 * np.log10(arg)
+        df = 1 + 2 / np.log(10) * aa / arg
+        step = f / df
+        step = np.minimum(step, 0.5 * xa)
+        x[active] = xa - step
+        active[active] = np.abs(step) > tol * np.abs(xa)
+
+    if active.any():
+        logger.warning('Friction factor did not converge for {} points'
+                       .format(active.sum()))
+    return x, n
+
+
+def friction_factor(R_e, k, d_i, return_slope=False):
+    """Calculate the Darcy friction factor lambda for arrays of points.
+
+    The regimes and correlations are the same as in delta_p(), but the
+    implicit equations are solved with a batched Newton iteration instead
+    of scipy.optimize.fsolve.
+
+    With ``return_slope=True`` the analytic derivative
+    ``d ln(lambda) / d ln(R_e)`` is returned as well. For the implicit laws
+    it follows from differentiating ``x + 2*log10(2.51*x/R_e + b) = 0``.
+
+    :param R_e:         [-]     Reynolds number (array)
+    :param k:           [m]     roughness of inner pipeline surface (array)
+    :param d_i:         [m]     inner diameter (array)
+    :param return_slope: [-]    also return the logarithmic derivative
+    :return:            [-]     friction factor lambda (array)
+    """
+    R_e, k, d_i = np.broadcast_arrays(np.asarray(R_e, float),
+                                      np.asarray(k, float),
+                                      np.asarray(d_i, float))
+    regime = flow_regime(R_e, k, d_i)
+    lam = np.empty(R_e.shape)
+    slope = np.zeros(R_e.shape)
+
+    m = regime == REGIME_LAMINAR
+    # S. 216 - (11.9), ISBN  978-3-540-73726-1
+    with np.errstate(divide='ignore'):
+        lam[m] = 64 / R_e[m]
+    slope[m] = -1
+
+    m = regime == REGIME_PRANDTL
+    lam[m] = 0.3164 * R_e[m] ** (-0.25)
+    slope[m] = -0.25
+
+    m = regime == REGIME_NIKURADSE
+    lam[m] = 0.0032 + 0.221 * R_e[m] ** (-0.237)
+    slope[m] = -0.237 * 0.221 * R_e[m] ** (-0.237) / lam[m]
+
+    m = regime == REGIME_ROUGH
+    lam[m] = (1 / (-2 * np.log10(k[m] / (3.71 * d_i[m])))) ** 2
+    slope[m] = 0
+
+    m = (regime == REGIME_KARMAN) | (regime == REGIME_TRANSITION)
+    if m.any():
+        smooth = regime[m] == REGIME_KARMAN
+        # Näherungswerte als Startwerte, wie in delta_p()
+        lam_init = np.where(smooth, 0.3164 / R_e[m] ** 0.25,
+                            0.25 / R_e[m] ** 0.2)
+        x, n = _newton_friction(R_e[m], k[m] / d_i[m], smooth,
+                                x0=1 / np.sqrt(lam_init))
+        logger.debug('Newton iterations for friction factor: {}'.format(n))
+        lam[m] = 1 / x ** 2
+
+        # Implicit differentiation of f(x, R_e) = 0 with a = 2.51/R_e
+        a = 2.51 / R_e[m]
+        b = np.where(smooth, 0., k[m] / d_i[m] / 3.71)
+        c = 2 / np.log(10) * a / (a * x + b)
+        slope[m] = -2 * c / (1 + c)
+
+    if return_slope:
+        return lam, slope
+    return lam
+
+
+def delta_p_array(v, d_i, k=0.1, T_medium=90, l=1,
+                  pressure=1, fluid='IF97::Water'):
+    """Vectorized version of delta_p() for arrays of input values.
+
+    All numeric arguments are broadcast against each other, so e.g. an
+    array of velocities can be combined with a single diameter. The
+    regimes are selected with masks and the implicit friction laws are
+    solved with a batched Newton iteration (see friction_factor()).
+    The results match delta_p() within a relative deviation of 1e-6,
+    which is the accuracy of the fsolve calls used there.
+
+    :param v:           [m/s]   flow velocity
+    :param d_i:         [m]     inner diameter
+    :param k:           [mm]    roughness of inner pipeline surface
+    :param T_medium:    [°C]    temperature of the medium
+    :param l:           [m]     length of pipeline
+    :param pressure:    [bar]   pressure level
+    :param fluid:       [-]     type of fluid, default: 'IF97::Water'
+    :return:            [Pa]    pressure drop (float for scalar input)
+    """
+    # Fluid properties are only evaluated for the given (not broadcast) shape
+    props = fluid_properties.get_provider(fluid)
+    d = props.density(T_medium, pressure)
+    d_v = props.viscosity(T_medium, pressure)
+
+    v, d_i, k, l, d, d_v = np.broadcast_arrays(
+        *[np.asarray(x, float) for x in (v, d_i, k, l, d, d_v)])
+
+    k = k * 0.001
+
+    k_v = d_v/d     # kinematic viskosity [m^2/s]
+
+    # Reynodszahl
+    R_e = (v * d_i) / k_v
+
+    lam = friction_factor(R_e, k, d_i)
+    with np.errstate(invalid='ignore'):
+        d_p = np.where(v == 0, 0., lam * l / d_i * d / 2 * v**2)
+
+    if d_p.ndim == 0:
+        return float(d_p)
+    return d_p
+
+
 def calc_v(vol_flow, d_i):
     """
 
@@ -198,12 +388,8 @@ def v_max_bisection(d_i, T_average, k=0.1, p_max=100,
     while n < 200:
         n += 1
 
-        p_0 = delta_p(v_0, k=k, d_i=d_i, T_medium=T_average,
-                      pressure=pressure, fluid=fluid)
-
-        p_1 = delta_p(v_1, k=k, d_i=d_i, T_medium=T_average,
-                      pressure=pressure, fluid=fluid)
-
+        # Only one endpoint moves per iteration, so p_0 and p_1 are
+        # updated from p_new below instead of being recomputed here
         v_new = 0.5 * (v_1 + v_0)
 
         p_new = delta_p(v_new, k=k, d_i=d_i, T_medium=T_average,
@@ -224,9 +410,9 @@ def v_max_bisection(d_i, T_average, k=0.1, p_max=100,
 
         else:
             if (p_0 - p_max)*(p_new-p_max) < 0:
-                v_1 = v_new
+                v_1, p_1 = v_new, p_new
             else:
-                v_0 = v_new
+                v_0, p_0 = v_new, p_new
 
     logger.debug('Number of Iterations: {}'.format(n))
     logger.debug('Resulting pressure drop: {}'.format(p_new))
@@ -235,6 +421,123 @@ def v_max_bisection(d_i, T_average, k=0.1, p_max=100,
     return v_new
 
 
+def _pressure_gradient(v, d_i, k, rho, k_v):
+    """Return pressure drop per meter and its derivative for arrays.
+
+    Works on already converted inputs, so that fluid properties only have
+    to be looked up once per row by the calling solver.
+
+    :param v:           [m/s]       flow velocity
+    :param d_i:         [m]         inner diameter
+    :param k:           [m]         roughness of inner pipeline surface
+    :param rho:         [kg/m^3]    density
+    :param k_v:         [m^2/s]     kinematic viscosity
+    :return:            [Pa/m], [Pa*s/m^2]  pressure drop, d(dp)/dv
+    """
+    R_e = (v * d_i) / k_v
+    lam, slope = friction_factor(R_e, k, d_i, return_slope=True)
+    d_p = lam / d_i * rho / 2 * v**2
+    return d_p, d_p / v * (2 + slope)
+
+
+def v_max_array(d_i, T_average, k=0.1, p_max=100,
+                p_epsilon=0.1, v_epsilon=0.001,
+                v_0=0.01, v_1=10, max_iter=100,
+                pressure=1, fluid='IF97::Water'):
+    """Calculate the maximum flow velocity for many pipes at once.
+
+    Solves ``delta_p(v) = p_max`` for every element of the (broadcast)
+    inputs with a safeguarded Newton iteration. The Newton step is taken
+    in log(v) with the analytic derivative of the friction law, where the
+    pressure drop is close to a power law. Each row keeps its own bracket
+    [v_0, v_1]; only the endpoint on the side of the new point is updated.
+    If the Newton step leaves the bracket, the row falls back to
+    bisection, which also handles the jumps of the pressure drop at the
+    regime boundaries. Converged rows are removed from the iteration.
+
+    The convergence criteria are the same as in v_max_bisection().
+
+    :param d_i:         [m]     inner diameter
+    :param T_average:   [°C]    average temperature
+    :param k:           [mm]    roughness of inner pipeline surface
+    :param p_max:       [Pa/m]  maximum pressure drop in pipeline
+    :param p_epsilon:   [Pa/m]  accuracy
+    :param v_epsilon:   [m/s]   minimum bracket width
+    :param v_0:         [m/s]   lower bound for the flow velocity
+    :param v_1:         [m/s]   upper bound for the flow velocity
+    :param max_iter:    [-]     maximum number of iterations
+    :param pressure:    [bar]   pressure level
+    :param fluid:       [-]     type of fluid, default: 'IF97::Water'
+    :return:            [m/s], [-], [-]  maximum flow velocity (NaN for an
+                        invalid bracket), convergence flag and number of
+                        iterations per row
+    """
+    props = fluid_properties.get_provider(fluid)
+    rho = props.density(T_average, pressure)
+    k_v = props.viscosity(T_average, pressure) / rho
+
+    d_i, k, p_max, rho, k_v, lo, hi = [
+        np.array(x, dtype=float) for x in np.broadcast_arrays(
+            d_i, np.asarray(k, float) * 0.001, p_max, rho, k_v, v_0, v_1)]
+    shape = d_i.shape
+    d_i, k, p_max, rho, k_v, lo, hi = [
+        x.ravel() for x in (d_i, k, p_max, rho, k_v, lo, hi)]
+
+    f_lo = _pressure_gradient(lo, d_i, k, rho, k_v)[0] - p_max
+    f_hi = _pressure_gradient(hi, d_i, k, rho, k_v)[0] - p_max
+
+    v = np.full(d_i.shape, np.nan)
+    n_iter = np.zeros(d_i.shape, dtype=int)
+    converged = np.zeros(d_i.shape, dtype=bool)
+    active = f_lo * f_hi < 0
+    if not active.all():
+        logger.error('The initial guesses are not assumed right for {} rows!'
+                     .format((~active).sum()))
+
+    # Start in the geometric centre of the bracket
+    v[active] = np.sqrt(lo[active] * hi[active])
+    n = 0
+    while n < max_iter and active.any():
+        n += 1
+        idx = np.flatnonzero(active)
+        n_iter[idx] = n
+        va = v[idx]
+        d_p, dd_p = _pressure_gradient(va, d_i[idx], k[idx], rho[idx],
+                                       k_v[idx])
+        f = d_p - p_max[idx]
+
+        done = np.abs(f) < p_epsilon
+        converged[idx[done]] = True
+
+        # Shrink the bracket on the side of the new point
+        below = (f < 0) == (f_lo[idx] < 0)
+        lo[idx[below]], f_lo[idx[below]] = va[below], f[below]
+        hi[idx[~below]], f_hi[idx[~below]] = va[~below], f[~below]
+
+        width = np.abs(hi[idx] - lo[idx]) < v_epsilon
+        converged[idx[width]] = True
+
+        # Newton step in log(v), bisection if it leaves the bracket
+        with np.errstate(divide='ignore', invalid='ignore'):
+            v_new = va * np.exp(-np.log(d_p / p_max[idx]) * d_p / (va*dd_p))
+        bad = ~((v_new > np.minimum(lo[idx], hi[idx]))
+                & (v_new < np.maximum(lo[idx], hi[idx])))
+        v_new[bad] = 0.5 * (lo[idx[bad]] + hi[idx[bad]])
+
+        keep = ~(done | width)
+        v[idx[keep]] = v_new[keep]
+        active[idx[~keep]] = False
+
+    if active.any():
+        logger.warning('Maximum velocity did not converge for {} rows'
+                       .format(active.sum()))
+
+    logger.debug('Number of Iterations: {}'.format(n))
+
+    return (v.reshape(shape), converged.reshape(shape),
+            n_iter.reshape(shape))
+
+
 def calc_power(T_vl=80, T_rl=50, mf=3):
     """
 
@@ -245,7 +548,7 @@ def calc_power(T_vl=80, T_rl=50, mf=3):
     """
 
     T_av = (T_vl + T_rl)*0.5
-    cp = PropsSI('C', 'T', T_av + 273.15, 'P', 101325, 'IF97::Water')
+    cp = fluid_properties.get_provider('IF97::Water').cp(T_av)
 
     return mf * cp * (T_vl - T_rl)     # [W]
 
@@ -259,7 +562,8 @@ def calc_mass_flow(v, di, T_av):
     :return: mass flow [kg/s]
     """
 
-    rho = PropsSI('D', 'T', T_av + 273.15, 'P', 101325, 'IF97::Water')  # [kg/m^3]
+    # [kg/m^3]
+    rho = fluid_properties.get_provider('IF97::Water').density(T_av)
 
     return rho * v * (0.5*di)**2 * math.pi      # [kg/s]
 
@@ -273,7 +577,7 @@ def calc_mass_flow_P(P, T_av, delta_T):
     :return: mass flow [kg/s]
     """
 
-    cp = PropsSI('C', 'T', T_av + 273.15, 'P', 101325, 'IF97::Water')
+    cp = fluid_properties.get_provider('IF97::Water').cp(T_av)
 
     return P / (cp*delta_T)
 
@@ -287,31 +591,88 @@ def calc_v_mf(mf, di, T_av):
     :return:
     """
 
-    rho = PropsSI(
-        'D', 'T', T_av + 273.15, 'P', 101325, 'IF97::Water')  # [kg/m^3]
+    rho = fluid_properties.get_provider(
+        'IF97::Water').density(T_av)  # [kg/m^3]
 
     return mf / (rho*(0.5*di)**2 * math.pi)
 
 
 def calc_dataframe_german(df):
-    """Calculate columns in a DataFrame prepared with german column names."""
-    df['v_max [m/s]'] = df.apply(lambda row: v_max_bisection(
-        d_i=row['Innendurchmesser [m]'],
-        T_average=row['Temperaturniveau [°C]'],
-        k=row['Rauhigkeit [mm]'],
-        p_max=row['Max delta p [Pa/m]']), axis=1)
-
-    df['Massenstrom [kg/s]'] = df.apply(lambda row: calc_mass_flow(
-        v=row['v_max [m/s]'], di=row['Innendurchmesser [m]'],
-        T_av=row['Temperaturniveau [°C]'],
-        ), axis=1)
-
-    df['P_max [kW]'] = df.apply(lambda row: 0.001*calc_power(
-        T_vl=row['T_Vorlauf [°C]'],
-        T_rl=row['T_Rücklauf [°C]'],
-        mf=row['Massenstrom [kg/s]']
-        ), axis=1)
+    """Calculate columns in a DataFrame prepared with german column names.
+
+    All rows are solved at once with v_max_array().
+    """
+    v_max, converged, _ = v_max_array(
+        d_i=df['Innendurchmesser [m]'].to_numpy(),
+        T_average=df['Temperaturniveau [°C]'].to_numpy(),
+        k=df['Rauhigkeit [mm]'].to_numpy(),
+        p_max=df['Max delta p [Pa/m]'].to_numpy())
+    if not converged.all():
+        logger.error('No maximum velocity found for rows {}'.format(
+            df.index[~converged].tolist()))
+    df['v_max [m/s]'] = v_max
+
+    df['Massenstrom [kg/s]'] = calc_mass_flow(
+        v=df['v_max [m/s]'], di=df['Innendurchmesser [m]'],
+        T_av=df['Temperaturniveau [°C]'])
+
+    df['P_max [kW]'] = 0.001*calc_power(
+        T_vl=df['T_Vorlauf [°C]'],
+        T_rl=df['T_Rücklauf [°C]'],
+        mf=df['Massenstrom [kg/s]'])
+
+    return df
+
+
+def cache_path_german(df, cache_dir='./cache'):
+    """Return the cache file for a DataFrame with german column names.
+
+    The file name contains a hash of the column names, dtypes, index and
+    values of all input columns, the CACHE_VERSION and the CoolProp
+    version. Any change in the input thus leads to a new file.
+
+    :param df:          [-]     DataFrame prepared with german column names
+    :param cache_dir:   [-]     directory of the cache files
+    :return:            [-]     path to the cache file
+    """
+    sha = hashlib.sha256()
+    sha.update(repr((CACHE_VERSION, CoolProp.__version__)).encode())
+    sha.update(repr([(c, str(df[c].dtype)) for c in df.columns]).encode())
+    sha.update(pd.util.hash_pandas_object(df, index=True).to_numpy()
+               .tobytes())
+    return os.path.join(cache_dir, 'DN_table_{}.pkl'.format(
+        sha.hexdigest()[:20]))
+
+
+def calc_dataframe_german_cached(df, cache_dir='./cache'):
+    """Run calc_dataframe_german() with a persistent cache on disk.
+
+    Results are stored as pickle files in ``cache_dir``, keyed by a hash
+    of the input (see cache_path_german()). The file is written to a
+    temporary name first and then moved into place, so the cache can be
+    shared by parallel runs and processes.
+
+    :param df:          [-]     DataFrame prepared with german column names
+    :param cache_dir:   [-]     directory of the cache files
+    :return:            [-]     DataFrame with the calculated columns
+    """
+    path = cache_path_german(df, cache_dir)
+    if os.path.exists(path):
+        try:
+            df_cached = pd.read_pickle(path)
+            logger.debug('Loaded DN table from cache {}'.format(path))
+            return df_cached
+        except Exception as e:
+            logger.warning('Ignoring unreadable cache file {}: {}'
+                           .format(path, e))
+
+    df = calc_dataframe_german(df)
 
+    os.makedirs(cache_dir, exist_ok=True)
+    path_tmp = '{}.{}.tmp'.format(path, os.getpid())
+    df.to_pickle(path_tmp)
+    os.replace(path_tmp, path)
+    logger.debug('Saved DN table to cache {}'.format(path))
     return df
 
 
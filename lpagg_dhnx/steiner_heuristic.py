@@ -0,0 +1,394 @@
+# -*- coding: utf-8 -*-
+
+"""Heuristic supply tree for the investment optimisation of DHNx.
+
+With fixed costs per meter of pipe, the cheapest network is a tree that
+connects the producers to all consumers along the streets: a Steiner tree
+in the graph of the pipes. supply_tree() approximates it:
+
+1. The edges are weighted with the costs of the cheapest pipe type at its
+   minimum capacity. Candidate trees are the Steiner tree approximation
+   of networkx and the tree of the shortest paths from the producers.
+2. Each tree is sized from the consumers towards the producers: every
+   pipe carries the demand behind it plus the heat losses of the pipes
+   behind it. The cheapest pipe type that can carry this flow is chosen.
+3. The edges are weighted again with the costs at the sized capacities
+   and a new Steiner tree is searched, as long as the costs decrease.
+4. Local search (key path exchange): each path of the tree between
+   consumers and forks is removed and the two parts are connected again
+   by the shortest path between them, if the tree becomes cheaper.
+
+The sized tree is a feasible solution of the optimisation model, so its
+costs are an upper bound of the optimum. The heat demand of the consumers
+is 'P_heat_max' times the simultaneity, as in the optimisation with
+heat_demand='scalar'. Existing pipes are free to use, their capacity and
+heat losses are not checked.
+
+The result has the same columns as the pipe results of DHNx, so it can
+be used in two ways:
+
+- Fast mode: use the tree as result, without running a solver.
+- Warm start: set_start() sets the tree as MIP start of the model (e.g.
+  for cbc and gurobi through pyomo), so the solver begins with a good
+  feasible solution. optimize_investment() does this and logs the gap
+  between the heuristic and the optimum, e.g. with heuristic='start' in
+  network_design.optimize_network().
+
+Usage::
+
+    import steiner_heuristic
+    tree = steiner_heuristic.supply_tree(tn_input, invest_opt)
+    tree['objective']  # upper bound of the optimum
+    steiner_heuristic.optimize_investment(network, invest_opt, start=tree)
+
+"""
+import heapq
+import logging
+from collections import defaultdict
+import numpy as np
+import pandas as pd
+import networkx as nx
+from networkx.algorithms.approximation import steiner_tree
+
+# Define the logging function
+logger = logging.getLogger(__name__)
+
+# Name of the virtual node that connects all producers
+ROOT = 'root'
+
+
+def _pipe_types(invest_options):
+    """Return the active pipe types as list of dicts."""
+    df = invest_options['network']['pipes']
+    if 'active' in df:
+        df = df.loc[df['active'] == 1]
+    return df[['label_3', 'nonconvex', 'l_factor', 'l_factor_fix', 'cap_max',
+               'cap_min', 'capex_pipes', 'fix_costs']].to_dict('records')
+
+
+def _size(flow, length, types):
+    """Return the cheapest pipe type for a flow [kW] through a pipe.
+
+    :return:    [-]     tuple of the pipe type, capacity [kW], costs and
+                        heat losses [kW]
+    """
+    # Plain Python: called for every pipe of every candidate tree
+    best, best_costs = None, np.inf
+    for pipe_type in types:
+        capacity = max(flow, pipe_type['cap_min'])
+        costs = length * (pipe_type['capex_pipes'] * capacity
+                          + pipe_type['fix_costs'] * pipe_type['nonconvex'])
+        if capacity <= pipe_type['cap_max'] and costs < best_costs:
+            best, best_costs, best_capacity = pipe_type, costs, capacity
+    if best is None:
+        raise ValueError('No pipe type can carry {:.0f} kW'.format(flow))
+    losses = length * (best['l_factor'] * best_capacity
+                       + best['l_factor_fix'])
+    return best, best_capacity, best_costs, losses
+
+
+def _prune(tree, terminals):
+    """Remove branches of the tree without terminals."""
+    leaves = [n for n in tree if tree.degree(n) == 1 and n not in terminals]
+    while leaves:
+        node = leaves.pop()
+        neighbours = list(tree[node])
+        tree.remove_node(node)
+        leaves += [n for n in neighbours
+                   if tree.degree(n) == 1 and n not in terminals]
+    return tree
+
+
+def _sized(graph, tree, demand, types):
+    """Size the pipes of a tree and return a dict with their results."""
+    need = defaultdict(float, demand)
+    pipes = dict()
+    for parent, child in reversed(list(nx.bfs_edges(tree, ROOT))):
+        edge = graph.edges[parent, child]
+        if edge['pid'] is None:  # connection of the virtual root
+            continue
+        if edge['existing']:
+            need[parent] += need[child]
+            continue
+        pipe_type, capacity, costs, losses = _size(
+            need[child], edge['length'], types)
+        pipes[edge['pid']] = dict(
+            hp_type=pipe_type['label_3'], capacity=capacity,
+            direction=1 if edge['from_node'] == parent else -1,
+            costs=costs, losses=losses)
+        need[parent] += need[child] + losses
+    return pipes
+
+
+def _key_paths(tree, terminals):
+    """Return the paths between terminals and forks of the tree."""
+    key = {n for n in tree if tree.degree(n) != 2 or n in terminals}
+    paths = []
+    for start in key:
+        for node in tree[start]:
+            path = [start, node]
+            while path[-1] not in key:
+                path.append(next(n for n in tree[path[-1]] if n != path[-2]))
+            if str(start) < str(path[-1]):  # each path once
+                paths.append(path)
+    return paths
+
+
+def _connect(graph, sources, targets):
+    """Return the shortest path from any source node to any target node."""
+    dist = dict.fromkeys(sources, 0)
+    previous = dict()
+    heap = [(0, i, node) for i, node in enumerate(sources)]
+    heapq.heapify(heap)
+    count = len(heap)
+    while heap:
+        d, _, node = heapq.heappop(heap)
+        if node in targets:
+            path = [node]
+            while path[-1] in previous:
+                path.append(previous[path[-1]])
+            return path[::-1]
+        if d > dist[node]:
+            continue
+        for other, edge in graph[node].items():
+            # The cost of a pipe for a given flow is proportional to its length
+            d_other = d + (0 if edge['pid'] is None or edge['existing']
+                           else edge['length'])
+            if d_other < dist.get(other, np.inf):
+                dist[other], previous[other] = d_other, node
+                heapq.heappush(heap, (d_other, count, other))
+                count += 1
+    return None
+
+
+def _path_costs(graph, path, flow, types):
+    """Return the costs of the pipes along a path for a given flow."""
+    costs = 0
+    for u, v in zip(path, path[1:]):
+        edge = graph.edges[u, v]
+        if edge['pid'] is not None and not edge['existing']:
+            costs += _size(flow, edge['length'], types)[2]
+    return costs
+
+
+def _exchange(graph, tree, terminals, demand, types):
+    """Replace paths of the tree by cheaper connections (local search).
+
+    Each path between terminals and forks of the tree is removed and the
+    two remaining parts are connected again by the shortest path between
+    them. If the new path is cheaper than the old one at the same flow,
+    the tree is sized again and kept if its costs are lower.
+    """
+    result = _sized(graph, tree, demand, types)
+    costs = sum(pipe['costs'] for pipe in result.values())
+    improved = True
+    while improved:
+        improved = False
+        for path in _key_paths(tree, terminals):
+            if not (all(tree.has_edge(u, v) for u, v in zip(path, path[1:]))
+                    and all(tree.degree(n) == 2 for n in path[1:-1])):
+                continue  # changed by a previous exchange
+            edges = list(zip(path, path[1:]))
+            tree.remove_edges_from(edges)
+            part = nx.node_connected_component(tree, path[0])
+            tree.add_edges_from(edges)
+            other = set(tree).difference(part, path[1:-1])
+            if len(part) > len(other):
+                part, other = other, part
+            # Search from the smaller part; the graph is undirected
+            new_path = _connect(graph, list(part), other)
+            if set(new_path) == set(path):
+                continue
+            flow = max([result[graph.edges[e]['pid']]['capacity']
+                        for e in edges if graph.edges[e]['pid'] in result],
+                       default=0)
+            if (_path_costs(graph, new_path, flow, types)
+                    > _path_costs(graph, path, flow, types) + 1e-6):
+                continue  # equal costs: the flows upstream may decide
+
+            candidate = tree.copy()
+            candidate.remove_edges_from(edges)
+            candidate.remove_nodes_from(path[1:-1])
+            nx.add_path(candidate, new_path)
+            _prune(candidate, terminals)
+            candidate_result = _sized(graph, candidate, demand, types)
+            candidate_costs = sum(pipe['costs'] for pipe
+                                  in candidate_result.values())
+            if candidate_costs < costs - 1e-6:
+                tree, result = candidate, candidate_result
+                costs, improved = candidate_costs, True
+    return tree
+
+
+def supply_tree(tn_input, invest_options, simultaneity=1, max_iter=5,
+                exchange=True):
+    """Find and size a supply tree from the producers to all consumers.
+
+    :param tn_input:        [-]     dict with 'consumers', 'producers' and
+                                    'pipes' (result of process_geometry());
+                                    the consumers need 'P_heat_max' [kW]
+    :param invest_options:  [-]     invest options of DHNx (e.g. from
+                                    dhnx.input_output.load_invest_options)
+    :param simultaneity:    [-]     simultaneity factor of the optimisation
+    :param max_iter:        [-]     maximum number of reweighted searches
+    :param exchange:        [-]     improve the tree by a local search
+    :return:                [-]     dict with the results of the pipes
+                                    ('pipes', like the pipe results of DHNx)
+                                    and their total costs ('objective')
+    """
+    types = _pipe_types(invest_options)
+    pipes = tn_input['pipes']
+    existing = (pipes['existing'].fillna(0).astype(bool) if 'existing'
+                in pipes else pd.Series(False, index=pipes.index))
+    weight_min = min(t['fix_costs'] * t['nonconvex']
+                     + t['capex_pipes'] * t['cap_min'] for t in types)
+
+    graph = nx.Graph()
+    for pid, u, v, length, exist in zip(pipes.index, pipes['from_node'],
+                                        pipes['to_node'], pipes['length'],
+                                        existing):
+        if graph.has_edge(u, v) and graph.edges[u, v]['length'] <= length:
+            continue  # keep the shorter of parallel pipes
+        graph.add_edge(u, v, pid=pid, from_node=u, length=length,
+                       existing=exist, weight=0 if exist else
+                       length * weight_min)
+    for i in tn_input['producers'].index:
+        graph.add_edge(ROOT, 'producers-{}'.format(i), pid=None, weight=0)
+
+    consumers = tn_input['consumers']
+    demand = (consumers['P_heat_max'] * simultaneity).loc[
+        consumers['P_heat_max'] > 0]
+    demand.index = 'consumers-' + demand.index.astype(str)
+    demand = demand.to_dict()
+    terminals = [ROOT] + list(demand)
+    missing = [n for n in terminals if n not in graph
+               or not nx.has_path(graph, ROOT, n)]
+    if missing:
+        raise ValueError('Consumers without connection to a producer: '
+                         '{}'.format(missing))
+    graph = graph.subgraph(nx.node_connected_component(graph, ROOT)).copy()
+
+    # Candidates: Steiner tree and tree of the shortest paths
+    paths = nx.single_source_dijkstra_path(graph, ROOT)
+    shortest = nx.Graph()
+    for node in terminals[1:]:
+        nx.add_path(shortest, paths[node])
+    candidates = [steiner_tree(graph, terminals), shortest]
+
+    best, best_costs = None, np.inf
+    for n_iter in range(max_iter):
+        improved = False
+        for tree in candidates:
+            tree = _prune(nx.Graph(tree), terminals)
+            result = _sized(graph, tree, demand, types)
+            costs = sum(pipe['costs'] for pipe in result.values())
+            if costs < best_costs - 1e-9:
+                best_tree, best_costs, improved = tree, costs, True
+        if not improved:
+            break
+        # Weight the edges with the costs at the sized capacities
+        capacity = {pid: pipe['capacity'] for pid, pipe in
+                    _sized(graph, best_tree, demand, types).items()}
+        for u, v, edge in graph.edges(data=True):
+            if edge['pid'] is not None and not edge['existing']:
+                _, _, edge['weight'], _ = _size(
+                    capacity.get(edge['pid'], 0), edge['length'], types)
+        candidates = [steiner_tree(graph, terminals)]
+
+    if exchange:
+        best_tree = _exchange(graph, best_tree, set(terminals), demand,
+                              types)
+    best = _sized(graph, best_tree, demand, types)
+    best_costs = sum(pipe['costs'] for pipe in best.values())
+
+    df = pd.DataFrame.from_dict(best, orient='index').reindex(
+        pipes.index[~existing])
+    df['hp_type'] = df['hp_type'].where(df['hp_type'].notna(), None)
+    df[['capacity', 'costs', 'losses']] = df[
+        ['capacity', 'costs', 'losses']].fillna(0)
+    df['direction'] = df['direction'].fillna(0).astype(int)
+    df = pipes.loc[~existing, ['from_node', 'to_node', 'length']].join(df)
+    logger.info('Heuristic supply tree with {} of {} pipes after {} '
+                'searches: costs {:.0f}'.format(
+                    len(best), len(pipes), n_iter + 1, best_costs))
+    return dict(pipes=df, objective=best_costs)
+
+
+def set_start(om, pipes):
+    """Set the investment of the pipes as start values of the model."""
+    from dhnx.optimization.oemof_heatpipe import HeatPipeline
+
+    block = getattr(om, 'InvestmentFlowBlock', None)
+    if block is None:  # oemof.solph < 0.5
+        block = om.InvestmentFlow
+    labels = {str(i.label) for i, o in block.invest
+              if isinstance(i, HeatPipeline)}
+
+    invest = dict()
+    label = 'infrastructure_heat_{}_{}-{}'.format
+    for row in pipes.loc[pipes['capacity'] > 0].itertuples():
+        forward = label(row.hp_type, row.from_node, row.to_node)
+        backward = label(row.hp_type, row.to_node, row.from_node)
+        # Bidirectional pipes only exist in the direction of the pipe
+        if row.direction == -1 and backward in labels:
+            invest[backward] = row.capacity
+        else:
+            invest[forward] = row.capacity
+
+    for i, o in block.invest:
+        if not isinstance(i, HeatPipeline):
+            continue
+        value = invest.get(str(i.label), 0)
+        block.invest[i, o].value = value
+        if (i, o) in block.invest_status:
+            block.invest_status[i, o].value = 1 if value > 0 else 0
+
+
+def optimize_investment(network, invest_options, start=None, **settings):
+    """Run the investment optimisation with the supply tree as MIP start.
+
+    The results are stored in ``network.results.optimization`` like by
+    network.optimize_investment(), with the additional key 'heuristic'
+    (result of supply_tree()).
+
+    :param network:         [-]     dhnx.network.ThermalNetwork
+    :param invest_options:  [-]     invest options of DHNx
+    :param start:           [-]     result of supply_tree(), default:
+                                    computed with the settings
+    :param settings:        [-]     settings of optimize_investment()
+    :return:                [-]     None
+    """
+    import oemof.solph as solph
+    from dhnx.optimization.optimization_models import (
+        setup_optimise_investment)
+
+    model = setup_optimise_investment(network, invest_options, **settings)
+    if start is None:
+        start = supply_tree(network.components, invest_options,
+                            simultaneity=model.settings['simultaneity'])
+
+    # Like model.solve(), with the start values set before solving
+    model.om = solph.Model(model.es)
+    set_start(model.om, start['pipes'])
+    solve_kw = dict(model.settings['solve_kw'] or {'tee': True},
+                    warmstart=True)
+    model.om.solve(solver=model.settings['solver'], solve_kwargs=solve_kw,
+                   cmdline_options=model.settings.get(
+                       'solver_cmdline_options', {}))
+    model.es.results['main'] = solph.processing.results(model.om)
+    model.es.results['meta'] = solph.processing.meta_results(model.om)
+
+    network.results.optimization = {
+        'oemof': model.es.results['main'],
+        'oemof_meta': model.es.results['meta'],
+        'components': {'pipes': model.get_results_edges()},
+        'heuristic': start,
+        }
+    objective = model.es.results['meta']['objective']
+    if objective > 0:
+        logger.info('Objective {:.0f}, heuristic upper bound {:.0f} ({:.2%} '
+                    'above)'.format(objective, start['objective'],
+                                    start['objective'] / objective - 1))
+    else:
+        logger.info('Objective {:.0f}, heuristic upper bound {:.0f}'.format(
+            objective, start['objective']))
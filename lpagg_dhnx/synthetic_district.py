@@ -0,0 +1,291 @@
+# -*- coding: utf-8 -*-
+
+"""Synthetic streets and buildings in the format of the OSM data.
+
+Part I of import_osm_invest_lpagg needs OpenStreetMap data of a real
+district. For benchmarks and tests of the later parts with districts of
+any size, this module creates streets and buildings with the same schema
+as the GeoDataFrames of osmnx (and osm_cache):
+
+- streets: LineStrings with the columns 'highway' and 'name'
+- buildings: Polygons with the columns 'building' and 'building:levels'
+  (a string, missing for a part of the buildings as in OSM)
+- index: MultiIndex of 'element_type' ('way') and 'osmid'
+- crs: EPSG:4326
+
+Two street layouts are available:
+
+- 'grid': a regular grid of residential streets with blocks of
+  ``block_size`` meters. Every fifth street is 'unclassified'.
+- 'tree': a main road ('unclassified') with residential side streets
+  and short dead end service roads branching off from them.
+
+The buildings are rectangles along both sides of the streets. Their OSM
+building tag is drawn from the shares in BUILDING_TYPES, which also
+defines the footprint and the range of the number of floors of each tag.
+The tags are those of the building typology (building_loads), so the
+buildings can be passed to run_lpagg(). Footprints that overlap a street
+or another building are dropped. The size of the street network is
+increased until there is room for the requested number of buildings.
+
+Usage::
+
+    import synthetic_district
+    data = synthetic_district.osm_data(n_buildings=1000, layout='tree')
+    data['houses'], data['generators'], data['streets']
+
+"""
+import logging
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely
+
+import dhnx.gistools.geometry_operations as go
+
+# Define the logging function
+logger = logging.getLogger(__name__)
+
+# OSM building tag -> share of the buildings, footprint width (along the
+# street) and depth [m] and minimum and maximum number of floors
+BUILDING_TYPES = pd.DataFrame(
+    [('house', 0.45, 10, 12, 1, 2),
+     ('detached', 0.15, 11, 13, 1, 2),
+     ('semidetached_house', 0.10, 8, 12, 2, 2),
+     ('residential', 0.05, 14, 12, 2, 3),
+     ('apartments', 0.15, 24, 14, 3, 6),
+     ('retail', 0.04, 20, 18, 1, 2),
+     ('commercial', 0.04, 30, 20, 1, 4),
+     ('industrial', 0.02, 40, 30, 1, 1),
+     ],
+    columns=['building', 'share', 'width', 'depth', 'levels_min',
+             'levels_max']).set_index('building')
+
+# Center of the example district of import_osm_invest_lpagg (lon, lat)
+ORIGIN = (9.105, 54.193)
+
+
+def grid_streets(n_x, n_y, block_size=(120, 100)):
+    """Return the ways of a grid of streets.
+
+    :param n_x:         [-]     number of blocks in x direction
+    :param n_y:         [-]     number of blocks in y direction
+    :param block_size:  [m]     length of the blocks in x and y direction
+    :return:            [-]     list of (LineString, highway tag), one way
+                                between each pair of adjacent crossings
+    """
+    dx, dy = block_size
+    ways = []
+    for j in range(n_y + 1):
+        highway = 'unclassified' if j % 5 == 0 else 'residential'
+        ways += [(shapely.LineString([(i*dx, j*dy), ((i+1)*dx, j*dy)]),
+                  highway) for i in range(n_x)]
+    for i in range(n_x + 1):
+        highway = 'unclassified' if i % 5 == 0 else 'residential'
+        ways += [(shapely.LineString([(i*dx, j*dy), (i*dx, (j+1)*dy)]),
+                  highway) for j in range(n_y)]
+    return ways
+
+
+def tree_streets(n_branches, spacing=140, branch_length=400,
+                 twig_spacing=100, twig_length=80):
+    """Return the ways of a tree shaped street network.
+
+    The side streets branch off the main road on alternating sides, the
+    service roads branch off the side streets on alternating sides.
+
+    :param n_branches:      [-]     number of side streets
+    :param spacing:         [m]     distance of the side streets
+    :param branch_length:   [m]     length of the side streets
+    :param twig_spacing:    [m]     distance of the service roads
+    :param twig_length:     [m]     length of the service roads
+    :return:                [-]     list of (LineString, highway tag)
+    """
+    def split(start, direction, length, step):
+        """Return the ways between the branching points of a street."""
+        points = [start + direction * x for x in
+                  np.append(np.arange(0, length, step), length)]
+        return [shapely.LineString([a, b]) for a, b in
+                zip(points[:-1], points[1:]) if not np.allclose(a, b)]
+
+    x_axis, y_axis = np.array([1., 0.]), np.array([0., 1.])
+    ways = [(way, 'unclassified') for way in
+            split(np.zeros(2), x_axis, n_branches * spacing, spacing)]
+    for i in range(n_branches):
+        start = x_axis * (i + 1) * spacing
+        side = y_axis if i % 2 == 0 else -y_axis
+        branch = split(start, side, branch_length, twig_spacing)
+        ways += [(way, 'residential') for way in branch]
+        for k in range(1, len(branch)):
+            twig_start = start + side * k * twig_spacing
+            twig_side = x_axis if k % 2 == 0 else -x_axis
+            ways.append((shapely.LineString(
+                [twig_start, twig_start + twig_side * twig_length]),
+                'service'))
+    return ways
+
+
+def _footprints(ways, rng, types, setback=6, gap=4):
+    """Return candidate footprints along both sides of the ways.
+
+    :return:    [-]     tuple of a list of Polygons and an array of the
+                        building tags
+    """
+    lengths = [line.length for line, _ in ways]
+    n_max = int(2 * sum(lengths) / (types['width'].min() + gap)) + 1
+    tags = rng.choice(types.index, size=n_max,
+                      p=types['share'] / types['share'].sum())
+    widths, depths = types['width'].to_dict(), types['depth'].to_dict()
+    n = 0
+    polygons = []
+    for (line, _), length in zip(ways, lengths):
+        start, end = np.array(line.coords[0]), np.array(line.coords[-1])
+        along = (end - start) / length
+        for normal in (np.array([-along[1], along[0]]),
+                       np.array([along[1], -along[0]])):
+            position = setback
+            while True:
+                width, depth = widths[tags[n]], depths[tags[n]]
+                if position + width > length - setback:
+                    break
+                corner = start + along * position + normal * setback
+                polygons.append(shapely.Polygon([
+                    corner, corner + along * width,
+                    corner + along * width + normal * depth,
+                    corner + normal * depth]))
+                position += width + gap
+                n += 1
+    return polygons, tags[:n]
+
+
+def _remove_overlaps(polygons, ways, setback=6):
+    """Return the indices of footprints without overlaps.
+
+    Footprints that intersect a street (with a buffer of the setback) are
+    removed, then of each pair of overlapping footprints the second one.
+    """
+    polygons = np.asarray(polygons)
+    streets = shapely.buffer(np.array([line for line, _ in ways]),
+                             setback - 1)
+    blocked = np.unique(shapely.STRtree(streets).query(
+        polygons, predicate='intersects')[0])
+    keep = np.setdiff1d(np.arange(len(polygons)), blocked)
+
+    i, j = shapely.STRtree(polygons[keep]).query(polygons[keep],
+                                                 predicate='intersects')
+    removed = set()
+    for a, b in sorted(zip(i[i < j], j[i < j])):
+        if a not in removed:
+            removed.add(b)
+    return keep[sorted(set(range(len(keep))) - removed)]
+
+
+def _to_osm_format(gdf, offset):
+    """Move the local coordinates by the offset and set the OSM index."""
+    gdf = gdf.set_geometry(gdf.translate(*offset))
+    gdf = gdf.set_crs('EPSG:4647').to_crs('EPSG:4326')
+    gdf.index = pd.MultiIndex.from_arrays(
+        [['way'] * len(gdf), np.arange(len(gdf)) + 1],
+        names=['element_type', 'osmid'])
+    return gdf
+
+
+def district(n_buildings, layout='grid', types=None, missing_levels=0.3,
+             origin=ORIGIN, seed=42):
+    """Return synthetic buildings and streets like the OSM data.
+
+    :param n_buildings:     [-]     number of buildings
+    :param layout:          [-]     street layout, 'grid' or 'tree'
+    :param types:           [-]     DataFrame like BUILDING_TYPES
+    :param missing_levels:  [-]     fraction of the buildings without the
+                                    tag 'building:levels'
+    :param origin:          [-]     center of the district (lon, lat)
+    :param seed:            [-]     seed of the random numbers
+    :return:                [-]     dict with GeoDataFrames 'buildings' and
+                                    'streets' (see module docstring)
+    """
+    if layout not in ('grid', 'tree'):
+        raise ValueError("layout must be 'grid' or 'tree', not "
+                         "{}".format(layout))
+    if types is None:
+        types = BUILDING_TYPES
+    rng = np.random.default_rng(seed)
+
+    # Street length for the buildings on both sides, corrected below
+    frontage = (types['share'] * (types['width'] + 4)).sum() / (
+        types['share'].sum())
+    street_length = 1.5 * n_buildings * frontage / 2
+    while True:
+        if layout == 'grid':  # about 220 m of streets per block
+            n = max(1, int(np.ceil(np.sqrt(street_length / 220))))
+            ways = grid_streets(n, n)
+        else:  # about 780 m of streets per side street
+            ways = tree_streets(max(1, int(np.ceil(street_length / 780))))
+        polygons, tags = _footprints(ways, rng, types)
+        keep = _remove_overlaps(polygons, ways)
+        if len(keep) >= n_buildings:
+            break
+        street_length *= 1.3 * n_buildings / max(len(keep), 1)
+
+    # Keep a random selection of the footprints, in order along the streets
+    keep = np.sort(rng.choice(keep, size=n_buildings, replace=False))
+    tags = tags[keep]
+    levels = rng.integers(types.loc[tags, 'levels_min'],
+                          types.loc[tags, 'levels_max'] + 1)
+    levels = pd.Series(levels.astype(str), dtype=object)
+    levels[rng.random(n_buildings) < missing_levels] = np.nan
+
+    buildings = gpd.GeoDataFrame(
+        {'building': tags, 'building:levels': levels.to_numpy()},
+        geometry=[polygons[i] for i in keep])
+    streets = gpd.GeoDataFrame(
+        {'highway': [highway for _, highway in ways],
+         'name': ['Street {}'.format(i + 1) for i in range(len(ways))]},
+        geometry=[line for line, _ in ways])
+    # Move the center of the streets to the origin (in EPSG:4647)
+    center = gpd.GeoSeries(gpd.points_from_xy([origin[0]], [origin[1]]),
+                           crs='EPSG:4326').to_crs('EPSG:4647').iloc[0]
+    x_min, y_min, x_max, y_max = streets.total_bounds
+    offset = (center.x - (x_min + x_max) / 2, center.y - (y_min + y_max) / 2)
+
+    logger.info('Synthetic {} district with {} buildings and {} streets '
+                '({:.1f} km)'.format(layout, n_buildings, len(streets),
+                                     streets.length.sum() / 1000))
+    return dict(buildings=_to_osm_format(buildings, offset),
+                streets=_to_osm_format(streets, offset))
+
+
+def osm_data(n_buildings, layout='grid', adoption_rate=0.7, seed=42,
+             **kwargs):
+    """Return a synthetic district like get_osm_data() (Part I).
+
+    One building becomes the generator, ``adoption_rate`` of the others
+    get 'DH_stage' = 1.
+
+    :param n_buildings:     [-]     number of buildings, including the
+                                    generator
+    :param layout:          [-]     street layout, 'grid' or 'tree'
+    :param adoption_rate:   [-]     fraction of buildings to connect to DHN
+    :param seed:            [-]     seed of the random numbers
+    :param kwargs:          [-]     further arguments of district()
+    :return:                [-]     dict with GeoDataFrames 'houses',
+                                    'generators' and 'streets'
+    """
+    data = district(n_buildings, layout=layout, seed=seed, **kwargs)
+    gdf_poly_houses = go.check_crs(data['buildings'])
+    gdf_lines_streets = go.check_crs(data['streets'])
+
+    rng = np.random.default_rng(seed)
+    id_generator = rng.integers(len(gdf_poly_houses))
+    gdf_poly_gen = gdf_poly_houses.iloc[[id_generator]].copy()
+    gdf_poly_houses = gdf_poly_houses.drop(index=gdf_poly_gen.index)
+    gdf_poly_houses.reset_index(drop=True, inplace=True)
+
+    ids_DH = rng.choice(len(gdf_poly_houses),
+                        size=int(adoption_rate*len(gdf_poly_houses)),
+                        replace=False)
+    gdf_poly_houses['DH_stage'] = 0
+    gdf_poly_houses.loc[ids_DH, 'DH_stage'] = 1
+
+    return dict(houses=gdf_poly_houses, generators=gdf_poly_gen,
+                streets=gdf_lines_streets)
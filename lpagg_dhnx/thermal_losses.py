@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+
+"""Hourly heat losses of the invested pipe network.
+
+The DHNx investment model only uses the linear loss factors from
+``invest_data/network/pipes.csv``. Here the losses of every invested pipe
+are calculated for each hour of a year from its DN and length, the supply
+and return temperature and the ground temperature.
+
+The ground temperature at the laying depth is derived from the air
+temperature of a DWD TRY weather file with the model of Kusuda and
+Achenbach (annual sine wave, damped and delayed with depth).
+
+The heat transfer of each pipe follows from the thermal resistances of the
+insulation and the soil, for single plastic jacket pipes (KMR) of
+insulation series 1. Supply and return pipe are assumed not to influence
+each other.
+
+The losses form a matrix of pipes x hours. It is evaluated in chunks of
+pipes, so that the memory use stays bounded for large networks; only
+per-pipe annual totals and the network loss time series are kept, unless
+the full matrix is requested.
+
+Usage::
+
+    import thermal_losses
+    T_ground = thermal_losses.ground_temperature(
+        'lpagg_in/DWD_TRY_weather_file.dat')
+    losses = thermal_losses.calc_losses(gdf_pipes, T_ground)
+    losses['network']  # [W] hourly series
+
+"""
+import logging
+import numpy as np
+import pandas as pd
+
+import weather_try
+
+# Define the logging function
+logger = logging.getLogger(__name__)
+
+# Outer diameter of the medium pipe and of the casing [mm] of plastic
+# jacket pipes with insulation series 1 (typical manufacturer values)
+KMR_SERIES_1 = pd.DataFrame(
+    {'d_medium': [33.7, 42.4, 48.3, 60.3, 76.1, 88.9, 114.3, 139.7, 168.3,
+                  219.1, 273.0, 323.9, 355.6, 406.4, 508.0, 610.0],
+     'D_casing': [90, 110, 110, 125, 140, 160, 200, 225, 250,
+                  315, 400, 450, 500, 560, 710, 800]})
+
+
+def ground_temperature(weather_file='./lpagg_in/DWD_TRY_weather_file.dat',
+                       depth=1.0, alpha=0.05, year=2021):
+    """Estimate the hourly ground temperature from a TRY weather file.
+
+    Kusuda-Achenbach: the annual mean and amplitude are taken from a sine
+    wave fitted to the daily mean air temperature. In the depth z the
+    amplitude is damped by ``exp(-z/d)`` and the phase delayed by ``z/d``,
+    with the damping depth ``d = sqrt(365 * alpha / pi)``.
+
+    :param weather_file:    [-]         path to a DWD TRY .dat file
+    :param depth:           [m]         laying depth of the pipes
+    :param alpha:           [m^2/d]     thermal diffusivity of the soil
+    :param year:            [-]         year of the returned index
+    :return:                [°C]        hourly ground temperature (Series)
+    """
+    T_air = weather_try.read_try(weather_file, year=year)['t']
+    T_day = T_air.resample('D').mean()
+
+    # Least squares fit of T_mean + a*cos(w*t) + b*sin(w*t)
+    t_day = np.arange(len(T_day))
+    w = 2 * np.pi / 365
+    A = np.column_stack([np.ones(len(t_day)), np.cos(w*t_day),
+                         np.sin(w*t_day)])
+    (T_mean, a, b), *_ = np.linalg.lstsq(A, T_day.to_numpy(), rcond=None)
+    amplitude = np.hypot(a, b)
+    phase = np.arctan2(b, a)
+
+    d = np.sqrt(365 * alpha / np.pi)
+    t_hour = np.arange(len(T_air)) / 24
+    T_ground = T_mean + amplitude * np.exp(-depth/d) * np.cos(
+        w*t_hour - phase - depth/d)
+    logger.debug('Ground temperature in {} m: mean {:.1f} °C, amplitude '
+                 '{:.1f} K'.format(depth, T_mean, amplitude*np.exp(-depth/d)))
+    return pd.Series(T_ground, index=T_air.index, name='T_ground')
+
+
+def heat_transfer_coefficient(d_i, depth=1.0, lambda_ins=0.027,
+                              lambda_soil=1.2):
+    """Return the heat transfer coefficient per meter of single pipes.
+
+    The casing diameter is interpolated from KMR_SERIES_1 at the inner
+    diameter. ``U = 1 / (R_insulation + R_soil)`` with
+    ``R_insulation = ln(D/d) / (2*pi*lambda_ins)`` and
+    ``R_soil = ln(4*H/D) / (2*pi*lambda_soil)``.
+
+    :param d_i:         [m]         inner diameter (array)
+    :param depth:       [m]         laying depth (pipe axis)
+    :param lambda_ins:  [W/(m*K)]   thermal conductivity of the insulation
+    :param lambda_soil: [W/(m*K)]   thermal conductivity of the soil
+    :return:            [W/(m*K)]   heat transfer coefficient (array)
+    """
+    d = np.asarray(d_i, dtype=float)
+    D = np.interp(d * 1000, KMR_SERIES_1['d_medium'],
+                  KMR_SERIES_1['D_casing']) / 1000
+    D = np.maximum(D, d * KMR_SERIES_1['D_casing'].iloc[-1]
+                   / KMR_SERIES_1['d_medium'].iloc[-1])
+    R_ins = np.log(D / d) / (2 * np.pi * lambda_ins)
+    R_soil = np.log(4 * depth / D) / (2 * np.pi * lambda_soil)
+    return 1 / (R_ins + R_soil)
+
+
+def calc_losses(pipes, T_ground, T_supply=80, T_return=50, depth=1.0,
+                chunk_size=512, return_matrix=False, **kwargs):
+    """Calculate the hourly heat losses of all invested pipes.
+
+    ``T_supply`` and ``T_return`` may be scalars, hourly series (one value
+    per hour of ``T_ground``) or arrays of shape (pipes, hours).
+
+    :param pipes:           [-]     pipes with columns 'DN', 'length' [m]
+                                    and 'capacity' (only pipes with a
+                                    capacity > 0 are considered)
+    :param T_ground:        [°C]    hourly ground temperature (Series)
+    :param T_supply:        [°C]    supply temperature
+    :param T_return:        [°C]    return temperature
+    :param depth:           [m]     laying depth
+    :param chunk_size:      [-]     number of pipes per evaluated chunk
+    :param return_matrix:   [-]     also return the pipes x hours matrix
+                                    (float32) as 'matrix'
+    :param kwargs:          [-]     passed to heat_transfer_coefficient()
+    :return:                [-]     dict with 'pipes' (annual losses per
+                                    pipe [kWh] and 'U [W/(m*K)]'),
+                                    'network' (hourly losses [W], Series)
+                                    and optionally 'matrix' [W]
+    """
+    pipes = pipes.loc[pipes['capacity'].fillna(0) > 0]
+    n_pipes, n_hours = len(pipes), len(T_ground)
+
+    U = heat_transfer_coefficient(pipes['DN'].to_numpy(dtype=float) / 1000,
+                                  depth=depth, **kwargs)
+    UL = U * pipes['length'].to_numpy(dtype=float)  # [W/K]
+
+    T_g = np.asarray(T_ground, dtype=float)
+    T_s = np.broadcast_to(np.asarray(T_supply, dtype=float),
+                          np.broadcast_shapes(np.shape(T_supply), (n_hours,)))
+    T_r = np.broadcast_to(np.asarray(T_return, dtype=float),
+                          np.broadcast_shapes(np.shape(T_return), (n_hours,)))
+
+    annual = np.zeros(n_pipes)
+    network = np.zeros(n_hours)
+    matrix = (np.empty((n_pipes, n_hours), np.float32) if return_matrix
+              else None)
+    for start in range(0, n_pipes, chunk_size):
+        chunk = slice(start, min(start + chunk_size, n_pipes))
+        T_s_c = T_s[chunk] if T_s.ndim == 2 else T_s
+        T_r_c = T_r[chunk] if T_r.ndim == 2 else T_r
+        # Supply and return pipe of each trench [W]
+        loss = UL[chunk, np.newaxis] * (T_s_c + T_r_c - 2 * T_g)
+        annual[chunk] = loss.sum(axis=1) / 1000  # hourly steps: Wh -> kWh
+        network += loss.sum(axis=0)
+        if return_matrix:
+            matrix[chunk] = loss
+
+    df = pd.DataFrame({'U [W/(m*K)]': U, 'Loss [kWh/a]': annual},
+                      index=pipes.index)
+    logger.info('Annual heat losses of the network: {:.0f} MWh'.format(
+        annual.sum() / 1000))
+    result = dict(pipes=df, network=pd.Series(network, index=T_ground.index,
+                                              name='Loss [W]'))
+    if return_matrix:
+        result['matrix'] = matrix
+    return result
@@ -0,0 +1,372 @@
+# -*- coding: utf-8 -*-
+
+"""Tiled, parallel geometry processing for large supply areas.
+
+``dhnx.gistools.connect_points.process_geometry`` connects all consumers
+and producers to the street network at once. Its runtime grows much
+faster than linear with the number of street segments (e.g. the welding
+of segments compares every segment with all others), so district-wide
+or city-wide areas become very slow.
+
+process_geometry_tiled() splits the area into square tiles. Every
+consumer and producer belongs to the tile ("core") that contains its
+centroid. Each tile is processed in a separate process with the streets
+of its core plus an overlap on all sides, so buildings close to the
+border of a tile are still connected to their nearest street. The
+results are stitched together:
+
+- Consumers and producers are taken from their own tile and renumbered.
+- House and generation connection lines are taken from the tile of the
+  connected building.
+- Street lines of each tile are clipped to its core. Street lines are
+  split where a building of a neighbouring tile is connected to them.
+- Forks are created from the end points of all lines. End points closer
+  than ``tolerance`` (e.g. the same border crossing found by two tiles)
+  are merged into a single fork.
+
+Streets that are cut by the overlap border are kept alive in each tile
+by temporary anchor consumers just outside the tile. Otherwise
+process_geometry would remove them as unused loose ends.
+
+Tiles without consumers and producers (e.g. parks, fields or industrial
+areas between the buildings) have nothing to connect. They are not
+processed, but the streets of their core are passed through, so the
+network stays connected across them. After stitching, a warning is
+logged if not all consumers and producers are connected to each other.
+
+The result has the same structure as the result of process_geometry.
+Differences to an untiled run are additional forks with two pipes at the
+borders of the tiles and unused dead ends that reach across a border or
+lie in tiles without buildings. Both do not change the result of the
+investment optimisation. Buildings that are further away from their
+nearest street than ``overlap`` may be connected to a different street
+than in an untiled run.
+
+Usage::
+
+    import tiled_geometry
+    tn_input = tiled_geometry.process_geometry_tiled(
+        lines=gdf_lines_streets, producers=gdf_poly_gen,
+        consumers=gdf_poly_houses, tile_size=1000, overlap=200)
+
+"""
+import os
+import logging
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely
+import shapely.ops
+from concurrent.futures import ProcessPoolExecutor
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from scipy.spatial import cKDTree
+
+import dhnx.gistools.geometry_operations as go
+from dhnx.gistools.connect_points import process_geometry
+
+# Define the logging function
+logger = logging.getLogger(__name__)
+
+# Distance [m] of the anchor consumers from the cut end of a street
+ANCHOR_DISTANCE = 1.0
+
+
+def make_tiles(bounds, tile_size=1000, overlap=200):
+    """Return the core and the buffered box of each tile.
+
+    :param bounds:      [m]     (minx, miny, maxx, maxy) of the area
+    :param tile_size:   [m]     edge length of the square tiles
+    :param overlap:     [m]     buffer around the core of each tile
+    :return:            [-]     list of (core, buffered) shapely boxes
+    """
+    minx, miny, maxx, maxy = bounds
+    nx = max(int(np.ceil((maxx - minx) / tile_size)), 1)
+    ny = max(int(np.ceil((maxy - miny) / tile_size)), 1)
+    tiles = []
+    for i in range(nx):
+        for j in range(ny):
+            x0, y0 = minx + i * tile_size, miny + j * tile_size
+            core = shapely.box(x0, y0, x0 + tile_size, y0 + tile_size)
+            buffered = shapely.box(x0 - overlap, y0 - overlap,
+                                   x0 + tile_size + overlap,
+                                   y0 + tile_size + overlap)
+            tiles.append((core, buffered))
+    return tiles
+
+
+def _tile_of(geometry, tiles):
+    """Return the index of the tile whose core contains each centroid."""
+    points = shapely.centroid(geometry.to_numpy())
+    cores = np.array([core for core, _ in tiles])
+    # Points on a shared border belong to the first tile found
+    i_point, i_tile = shapely.STRtree(cores).query(points,
+                                                   predicate='intersects')
+    tile = np.full(len(points), -1)
+    tile[i_point[::-1]] = i_tile[::-1]
+    return tile
+
+
+def _clip_lines(lines, box):
+    """Clip lines to a box, keeping only (Multi)LineStrings."""
+    clipped = gpd.clip(lines, box)
+    clipped = clipped.explode(index_parts=False)
+    clipped = clipped.loc[clipped.geom_type == 'LineString']
+    return clipped.loc[~clipped.is_empty & (clipped.length > 0)]
+
+
+def _anchors(lines, box):
+    """Create anchor points beyond the ends of lines cut by the box.
+
+    The anchors extend the last segment of a cut line by ANCHOR_DISTANCE.
+    """
+    boundary = box.boundary
+    anchors = []
+    for geom in lines.geometry:
+        coords = np.asarray(geom.coords)
+        for end, prev in ((coords[0], coords[1]), (coords[-1], coords[-2])):
+            if boundary.distance(shapely.Point(end)) < 1e-6:
+                direction = (end - prev) / np.hypot(*(end - prev))
+                anchors.append(shapely.Point(end
+                                             + ANCHOR_DISTANCE * direction))
+    anchors = gpd.GeoDataFrame(geometry=anchors, crs=lines.crs)
+    return anchors.drop_duplicates(subset='geometry')
+
+
+def _process_tile(lines, producers, consumers, kwargs):
+    """Run process_geometry for a single tile (in a worker process)."""
+    return process_geometry(lines=lines, producers=producers,
+                            consumers=consumers, **kwargs)
+
+
+def _split_lines_at_points(lines, points, tolerance):
+    """Split lines at points that lie on their interior.
+
+    :param lines:       [-]     GeoDataFrame of LineStrings
+    :param points:      [-]     array of shapely Points
+    :param tolerance:   [m]     maximum distance of a point from the line
+    :return:            [-]     GeoDataFrame of LineStrings
+    """
+    geoms = lines.geometry.to_numpy()
+    i_pt, i_line = shapely.STRtree(geoms).query(
+        points, predicate='dwithin', distance=tolerance)
+    dist = shapely.line_locate_point(geoms[i_line], points[i_pt])
+    inner = ((dist > tolerance)
+             & (dist < shapely.length(geoms[i_line]) - tolerance))
+    i_line, dist = i_line[inner], dist[inner]
+    if len(i_line) == 0:
+        return lines
+
+    parts = []
+    for i in np.unique(i_line):
+        cuts = np.unique(np.r_[0, dist[i_line == i], geoms[i].length])
+        parts += [(i, shapely.ops.substring(geoms[i], a, b))
+                  for a, b in zip(cuts[:-1], cuts[1:])]
+    idx, new_geoms = zip(*parts)
+    split = lines.iloc[list(idx)].copy()
+    split.geometry = list(new_geoms)
+    keep = np.ones(len(lines), dtype=bool)
+    keep[np.unique(i_line)] = False
+    logger.debug('Split {} street lines at connections of neighbouring '
+                 'tiles'.format((~keep).sum()))
+    return pd.concat([lines.iloc[keep], split], ignore_index=True)
+
+
+def _create_forks(pipes, tolerance):
+    """Create forks from the line ends and set 'from_node' and 'to_node'.
+
+    Only line ends that are not yet connected to a consumer or producer
+    (i.e. where 'from_node' or 'to_node' is NaN) become forks. End
+    points closer than ``tolerance`` are merged.
+    """
+    geoms = pipes.geometry.to_numpy()
+    ends = shapely.get_coordinates(np.concatenate(
+        [shapely.get_point(geoms, 0), shapely.get_point(geoms, -1)]))
+    free = np.concatenate([pipes['from_node'].isna().to_numpy(),
+                           pipes['to_node'].isna().to_numpy()])
+    coords = ends[free]
+
+    pairs = cKDTree(coords).query_pairs(tolerance, output_type='ndarray')
+    graph = coo_matrix((np.ones(len(pairs)), (pairs[:, 0], pairs[:, 1])),
+                       shape=(len(coords), len(coords)))
+    _, label = connected_components(graph, directed=False)
+    # Renumber the forks in order of their first appearance
+    _, first, label = np.unique(label, return_index=True, return_inverse=True)
+    order = np.argsort(np.argsort(first))
+    label = order[label]
+
+    forks = gpd.GeoDataFrame(
+        geometry=shapely.points(coords[np.sort(first)]), crs=pipes.crs)
+    forks.index.name = 'id'
+    forks['id_full'] = 'forks-' + forks.index.astype(str)
+    forks['lat'] = forks.geometry.y
+    forks['lon'] = forks.geometry.x
+
+    node = np.empty(len(ends), dtype=object)
+    node[free] = forks['id_full'].to_numpy()[label]
+    n = len(pipes)
+    pipes['from_node'] = pipes['from_node'].fillna(
+        pd.Series(node[:n], index=pipes.index))
+    pipes['to_node'] = pipes['to_node'].fillna(
+        pd.Series(node[n:], index=pipes.index))
+    return forks, pipes
+
+
+def _check_connected(pipes, nodes):
+    """Log a warning if the nodes are not all connected by the pipes.
+
+    :param pipes:   [-]     DataFrame with 'from_node' and 'to_node'
+    :param nodes:   [-]     ids of the consumers and producers
+    :return:        [-]     number of connected components of the nodes
+    """
+    ids, edges = np.unique(np.r_[pipes['from_node'], pipes['to_node']],
+                           return_inverse=True)
+    edges = edges.reshape(2, -1)
+    graph = coo_matrix((np.ones(edges.shape[1]), (edges[0], edges[1])),
+                       shape=(len(ids), len(ids)))
+    _, label = connected_components(graph, directed=False)
+    label = pd.Series(label, index=ids).reindex(list(nodes))
+    n_components = label.nunique() + label.isna().sum()
+    if n_components > 1:
+        logger.warning('The consumers and producers are in {} parts of the '
+                       'network that are not connected'.format(
+                           n_components))
+    return n_components
+
+
+def _renumber(gdf, prefix):
+    """Renumber consumers or producers; return them and the id mapping."""
+    old = list(zip(gdf['_tile'], gdf['id_full']))
+    gdf = gdf.drop(columns=['_tile']).reset_index(drop=True)
+    gdf.index.name = 'id'
+    gdf['id_full'] = prefix + '-' + gdf.index.astype(str)
+    return gdf, dict(zip(old, gdf['id_full']))
+
+
+def process_geometry_tiled(lines, producers, consumers, tile_size=1000,
+                           overlap=200, n_workers=None, tolerance=1e-3,
+                           **kwargs):
+    """Connect consumers and producers to the streets in parallel tiles.
+
+    :param lines:       [-]     GeoDataFrame of the streets
+    :param producers:   [-]     GeoDataFrame of the producers
+    :param consumers:   [-]     GeoDataFrame of the consumers
+    :param tile_size:   [m]     edge length of the square tiles
+    :param overlap:     [m]     streets within this distance around a tile
+                                are available for its buildings
+    :param n_workers:   [-]     number of processes, default: all cores
+    :param tolerance:   [m]     distance for merging forks of neighbouring
+                                tiles
+    :param kwargs:      [-]     passed to process_geometry(); only the
+                                method 'midpoint' is supported
+    :return:            [-]     dict with 'forks', 'consumers', 'producers'
+                                and 'pipes', like process_geometry()
+    """
+    if kwargs.get('method', 'midpoint') != 'midpoint':
+        raise ValueError("Tiled geometry processing only supports the "
+                         "method 'midpoint'")
+    projected_crs = kwargs.get('projected_crs', 4647)
+    lines = go.check_crs(lines.copy(), crs=projected_crs)
+    producers = go.check_crs(producers.copy(), crs=projected_crs)
+    consumers = go.check_crs(consumers.copy(), crs=projected_crs)
+
+    bounds = np.array([gdf.total_bounds for gdf in
+                       (lines, producers, consumers)])
+    tiles = make_tiles((*bounds[:, :2].min(axis=0),
+                        *bounds[:, 2:].max(axis=0)),
+                       tile_size=tile_size, overlap=overlap)
+    consumers['_tile'] = _tile_of(consumers.geometry, tiles)
+    producers['_tile'] = _tile_of(producers.geometry, tiles)
+
+    # Input of each tile with buildings. All producers are passed to every
+    # tile, because process_geometry needs at least one of them. Only the
+    # tile that owns a producer keeps its connection.
+    args, used, passed = [], [], []
+    for i, (core, buffered) in enumerate(tiles):
+        own = consumers.loc[consumers['_tile'] == i]
+        if len(own) == 0 and not (producers['_tile'] == i).any():
+            # Nothing to connect, pass the streets of the core through
+            streets = _clip_lines(lines[['geometry']], core)
+            if len(streets) > 0:
+                passed.append(streets.assign(
+                    type='DL', _tile=i, _building=None,
+                    _from_building=False))
+            continue
+        tile_lines = _clip_lines(lines, buffered)
+        anchors = _anchors(tile_lines, buffered)
+        anchors['_tile'] = -1
+        tile_consumers = pd.concat([own, anchors], ignore_index=True)
+        args.append((tile_lines, producers.copy(), tile_consumers, kwargs))
+        used.append(i)
+
+    n_workers = min(n_workers or os.cpu_count(), len(args))
+    logger.info('Processing geometry in {} of {} tiles on {} processes, '
+                'streets of {} tiles without buildings are passed through'
+                .format(len(used), len(tiles), n_workers, len(passed)))
+    if n_workers > 1:
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            results = list(executor.map(_process_tile, *zip(*args)))
+    else:
+        results = [_process_tile(*a) for a in args]
+
+    # Stitch the tiles
+    cons_all, prod_all, pipes_all = [], [], []
+    for i, result in zip(used, results):
+        core = tiles[i][0]
+        cons = result['consumers']
+        prod = result['producers']
+        cons_all.append(cons.loc[cons['_tile'] == i])
+        prod_all.append(prod.loc[prod['_tile'] == i])
+
+        # Remember the building (if any) at either end of each pipe
+        from_node = result['pipes']['from_node']
+        to_node = result['pipes']['to_node']
+        from_building = ~from_node.str.startswith('forks-')
+        pipes = result['pipes'].drop(columns=['from_node', 'to_node'])
+        pipes['_tile'] = i
+        pipes['_building'] = from_node.where(
+            from_building, to_node.where(~to_node.str.startswith('forks-')))
+        pipes['_from_building'] = from_building
+        own = set(cons_all[-1]['id_full']) | set(prod_all[-1]['id_full'])
+        connections = pipes.loc[pipes['_building'].isin(own)]
+        streets = _clip_lines(pipes.loc[pipes['_building'].isna()], core)
+        pipes_all += [connections, streets]
+
+    consumers, map_cons = _renumber(pd.concat(cons_all), 'consumers')
+    producers, map_prod = _renumber(pd.concat(prod_all), 'producers')
+    pipes = pd.concat(pipes_all + passed, ignore_index=True)
+
+    # Split streets where buildings of other tiles are connected
+    is_conn = pipes['_building'].notna().to_numpy()
+    conn = pipes.loc[is_conn]
+    street_ends = np.where(conn['_from_building'], shapely.get_point(
+        conn.geometry.to_numpy(), -1), shapely.get_point(
+        conn.geometry.to_numpy(), 0))
+    streets = _split_lines_at_points(pipes.loc[~is_conn], street_ends,
+                                     tolerance)
+    pipes = pd.concat([conn, streets], ignore_index=True)
+
+    # Node ids of buildings, forks for all other line ends
+    mapping = {**map_cons, **map_prod}
+    building = pd.Series([mapping.get(key) for key in
+                          zip(pipes['_tile'], pipes['_building'])],
+                         index=pipes.index, dtype=object)
+    pipes['from_node'] = building.where(pipes['_from_building'])
+    pipes['to_node'] = building.where(~pipes['_from_building'])
+    forks, pipes = _create_forks(pipes, tolerance)
+    _check_connected(pipes, pd.concat([consumers['id_full'],
+                                       producers['id_full']]))
+
+    pipes = pipes.drop(columns=['_tile', '_building', '_from_building'])
+    pipes = gpd.GeoDataFrame(pipes, geometry='geometry', crs=lines.crs)
+    pipes.index.name = 'id'
+    pipes['length'] = pipes.length
+    logger.info('Total line length is {:.0f} m'.format(
+        pipes['length'].sum()))
+
+    return {
+        'forks': forks,
+        'consumers': consumers,
+        'producers': producers,
+        'pipes': pipes,
+    }
@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+
+"""Read test reference year (TRY) weather files of the DWD.
+
+The files (e.g. lpagg_in/DWD_TRY_weather_file.dat) have a long text
+header, followed by a line starting with '***' and hourly values in fixed
+width columns. The hour 'HH' is given from 1 to 24 (MEZ) and denotes the
+end of each hourly interval; the DatetimeIndex uses the start.
+
+The values are parsed into one float array of hours x TRY_COLUMNS. This
+array is cached as .npy file in ``cache_dir`` (default:
+./dhnx_out/cache, e.g. TRY_DWD_TRY_weather_file_<hash>.npy, with a hash
+of the absolute path of the source file) and loaded memory-mapped, as
+long as it is newer than the source file. If the cache directory is not
+writable, the file is parsed each time.
+
+load_try_cube() combines several TRY files (e.g. of different stations
+or scenarios) into one array of stations x hours x variables.
+
+Usage::
+
+    import weather_try
+    df = weather_try.read_try('lpagg_in/DWD_TRY_weather_file.dat')
+    cube = weather_try.load_try_cube(paths, variables=['t', 'B', 'D'])
+    cube['data'][:, :, 0]  # temperature of all stations
+
+"""
+import os
+import hashlib
+import logging
+import numpy as np
+import pandas as pd
+
+# Define the logging function
+logger = logging.getLogger(__name__)
+
+TRY_COLUMNS = ['RW', 'HW', 'MM', 'DD', 'HH', 't', 'p', 'WR', 'WG', 'N', 'x',
+               'RF', 'B', 'D', 'A', 'E', 'IL']
+
+# Columns with decimal places, all others are integers
+TRY_FLOAT_COLUMNS = ['t', 'WG', 'x']
+
+
+def _parse(path):
+    """Parse the data section of a TRY file into a float array."""
+    with open(path, 'rb') as f:
+        content = f.read()
+    marker = content.find(b'\n***')
+    if marker < 0:
+        raise ValueError('No data section found in TRY file {}'.format(path))
+    start = content.find(b'\n', marker + 1) + 1
+    values = np.array(content[start:].split(), dtype=float)
+    if len(values) % len(TRY_COLUMNS):
+        raise ValueError('Data section of TRY file {} is not a table of {} '
+                         'columns'.format(path, len(TRY_COLUMNS)))
+    return values.reshape(-1, len(TRY_COLUMNS))
+
+
+def cache_path_try(path, cache_dir='./dhnx_out/cache'):
+    """Return the path of the .npy cache file of a TRY file.
+
+    :param path:        [-]     path to the TRY .dat file
+    :param cache_dir:   [-]     directory of the cache files
+    :return:            [-]     path of the cache file
+    """
+    key = hashlib.sha256(os.path.abspath(path).encode()).hexdigest()[:12]
+    name = os.path.splitext(os.path.basename(path))[0]
+    return os.path.join(cache_dir, 'TRY_{}_{}.npy'.format(name, key))
+
+
+def read_try_array(path, cache_dir='./dhnx_out/cache'):
+    """Return the values of a TRY file as array of hours x TRY_COLUMNS.
+
+    :param path:        [-]     path to the TRY .dat file
+    :param cache_dir:   [-]     directory of the .npy cache files, None:
+                                no cache
+    :return:            [-]     float array (memory-mapped if cached)
+    """
+    cache_path = None if cache_dir is None else cache_path_try(path,
+                                                               cache_dir)
+    if (cache_path and os.path.exists(cache_path)
+            and os.path.getmtime(cache_path) >= os.path.getmtime(path)):
+        return np.load(cache_path, mmap_mode='r')
+
+    values = _parse(path)
+    if cache_path:
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            tmp = cache_path + '.tmp.npy'
+            np.save(tmp, values)
+            os.replace(tmp, cache_path)
+            logger.debug('Saved TRY cache file {}'.format(cache_path))
+        except OSError as e:
+            logger.debug('TRY cache file not written: {}'.format(e))
+    return values
+
+
+def _index(values, year):
+    """Return the hourly DatetimeIndex from the columns MM, DD and HH."""
+    month, day, hour = (values[:, TRY_COLUMNS.index(col)].astype(int)
+                        for col in ('MM', 'DD', 'HH'))
+    index = (pd.to_datetime(pd.DataFrame({'year': year, 'month': month,
+                                          'day': day}))
+             + pd.to_timedelta(hour - 1, unit='h'))
+    return pd.DatetimeIndex(index, name='time')
+
+
+def read_try(path, year=2021, cache_dir='./dhnx_out/cache'):
+    """Read a DWD TRY file into a DataFrame with hourly DatetimeIndex.
+
+    :param path:        [-]     path to the TRY .dat file
+    :param year:        [-]     year of the index (TRY files have none)
+    :param cache_dir:   [-]     directory of the .npy cache files, None:
+                                no cache
+    :return:            [-]     DataFrame with the columns TRY_COLUMNS
+    """
+    values = read_try_array(path, cache_dir=cache_dir)
+    df = pd.DataFrame(np.array(values), columns=TRY_COLUMNS,
+                      index=_index(values, year))
+    int_columns = [col for col in TRY_COLUMNS
+                   if col not in TRY_FLOAT_COLUMNS]
+    df[int_columns] = df[int_columns].astype(np.int64)
+    logger.debug('Read {} hours from TRY file {}'.format(len(df), path))
+    return df
+
+
+def load_try_cube(paths, variables=None, year=2021,
+                  cache_dir='./dhnx_out/cache'):
+    """Load several TRY files into one array of stations x hours x variables.
+
+    All files must cover the same hours.
+
+    :param paths:       [-]     list of paths to TRY .dat files
+    :param variables:   [-]     list of columns, default: all TRY_COLUMNS
+    :param year:        [-]     year of the index
+    :param cache_dir:   [-]     directory of the .npy cache files, None:
+                                no cache
+    :return:            [-]     dict with 'data' (float array), 'index'
+                                (DatetimeIndex of the hours), 'stations'
+                                (the paths) and 'variables'
+    """
+    variables = list(variables or TRY_COLUMNS)
+    columns = [TRY_COLUMNS.index(var) for var in variables]
+    arrays = [read_try_array(path, cache_dir=cache_dir) for path in paths]
+
+    n_hours = {len(values) for values in arrays}
+    if len(n_hours) > 1:
+        raise ValueError('TRY files have different numbers of hours: '
+                         '{}'.format(sorted(n_hours)))
+
+    data = np.empty((len(arrays), n_hours.pop(), len(variables)))
+    for i, values in enumerate(arrays):
+        data[i] = values[:, columns]
+    return dict(data=data, index=_index(arrays[0], year),
+                stations=list(paths), variables=variables)